@@ -52,6 +52,18 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
+# Configure prescription scanning
+app.config['SCAN_BATCH_MAX_PAGES'] = int(os.environ.get('SCAN_BATCH_MAX_PAGES', 20))
+app.config['SCAN_MAX_UPLOAD_BYTES'] = int(os.environ.get('SCAN_MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+# Content-addressed store of scanned images, under the instance folder by default
+app.config['SCAN_STORE_DIR'] = os.environ.get('SCAN_STORE_DIR')
+# Seconds between keep-alive comments on idle scan progress streams
+app.config['SCAN_EVENTS_KEEPALIVE'] = int(os.environ.get('SCAN_EVENTS_KEEPALIVE', 15))
+# Most dosage lines or prescriptions checked by one batch verification request
+app.config['DOSAGE_BATCH_MAX_LINES'] = int(os.environ.get('DOSAGE_BATCH_MAX_LINES', 200))
+# Most stock changes applied by one batch inventory request
+app.config['INVENTORY_BATCH_MAX_LINES'] = int(os.environ.get('INVENTORY_BATCH_MAX_LINES', 1000))
+
 # Initialize db with app
 db.init_app(app)
 
@@ -70,21 +82,8 @@ from models import User
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
-with app.app_context():
-    # Make sure to import the models here or their tables won't be created
-    import models  # noqa: F401
-
-    db.create_all()
-    logging.info("Database tables created")
-    
-    # Create default roles if they don't exist
-    from models import Role
-    roles = ['patient', 'doctor', 'pharmacist']
-    for role_name in roles:
-        role = Role.query.filter_by(name=role_name).first()
-        if not role:
-            role = Role(name=role_name)
-            db.session.add(role)
-    
-    db.session.commit()
-    logging.info("Default roles created")
+# Scan-dedicated workers can load the OCR and AI stack up front rather than
+# on the first scan
+if os.environ.get('SCAN_PRELOAD') == '1':
+    from utils.scan_pipeline import preload_scan_stack
+    preload_scan_stack()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Import-time benchmark for MedScanner
+
+Measures how long a fresh interpreter takes to import the app, lists the
+slowest imports, and checks the OCR and AI stack is not loaded by it.
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+# Modules only scanning code should load
+HEAVY_MODULES = ['cv2', 'numpy', 'PIL', 'pytesseract', 'openai', 'tesserocr', 'utils.ocr']
+
+MEASURE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed, ','.join(heavy))
+"""
+
+
+def measure_once(module, env):
+    """Import module in a new interpreter, returning (seconds, heavy modules loaded)"""
+    code = MEASURE.format(module=module, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    elapsed, _, heavy = result.stdout.splitlines()[-1].partition(' ')
+    return float(elapsed), [name for name in heavy.split(',') if name]
+
+
+def slowest_imports(module, env, count):
+    """Cumulative import times from python -X importtime, slowest first"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env=env)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative), name.strip()))
+    return sorted(timings, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure MedScanner cold import time")
+    parser.add_argument("--module", default="app", help="Module to import")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to time")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with an error if importing loads the OCR or AI stack")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "sqlite://")
+
+    times = []
+    heavy = []
+    for _ in range(args.runs):
+        elapsed, heavy = measure_once(args.module, env)
+        times.append(elapsed)
+
+    print(f"import {args.module}: median {statistics.median(times) * 1000:.0f} ms, "
+          f"min {min(times) * 1000:.0f} ms over {args.runs} runs\n")
+    print(f"{'cumulative (ms)':>16}  module")
+    for cumulative, name in slowest_imports(args.module, env, args.top):
+        print(f"{cumulative / 1000:>16.1f}  {name}")
+
+    if heavy:
+        print(f"\nLoaded at import time: {', '.join(heavy)}")
+        return 1 if args.check else 0
+    print("\nOCR and AI stack not loaded at import time")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Scan pipeline benchmark for MedScanner
+
+Runs the scan pipeline over a generated corpus of synthetic prescriptions and
+reports throughput and per-stage latency. OCR, vision and extraction use the
+fake backends by default, so nothing is sent over the network.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+STAGES = ['decoded', 'preprocessed', 'ocr_done', 'extraction_done', 'resolved']
+
+
+def prepare_environment(workdir):
+    """Point the app at a throwaway database and scan store before importing it"""
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    os.environ['SCAN_STORE_DIR'] = os.path.join(workdir, 'scans')
+
+
+def seed_catalog(db):
+    """Add the medications named in the corpus to the catalog"""
+    from models import Medication
+    from utils.scan_corpus import SAMPLE_PRESCRIPTIONS
+
+    names = sorted({line.split()[0] for lines in SAMPLE_PRESCRIPTIONS for line in lines})
+    db.session.add_all(Medication(name=name, generic_name=name.lower()) for name in names)
+    db.session.commit()
+
+
+def scan_once(app, image_bytes, user_id=None):
+    """Scan one image, returning the time each stage finished"""
+    from utils.scan_pipeline import run_scan_pipeline
+
+    times = {}
+    with app.app_context():
+        start = time.perf_counter()
+        run_scan_pipeline(image_bytes=image_bytes, user_id=user_id,
+                          progress=lambda stage, data: times.setdefault(stage, time.perf_counter()))
+        times['end'] = time.perf_counter()
+    times['start'] = start
+    return times
+
+
+def stage_latencies(timings):
+    """Seconds spent in each stage, measured from the previous stage reached"""
+    latencies = {stage: [] for stage in STAGES + ['total']}
+    for times in timings:
+        previous = times['start']
+        for stage in STAGES:
+            if stage in times:
+                latencies[stage].append(times[stage] - previous)
+                previous = times[stage]
+        latencies['total'].append(times['end'] - times['start'])
+    return latencies
+
+
+def print_report(latencies, elapsed, scans, workers):
+    import numpy as np
+
+    print(f"\nScanned {scans} images in {elapsed:.2f}s with {workers} workers: "
+          f"{scans / elapsed:.2f} scans/sec\n")
+    print(f"{'stage':<18}{'p50 (ms)':>10}{'p95 (ms)':>10}{'count':>8}")
+    for stage, values in latencies.items():
+        if not values:
+            continue
+        p50, p95 = np.percentile(np.array(values) * 1000, [50, 95])
+        print(f"{stage:<18}{p50:>10.1f}{p95:>10.1f}{len(values):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MedScanner scan pipeline")
+    parser.add_argument("--scans", type=int, default=50, help="Number of synthetic scans")
+    parser.add_argument("--workers", type=int, default=4, help="Scans processed at the same time")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the corpus and fake latencies")
+    parser.add_argument("--ocr", default="fake", help="OCR backend (fake, tesseract)")
+    parser.add_argument("--vision", default="fake", help="Vision backend (fake, openai)")
+    parser.add_argument("--extraction", default="fake", help="Extraction backend (fake, openai)")
+    parser.add_argument("--ocr-latency", type=float, default=0.15, help="Seconds per fake OCR call")
+    parser.add_argument("--vision-latency", type=float, default=1.5, help="Seconds per fake vision call")
+    parser.add_argument("--extraction-latency", type=float, default=1.0, help="Seconds per fake extraction call")
+    parser.add_argument("--jitter", type=float, default=0.25,
+                        help="Fake latencies vary by up to this fraction either way")
+    parser.add_argument("--empty-catalog", action="store_true",
+                        help="Start with no medications, so every scan needs the extraction backend")
+    parser.add_argument("--reuse", action="store_true",
+                        help="Upload every scan as the same user, so repeated pages reuse earlier results")
+    parser.add_argument("--corpus-dir", help="Also write the corpus images to this directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='medscanner-bench-')
+    prepare_environment(workdir)
+
+    try:
+        from app import app, db
+        from utils.backends import use_backend
+        from utils.bootstrap import bootstrap_database
+        from utils.scan_corpus import generate_corpus, write_corpus
+
+        fake_options = {
+            'ocr': args.ocr_latency,
+            'vision': args.vision_latency,
+            'extraction': args.extraction_latency,
+        }
+        for kind, name in (('ocr', args.ocr), ('vision', args.vision), ('extraction', args.extraction)):
+            options = {}
+            if name == 'fake':
+                latency = fake_options[kind]
+                options = {'latency': latency, 'jitter': latency * args.jitter, 'seed': args.seed}
+            use_backend(kind, name, **options)
+
+        with app.app_context():
+            bootstrap_database()
+            if not args.empty_catalog:
+                seed_catalog(db)
+
+        print(f"Generating {args.scans} synthetic prescriptions...")
+        corpus = [data for _, data in generate_corpus(args.scans, seed=args.seed)]
+        if args.corpus_dir:
+            write_corpus(args.corpus_dir, args.scans, seed=args.seed)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            timings = list(executor.map(lambda data: scan_once(app, data, 1 if args.reuse else None), corpus))
+        elapsed = time.perf_counter() - start
+
+        print_report(stage_latencies(timings), elapsed, len(corpus), args.workers)
+        return 0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,16 @@
 import logging
 from app import app
+from utils.bootstrap import bootstrap_database, check_schema_version
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
 if __name__ == "__main__":
+    # Development server: make sure the database is ready
+    with app.app_context():
+        bootstrap_database()
     app.run(host="0.0.0.0", port=5000, debug=True)
+else:
+    # Workers don't create tables, they only check the schema is current
+    with app.app_context():
+        check_schema_version()
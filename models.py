@@ -52,6 +52,19 @@ class Medication(db.Model):
     # Inventory related
     stock_quantity = db.Column(db.Integer, default=0)
     minimum_stock_level = db.Column(db.Integer, default=10)
+    reserved_quantity = db.Column(db.Integer, default=0)  # held for confirmed prescriptions
+    
+    # Written by the demand forecast (flask forecast-inventory)
+    daily_demand = db.Column(db.Float, nullable=True)  # expected units used per day
+    suggested_minimum_stock = db.Column(db.Integer, nullable=True)  # reorder point for that demand
+    forecast_at = db.Column(db.DateTime, nullable=True)
+    
+    # Low stock is measured against the forecast reorder point when there is one
+    reorder_level = db.column_property(db.func.coalesce(suggested_minimum_stock, minimum_stock_level))
+    # Whether stock is below reorder_level, kept up to date whenever either changes
+    is_low_stock = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false(), index=True)
+    # Days the current stock lasts at the forecast demand, worked out on read so it never goes stale
+    days_of_supply = db.column_property(db.cast(stock_quantity, db.Float) / db.func.nullif(daily_demand, 0, type_=db.Float))
     
     # Relationships
     prescriptions = db.relationship('PrescriptionMedication', backref='medication', lazy=True)
@@ -82,11 +95,11 @@ class DrugInteraction(db.Model):
 
 class Prescription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     date_prescribed = db.Column(db.DateTime, default=datetime.utcnow)
     date_filled = db.Column(db.DateTime, nullable=True)
-    status = db.Column(db.String(20), default='pending')  # pending, filled, cancelled
+    status = db.Column(db.String(20), default='pending')  # pending, confirmed, filled, cancelled
     scan_image_path = db.Column(db.String(255), nullable=True)
     
     # Relationships
@@ -106,6 +119,14 @@ class PrescriptionMedication(db.Model):
     frequency = db.Column(db.String(50))  # e.g., "twice daily", "every 4 hours"
     duration = db.Column(db.String(50))  # e.g., "7 days", "1 month"
     instructions = db.Column(db.Text)
+    quantity = db.Column(db.Integer, nullable=True)  # units dispensed, set when confirmed or filled
+    
+    # Parsed from dosage, frequency and duration when the row is saved
+    doses_per_day = db.Column(db.Float, nullable=True)
+    course_days = db.Column(db.Float, nullable=True)
+    daily_mg = db.Column(db.Float, nullable=True)  # dose in mg times doses per day
+    starts_at = db.Column(db.DateTime, nullable=True)  # when filled, else when prescribed
+    ends_at = db.Column(db.DateTime, nullable=True)  # end of the course, if it has a duration
     
     def __repr__(self):
         return f'<PrescriptionMedication {self.id}>'
@@ -153,6 +174,8 @@ class InventoryLog(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     recorded_by_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     reason = db.Column(db.String(100))  # e.g., "prescription filled", "stock adjustment"
+    # Prescription the stock was dispensed for, None for other changes
+    prescription_id = db.Column(db.Integer, db.ForeignKey('prescription.id'), nullable=True, index=True)
     
     # Relationships
     medication = db.relationship('Medication')
@@ -162,6 +185,25 @@ class InventoryLog(db.Model):
         return f'<InventoryLog {self.id} - {self.medication_id}: {self.quantity_change}>'
 
 
+class InventoryDailyRollup(db.Model):
+    """One medication's inventory movements on one day, kept up to date from InventoryLog"""
+    __table_args__ = (db.UniqueConstraint('medication_id', 'day', name='uq_inventory_daily_rollup_day'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    medication_id = db.Column(db.Integer, db.ForeignKey('medication.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False, index=True)
+    receipts = db.Column(db.Integer, nullable=False, default=0)  # units added
+    dispensed = db.Column(db.Integer, nullable=False, default=0)  # units removed to fill prescriptions
+    adjustments = db.Column(db.Integer, nullable=False, default=0)  # other removals, negative
+    closing_balance = db.Column(db.Integer)  # stock at the end of the day
+    
+    # Relationships
+    medication = db.relationship('Medication')
+    
+    def __repr__(self):
+        return f'<InventoryDailyRollup {self.medication_id} {self.day}>'
+
+
 class PatientMedicalHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -189,3 +231,31 @@ class PatientAllergy(db.Model):
     
     def __repr__(self):
         return f'<PatientAllergy {self.id} - User: {self.user_id}, Allergen: {self.allergen}>'
+
+
+class ScanRecord(db.Model):
+    """A scanned prescription image and the result of processing it"""
+    # Results are only reused for the user who uploaded the scan
+    __table_args__ = (db.Index('uq_scan_record_user_sha256', 'user_id', 'sha256', unique=True),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)  # uploader, None if anonymous
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    dhash = db.Column(db.String(64), nullable=False)  # perceptual hash, hex
+    image_path = db.Column(db.String(255), nullable=False)  # relative to the scan store
+    extracted_text = db.Column(db.Text)
+    medications_json = db.Column(db.Text)  # resolved medications as JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ScanRecord {self.id} {self.sha256[:12]}>'
+
+
+class SchemaVersion(db.Model):
+    """Version of the database schema, a single row kept by bootstrap-db"""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SchemaVersion {self.version}>'
@@ -1,21 +1,35 @@
 import os
+import json
 import logging
 import base64
 import tempfile
-from datetime import datetime
-from flask import flash, redirect, render_template, request, url_for, jsonify, session
+from io import StringIO
+from datetime import datetime, timedelta
+import click
+from flask import flash, redirect, render_template, request, url_for, jsonify, session, Response, send_file, abort
 from flask_login import login_required, login_user, logout_user, current_user
 from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
 from app import app, db
 from models import (User, Role, Medication, DrugInteraction, Prescription,
                    PrescriptionMedication, InteractionReport, InteractionDetail,
-                   InventoryLog, PatientMedicalHistory, PatientAllergy)
-from utils.ocr import extract_text_from_image
-from utils.drug_interaction import check_drug_interactions
-from utils.dosage import verify_dosage
-from utils.inventory import update_inventory
+                   InventoryLog, PatientMedicalHistory, PatientAllergy, ScanRecord)
+from utils.drug_interaction import check_drug_interactions, screen_prescription_interactions
+from utils.dosage import (verify_dosage, verify_dosage_lines, verify_prescription_dosages,
+                          patient_dosing_context, active_daily_totals, patient_daily_totals)
+from utils.inventory import update_inventory, apply_inventory_adjustments
+from utils.inventory_rollups import get_inventory_usage, write_usage_csv
+from utils.dispensing import reserve_prescription, fill_prescriptions, cancel_prescription
+from utils.scan_pipeline import run_scan_pipeline, count_scan_pages
+from utils.scan_jobs import (submit_scan_job, submit_batch_scan_job, get_scan_job,
+                             JOB_DONE, JOB_FAILED)
+
+# Templates show today's date on the dashboards
+@app.context_processor
+def inject_now():
+    return {'now': datetime.utcnow}
 
 # Home page route
 @app.route('/')
@@ -136,10 +150,12 @@ def dashboard():
         
     elif current_user.has_role('pharmacist'):
         # Get pending prescriptions
-        pending_prescriptions = Prescription.query.filter_by(status='pending').order_by(Prescription.date_prescribed.desc()).limit(10).all()
+        pending_prescriptions = Prescription.query.filter(
+            Prescription.status.in_(['pending', 'confirmed'])
+        ).order_by(Prescription.date_prescribed.desc()).limit(10).all()
         
-        # Get medications with low stock
-        low_stock = Medication.query.filter(Medication.stock_quantity < Medication.minimum_stock_level).all()
+        # Get medications with low stock, flagged when their stock changes
+        low_stock = Medication.query.filter(Medication.is_low_stock.is_(True)).order_by(Medication.name).all()
         
         return render_template('dashboard.html', pending_prescriptions=pending_prescriptions, low_stock=low_stock)
     
@@ -214,72 +230,10 @@ def process_scan():
             temp_file.write(image_bytes)
             temp_file_path = temp_file.name
         
-        # Extract text from the image using enhanced OCR with AI capabilities
-        extracted_text = extract_text_from_image(temp_file_path)
-        
-        # Extract structured medication information using AI
-        from utils.ocr import extract_medications_from_text
-        detected_medications = extract_medications_from_text(extracted_text)
-        
-        # Map the detected medications to database entries if possible
-        medications = []
-        
-        if detected_medications:
-            # First try to match detected medications with our database
-            for med_info in detected_medications:
-                # Try to find the medication in the database
-                med_matches = Medication.query.filter(
-                    Medication.name.ilike(f'%{med_info["name"]}%') |
-                    Medication.generic_name.ilike(f'%{med_info["name"]}%')
-                ).all()
-                
-                if med_matches:
-                    # Use database entries
-                    for med in med_matches:
-                        medications.append({
-                            'id': med.id,
-                            'name': med.name,
-                            'strength': med.strength,
-                            'dosage_form': med.dosage_form,
-                            'dosage': med_info.get('dosage', ''),
-                            'frequency': med_info.get('frequency', ''),
-                            'instructions': med_info.get('instructions', '')
-                        })
-                else:
-                    # Medication not found in database, create a temporary entry
-                    # In a real app, you might want to add new medications to the database
-                    # or notify pharmacy staff about unknown medications
-                    medications.append({
-                        'id': f'temp_{len(medications)}',  # Temporary ID
-                        'name': med_info.get('name', 'Unknown Medication'),
-                        'strength': med_info.get('dosage', ''),
-                        'dosage_form': '',
-                        'dosage': med_info.get('dosage', ''),
-                        'frequency': med_info.get('frequency', ''),
-                        'instructions': med_info.get('instructions', '')
-                    })
-        
-        # If AI extraction didn't work, fall back to the simple method
-        if not medications:
-            logging.info("AI medication extraction didn't find medications, using fallback method")
-            for line in extracted_text.split('\n'):
-                line = line.strip()
-                if line and ('medication:' in line.lower() or 'drug:' in line.lower()):
-                    parts = line.split(':')
-                    if len(parts) > 1:
-                        med_name = parts[1].strip()
-                        med_matches = Medication.query.filter(
-                            Medication.name.ilike(f'%{med_name}%')
-                        ).all()
-                        
-                        if med_matches:
-                            for med in med_matches:
-                                medications.append({
-                                    'id': med.id,
-                                    'name': med.name,
-                                    'strength': med.strength,
-                                    'dosage_form': med.dosage_form
-                                })
+        # Run OCR, medication extraction and catalog matching
+        scan_result = run_scan_pipeline(temp_file_path)
+        extracted_text = scan_result['extracted_text']
+        medications = scan_result['medications']
         
         # Clean up the temporary file
         os.unlink(temp_file_path)
@@ -300,6 +254,200 @@ def process_scan():
         logging.error(f"Error processing scan: {str(e)}")
         return jsonify({'error': f'Error processing image: {str(e)}'}), 500
 
+@app.route('/health/ocr')
+def ocr_health():
+    from utils.ocr_engine import get_ocr_pool
+    return jsonify(get_ocr_pool().health_check())
+
+def read_scan_upload(max_bytes, chunk_size=64 * 1024):
+    """
+    Read an uploaded scan into memory, enforcing a size cap as it streams in
+    
+    The image can be a multipart file field named 'image' or the raw request
+    body sent with an image/* content type.
+    
+    Args:
+        max_bytes (int): Largest upload accepted
+        chunk_size (int): Bytes read from the stream at a time
+        
+    Returns:
+        bytearray: The encoded image, or None if the request has no image
+        
+    Raises:
+        RequestEntityTooLarge: If the upload is larger than max_bytes
+    """
+    # Lets werkzeug reject oversized bodies before parsing them
+    request.max_content_length = max_bytes
+    
+    if request.mimetype.startswith('image/'):
+        stream = request.stream
+    elif 'image' in request.files:
+        stream = request.files['image'].stream
+    else:
+        return None
+    
+    return read_capped(stream, max_bytes, chunk_size)
+
+def read_capped(stream, max_bytes, chunk_size=64 * 1024):
+    """
+    Read a stream into memory, giving up as soon as it passes max_bytes
+    
+    Args:
+        stream: File-like object to read
+        max_bytes (int): Largest size accepted
+        chunk_size (int): Bytes read at a time
+        
+    Returns:
+        bytearray: The stream's contents
+        
+    Raises:
+        RequestEntityTooLarge: If the stream is larger than max_bytes
+    """
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer.extend(chunk)
+        if len(buffer) > max_bytes:
+            raise RequestEntityTooLarge()
+    return buffer
+
+# Asynchronous scan jobs: submit an image, poll its status, fetch the result
+@app.route('/api/scan-jobs', methods=['POST'])
+def submit_scan():
+    max_bytes = app.config.get('SCAN_MAX_UPLOAD_BYTES', 10 * 1024 * 1024)
+    try:
+        image_bytes = read_scan_upload(max_bytes)
+        
+        # Older clients send the image as a base64 data URL form field
+        if image_bytes is None and 'image_data' in request.form:
+            image_data = request.form['image_data'].split(',')[1]
+            image_bytes = base64.b64decode(image_data)
+    except RequestEntityTooLarge:
+        return jsonify({'error': f'Image too large (maximum {max_bytes} bytes)'}), 413
+    except (IndexError, ValueError):
+        return jsonify({'error': 'Invalid image data'}), 400
+    
+    if not image_bytes:
+        return jsonify({'error': 'No image data provided'}), 400
+    
+    # Stored scans are only reused for the user who uploaded them
+    job = submit_scan_job(image_bytes, current_user.id if current_user.is_authenticated else None)
+    
+    response = jsonify({
+        **job.to_dict(),
+        'status_url': url_for('scan_job_status', job_id=job.id),
+        'result_url': url_for('scan_job_result', job_id=job.id),
+        'events_url': url_for('scan_job_events', job_id=job.id)
+    })
+    response.headers['Location'] = url_for('scan_job_status', job_id=job.id)
+    return response, 202
+
+@app.route('/api/scan-batch', methods=['POST'])
+def submit_batch_scan():
+    max_bytes = app.config.get('SCAN_MAX_UPLOAD_BYTES', 10 * 1024 * 1024)
+    max_pages = app.config.get('SCAN_BATCH_MAX_PAGES', 20)
+    
+    # Pages are only counted here, the job splits and rasterizes them
+    files = []
+    page_count = 0
+    try:
+        # The whole batch shares the single upload cap
+        request.max_content_length = max_bytes
+        uploads = [f for f in request.files.getlist('images') if f and f.filename]
+        if not uploads:
+            return jsonify({'error': 'No images provided'}), 400
+        
+        received = 0
+        for upload in uploads:
+            filename = secure_filename(upload.filename)
+            data = read_capped(upload.stream, max_bytes - received)
+            received += len(data)
+            
+            # Multi-page TIFF and PDF uploads contribute one image per page
+            page_count += count_scan_pages(filename, data)
+            if page_count > max_pages:
+                return jsonify({'error': f'Too many pages (maximum {max_pages})'}), 400
+            files.append((filename, data))
+    except RequestEntityTooLarge:
+        return jsonify({'error': f'Images too large (maximum {max_bytes} bytes in total)'}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    job = submit_batch_scan_job(files)
+    
+    response = jsonify({
+        **job.to_dict(),
+        'pages': page_count,
+        'status_url': url_for('scan_job_status', job_id=job.id),
+        'result_url': url_for('scan_job_result', job_id=job.id),
+        'events_url': url_for('scan_job_events', job_id=job.id)
+    })
+    response.headers['Location'] = url_for('scan_job_status', job_id=job.id)
+    return response, 202
+
+@app.route('/api/scan-jobs/<job_id>')
+def scan_job_status(job_id):
+    job = get_scan_job(job_id)
+    if not job:
+        return jsonify({'error': 'Scan job not found'}), 404
+    
+    return jsonify(job.to_dict())
+
+@app.route('/api/scan-jobs/<job_id>/result')
+def scan_job_result(job_id):
+    job = get_scan_job(job_id)
+    if not job:
+        return jsonify({'error': 'Scan job not found'}), 404
+    
+    if job.status == JOB_FAILED:
+        return jsonify({'error': job.error}), 500
+    
+    if job.status != JOB_DONE:
+        # Not ready yet, the client should keep polling
+        return jsonify(job.to_dict()), 202
+    
+    # Save the scan data to session for later processing
+    session['scan_data'] = job.result
+    
+    return jsonify({
+        'success': True,
+        **job.result
+    })
+
+@app.route('/api/scan-jobs/<job_id>/events')
+def scan_job_events(job_id):
+    job = get_scan_job(job_id)
+    if not job:
+        return jsonify({'error': 'Scan job not found'}), 404
+    
+    # A reconnecting EventSource resumes after the last event it received
+    try:
+        start = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        start = 0
+    keepalive = app.config.get('SCAN_EVENTS_KEEPALIVE', 15)
+    
+    def stream():
+        index = start
+        while True:
+            events = job.events_since(index, timeout=keepalive)
+            if not events:
+                # Comment line so proxies don't close an idle connection
+                yield ': keep-alive\n\n'
+                continue
+            for event in events:
+                yield f"id: {index}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+                index += 1
+                if event['event'] in (JOB_DONE, JOB_FAILED):
+                    return
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/confirm-prescription', methods=['POST'])
 def confirm_prescription():
     if 'scan_data' not in session:
@@ -362,6 +510,12 @@ def confirm_prescription():
         if current_user.has_role('doctor'):
             new_prescription.doctor_id = current_user.id
         
+        # Link the stored scan image, if the scan was kept
+        scan_id = session['scan_data'].get('scan_id')
+        scan_record = db.session.get(ScanRecord, scan_id) if scan_id else None
+        if scan_record:
+            new_prescription.scan_image_path = scan_record.image_path
+        
         db.session.add(new_prescription)
         db.session.flush()  # Flush to get the prescription ID
         
@@ -424,6 +578,105 @@ def view_prescription(prescription_id):
     
     return render_template('interactions.html', prescription=prescription, reports=reports)
 
+@app.route('/prescription/<int:prescription_id>/scan-thumbnail')
+@login_required
+def prescription_scan_thumbnail(prescription_id):
+    prescription = Prescription.query.get_or_404(prescription_id)
+    
+    if not (current_user.id == prescription.user_id or 
+            current_user.has_role('doctor') or 
+            current_user.has_role('pharmacist')):
+        abort(403)
+    
+    if not prescription.scan_image_path:
+        abort(404)
+    
+    from utils.scan_store import get_scan_thumbnail
+    thumbnail = get_scan_thumbnail(prescription.scan_image_path)
+    if thumbnail is None:
+        abort(404)
+    
+    # Stored scans never change, so browsers can keep the thumbnail
+    return send_file(thumbnail, mimetype='image/jpeg', max_age=30 * 24 * 3600)
+
+# Prescription fill workflow: confirm reserves stock, fill dispenses it, cancel releases it
+@app.route('/prescription/<int:prescription_id>/confirm', methods=['POST'])
+@login_required
+def confirm_prescription_fill(prescription_id):
+    if not current_user.has_role('pharmacist'):
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    prescription = Prescription.query.get_or_404(prescription_id)
+    result = reserve_prescription(prescription)
+    if result['success']:
+        flash('Prescription confirmed and stock reserved', 'success')
+    else:
+        flash(f"Could not confirm prescription: {result['error']}", 'danger')
+    
+    return redirect(url_for('view_prescription', prescription_id=prescription_id))
+
+@app.route('/prescription/<int:prescription_id>/fill', methods=['POST'])
+@login_required
+def fill_prescription(prescription_id):
+    if not current_user.has_role('pharmacist'):
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    prescription = Prescription.query.get_or_404(prescription_id)
+    result = fill_prescriptions([prescription], current_user.id)
+    if result['filled']:
+        flash('Prescription filled', 'success')
+    else:
+        error = result.get('error') or result['failed'][0]['error']
+        flash(f'Could not fill prescription: {error}', 'danger')
+    
+    return redirect(url_for('view_prescription', prescription_id=prescription_id))
+
+@app.route('/prescription/<int:prescription_id>/cancel', methods=['POST'])
+@login_required
+def cancel_prescription_route(prescription_id):
+    if not (current_user.has_role('pharmacist') or current_user.has_role('doctor')):
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    prescription = Prescription.query.get_or_404(prescription_id)
+    result = cancel_prescription(prescription)
+    if result['success']:
+        flash('Prescription cancelled', 'success')
+    else:
+        flash(f"Could not cancel prescription: {result['error']}", 'danger')
+    
+    return redirect(url_for('view_prescription', prescription_id=prescription_id))
+
+@app.route('/fill-prescriptions', methods=['POST'])
+@login_required
+def fill_prescriptions_route():
+    if not current_user.has_role('pharmacist'):
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    prescription_ids = request.form.getlist('prescription_id', type=int)
+    if not prescription_ids:
+        flash('No prescriptions selected', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    # Serve the oldest prescriptions first when stock runs short
+    prescriptions = Prescription.query.filter(
+        Prescription.id.in_(prescription_ids)
+    ).order_by(Prescription.date_prescribed, Prescription.id).all()
+    result = fill_prescriptions(prescriptions, current_user.id)
+    
+    if 'error' in result:
+        flash(f"Error filling prescriptions: {result['error']}", 'danger')
+    else:
+        if result['filled']:
+            flash(f"Filled {len(result['filled'])} prescriptions", 'success')
+        for failure in result['failed']:
+            flash(f"Prescription #{failure['prescription_id']} not filled: {failure['error']}", 'warning')
+    
+    return redirect(url_for('dashboard'))
+
 # Drug Interaction routes
 @app.route('/interactions')
 def interactions():
@@ -525,29 +778,25 @@ def generate_interaction_report(prescription_id):
     db.session.add(report)
     db.session.flush()
     
-    # Check for drug-drug interactions
+    # Check for drug-drug interactions, including medications of the patient's
+    # other prescriptions that are taken at the same time
     interactions_found = False
-    for i, med1 in enumerate(medications):
-        for j, med2 in enumerate(medications[i+1:], i+1):
-            # Query for interactions between these medications
-            interaction = DrugInteraction.query.filter(
-                ((DrugInteraction.drug1_id == med1.id) & (DrugInteraction.drug2_id == med2.id)) |
-                ((DrugInteraction.drug1_id == med2.id) & (DrugInteraction.drug2_id == med1.id))
-            ).first()
-            
-            if interaction:
-                interactions_found = True
-                # Record the interaction
-                detail = InteractionDetail(
-                    report_id=report.id,
-                    drug1_id=med1.id,
-                    drug2_id=med2.id,
-                    interaction_type='drug-drug',
-                    severity=interaction.severity,
-                    description=interaction.description,
-                    recommendation="Consult with healthcare provider before taking these medications together."
-                )
-                db.session.add(detail)
+    for found in screen_prescription_interactions(prescription):
+        interactions_found = True
+        description = found['description']
+        if found['other_prescription_id']:
+            description += f" ({found['drug2_name']} is also taken under prescription #{found['other_prescription_id']})"
+        # Record the interaction
+        detail = InteractionDetail(
+            report_id=report.id,
+            drug1_id=found['drug1_id'],
+            drug2_id=found['drug2_id'],
+            interaction_type='drug-drug',
+            severity=found['severity'],
+            description=description,
+            recommendation="Consult with healthcare provider before taking these medications together."
+        )
+        db.session.add(detail)
     
     # Check for patient allergies if patient data is available
     patient = User.query.get(prescription.user_id)
@@ -571,31 +820,19 @@ def generate_interaction_report(prescription_id):
     
     # Check for dosage issues
     dosage_issues = False
-    for pm in prescription.medications:
-        # This is a simplified check - in a real app, you'd have more complex logic
-        try:
-            med = pm.medication
-            dosage_ok = True
-            
-            # If we have patient data, do more specific checks
-            if patient and patient.weight and patient.date_of_birth:
-                # Example of a dosage check
-                if 'mg' in pm.dosage and int(pm.dosage.split('mg')[0].strip()) > 1000:
-                    dosage_ok = False
-            
-            if not dosage_ok:
-                dosage_issues = True
-                detail = InteractionDetail(
-                    report_id=report.id,
-                    drug1_id=med.id,
-                    interaction_type='dosage',
-                    severity='moderate',
-                    description=f"Dosage of {pm.dosage} may be inappropriate",
-                    recommendation="Review medication dosage before administration."
-                )
-                db.session.add(detail)
-        except Exception as e:
-            logging.error(f"Error checking dosage: {str(e)}")
+    dosage_results = verify_prescription_dosages([prescription])[prescription.id]
+    for pm, result in zip(prescription.medications, dosage_results):
+        if not result['is_appropriate']:
+            dosage_issues = True
+            detail = InteractionDetail(
+                report_id=report.id,
+                drug1_id=pm.medication_id,
+                interaction_type='dosage',
+                severity='moderate',
+                description=f"Dosage of {pm.dosage} may be inappropriate: " + "; ".join(result['warnings']),
+                recommendation=" ".join(result['recommendations']) or "Review medication dosage before administration."
+            )
+            db.session.add(detail)
     
     # Update report summary
     if interactions_found or dosage_issues:
@@ -660,6 +897,66 @@ def verify_dosage_route():
         logging.error(f"Error verifying dosage: {str(e)}")
         return jsonify({'error': f'Error verifying dosage: {str(e)}'}), 500
 
+@app.route('/api/verify-dosages', methods=['POST'])
+@login_required
+def verify_dosages_api():
+    """Verify many dosages in one request
+    
+    The JSON body either has 'lines' (each with medication_id, dosage and
+    optionally frequency) for one patient, given by 'patient_id' or by
+    'patient_weight' and 'patient_age', or 'prescription_ids' to check
+    stored prescriptions against their own patients.
+    """
+    if not (current_user.has_role('doctor') or current_user.has_role('pharmacist')):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    lines = data.get('lines')
+    prescription_ids = data.get('prescription_ids')
+    
+    if not lines and not prescription_ids:
+        return jsonify({'error': 'Missing required parameters'}), 400
+    if lines and not (isinstance(lines, list) and all(isinstance(line, dict) for line in lines)):
+        return jsonify({'error': 'lines must be a list of objects'}), 400
+    if prescription_ids and not isinstance(prescription_ids, list):
+        return jsonify({'error': 'prescription_ids must be a list'}), 400
+    
+    max_lines = app.config['DOSAGE_BATCH_MAX_LINES']
+    if len(lines or []) > max_lines or len(prescription_ids or []) > max_lines:
+        return jsonify({'error': f'At most {max_lines} lines or prescriptions per request'}), 400
+    
+    try:
+        if prescription_ids:
+            prescriptions = Prescription.query.filter(Prescription.id.in_(prescription_ids)).all()
+            results = verify_prescription_dosages(prescriptions)
+            missing = sorted(set(prescription_ids) - set(results))
+            return jsonify({
+                'prescriptions': [{'prescription_id': prescription_id, 'results': result}
+                                  for prescription_id, result in results.items()],
+                'missing': missing
+            })
+        
+        patient_id = data.get('patient_id')
+        if patient_id:
+            patient = User.query.get(patient_id)
+            if not patient:
+                return jsonify({'error': 'Patient not found'}), 404
+            weight, age = patient_dosing_context(patient)
+            # Doses of the same drugs the patient already takes count towards daily maxima
+            daily_totals = patient_daily_totals(active_daily_totals([patient.id]), patient.id)
+        else:
+            weight = float(data['patient_weight']) if data.get('patient_weight') else None
+            age = int(data['patient_age']) if data.get('patient_age') else None
+            daily_totals = None
+        
+        return jsonify({'results': verify_dosage_lines(lines, weight, age, daily_totals=daily_totals)})
+    
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid parameters: {str(e)}'}), 400
+    except Exception as e:
+        logging.error(f"Error verifying dosages: {str(e)}")
+        return jsonify({'error': f'Error verifying dosages: {str(e)}'}), 500
+
 # Inventory tracking routes
 @app.route('/inventory')
 @login_required
@@ -676,6 +973,35 @@ def inventory():
     
     return render_template('inventory.html', medications=medications, logs=logs)
 
+@app.route('/inventory/usage')
+@login_required
+def inventory_usage():
+    """Daily receipts, dispensing and balances, from the inventory rollups"""
+    if not current_user.has_role('pharmacist'):
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    days = max(1, min(request.args.get('days', 30, type=int), 366))
+    medication_id = request.args.get('medication_id', type=int)
+    end = datetime.utcnow().date()
+    start = end - timedelta(days=days - 1)
+    usage = get_inventory_usage(start, end, medication_id)
+    
+    if request.args.get('format') == 'csv':
+        output = StringIO()
+        write_usage_csv(usage, output)
+        return Response(output.getvalue(), mimetype='text/csv', headers={
+            'Content-Disposition': f'attachment; filename=inventory_usage_{start}_{end}.csv'
+        })
+    
+    totals = {
+        field: sum(row[field] for row in usage)
+        for field in ('receipts', 'dispensed', 'adjustments')
+    }
+    medications = Medication.query.order_by(Medication.name).all()
+    return render_template('inventory_usage.html', usage=usage, totals=totals, medications=medications,
+                           medication_id=medication_id, days=days, start=start, end=end)
+
 @app.route('/update-inventory', methods=['POST'])
 @login_required
 def update_inventory_route():
@@ -701,14 +1027,45 @@ def update_inventory_route():
         quantity = int(quantity_change)
         
         # Update inventory
-        update_inventory(medication.id, quantity, reason, current_user.id)
-        
-        flash('Inventory updated successfully', 'success')
+        if update_inventory(medication.id, quantity, reason, current_user.id):
+            flash('Inventory updated successfully', 'success')
+        elif quantity < 0:
+            flash(f'Inventory not updated: not enough {medication.name} in stock for this change', 'danger')
+        else:
+            flash('Inventory not updated, please try again', 'danger')
     except Exception as e:
         flash(f'Error updating inventory: {str(e)}', 'danger')
     
     return redirect(url_for('inventory'))
 
+@app.route('/api/inventory/adjustments', methods=['POST'])
+@login_required
+def inventory_adjustments_api():
+    """Apply many stock changes, such as a wholesaler delivery, at once
+    
+    The JSON body has 'adjustments', each with medication_id,
+    quantity_change and reason. Lines that can't be applied are listed in
+    'failed' without stopping the others.
+    """
+    if not current_user.has_role('pharmacist'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    adjustments = data.get('adjustments')
+    
+    if not adjustments or not isinstance(adjustments, list):
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    max_lines = app.config['INVENTORY_BATCH_MAX_LINES']
+    if len(adjustments) > max_lines:
+        return jsonify({'error': f'At most {max_lines} adjustments per request'}), 400
+    
+    result = apply_inventory_adjustments(adjustments, current_user.id)
+    if 'error' in result:
+        return jsonify({'error': f"Error updating inventory: {result['error']}"}), 500
+    
+    return jsonify(result)
+
 # Reporting routes
 @app.route('/reports')
 @login_required
@@ -753,10 +1110,74 @@ def page_not_found(e):
 def server_error(e):
     return render_template('500.html'), 500
 
+# Create or upgrade the schema; run once per deploy, not in every worker
+@app.cli.command("bootstrap-db")
+def bootstrap_db_command():
+    """Create or upgrade the database schema and default roles."""
+    from utils.bootstrap import bootstrap_database
+    result = bootstrap_database()
+    
+    if result['from_version'] == result['to_version']:
+        print(f"Database schema already at version {result['to_version']}.")
+    else:
+        print(f"Database schema upgraded from version {result['from_version']} to {result['to_version']}.")
+    if result['roles_created']:
+        print(f"Created roles: {', '.join(result['roles_created'])}.")
+
+@app.cli.command("audit-dosages")
+@click.option('--output', default='dosage_audit.csv', show_default=True,
+              help='CSV file the flagged prescription lines are written to.')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Rows fetched from the database at a time.')
+def audit_dosages_command(output, batch_size):
+    """Check the dosage of every prescribed medication and write out the flagged ones."""
+    from utils.dosage_audit import audit_dosages
+    summary = audit_dosages(output, batch_size)
+    
+    print(f"Audited {summary['rows']} prescription lines: {summary['flagged']} flagged, "
+          f"{summary['inappropriate']} inappropriate. Written to {output}.")
+
+@app.cli.command("rollup-inventory")
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Recompute the daily rollups from this day on.')
+@click.option('--full', is_flag=True, help='Recompute every day from the whole inventory log.')
+def rollup_inventory_command(since, full):
+    """Bring the daily inventory rollups up to date with the inventory log."""
+    from utils.inventory_rollups import rebuild_inventory_rollups, catch_up_inventory_rollups
+    if full:
+        rows = rebuild_inventory_rollups()
+    elif since:
+        rows = rebuild_inventory_rollups(since.date())
+    else:
+        rows = catch_up_inventory_rollups()
+    
+    print(f"Wrote {rows} daily inventory rollups.")
+
+@app.cli.command("forecast-inventory")
+def forecast_inventory_command():
+    """Forecast medication demand and update the suggested minimum stock levels."""
+    from utils.inventory_forecast import forecast_inventory
+    summary = forecast_inventory()
+    
+    print(f"Forecast demand for {summary['medications']} medications, "
+          f"{summary['suggested']} given a suggested minimum stock level.")
+
+@app.cli.command("prune-scans")
+@click.option('--days', type=float, help='Keep stored scans this many days (SCAN_RETENTION_DAYS by default).')
+def prune_scans_command(days):
+    """Delete stored scans past their retention period and images nothing refers to."""
+    from utils.scan_store import prune_scan_store
+    summary = prune_scan_store(days)
+    
+    print(f"Deleted {summary['records']} stored scans and {summary['files']} files.")
+
 # Initialize database with sample data
 @app.cli.command("init-db")
 def init_db_command():
     """Initialize the database with sample data."""
+    from utils.bootstrap import bootstrap_database
+    bootstrap_database()
+    
     # Add sample medications
     medications = [
         {
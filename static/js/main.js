@@ -127,20 +127,45 @@ function showAlert(message, type = 'info', containerId = 'alert-container') {
 
 /**
  * Setup the dosage verification form
+ *
+ * Every medication line of the form is checked with a single request to the
+ * batch verification API.
  */
 function setupDosageVerificationForm() {
     const dosageForm = document.getElementById('dosage-verification-form');
     if (!dosageForm) return;
     
+    const linesContainer = document.getElementById('dosage-lines');
+    const addLineButton = document.getElementById('add-dosage-line');
+    
+    if (addLineButton && linesContainer) {
+        addLineButton.addEventListener('click', function() {
+            const template = linesContainer.querySelector('.dosage-line');
+            const line = template.cloneNode(true);
+            line.querySelectorAll('input').forEach(input => { input.value = ''; });
+            line.querySelector('select').selectedIndex = 0;
+            linesContainer.appendChild(line);
+        });
+    }
+    
     dosageForm.addEventListener('submit', function(e) {
         e.preventDefault();
         
-        const formData = new FormData(dosageForm);
         const resultContainer = document.getElementById('dosage-results');
+        const lines = Array.from(dosageForm.querySelectorAll('.dosage-line')).map(line => ({
+            medication_id: parseInt(line.querySelector('[name="medication_id"]').value, 10),
+            dosage: line.querySelector('[name="dosage"]').value,
+            frequency: line.querySelector('[name="frequency"]').value
+        }));
         
-        fetch('/verify-dosage', {
+        fetch('/api/verify-dosages', {
             method: 'POST',
-            body: formData
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                lines: lines,
+                patient_weight: dosageForm.querySelector('[name="patient_weight"]').value,
+                patient_age: dosageForm.querySelector('[name="patient_age"]').value
+            })
         })
         .then(response => response.json())
         .then(data => {
@@ -154,29 +179,33 @@ function setupDosageVerificationForm() {
             resultHTML += '<div class="card-header bg-primary text-white">Dosage Verification Results</div>';
             resultHTML += '<div class="card-body">';
             
-            if (data.is_appropriate) {
-                resultHTML += '<div class="alert alert-success">✓ Dosage appears to be appropriate</div>';
-            } else {
-                resultHTML += '<div class="alert alert-danger">⚠ Dosage may not be appropriate</div>';
-            }
-            
-            if (data.warnings && data.warnings.length > 0) {
-                resultHTML += '<h5 class="mt-3">Warnings:</h5>';
-                resultHTML += '<ul class="list-group">';
-                data.warnings.forEach(warning => {
-                    resultHTML += `<li class="list-group-item list-group-item-warning">${warning}</li>`;
-                });
-                resultHTML += '</ul>';
-            }
-            
-            if (data.recommendations && data.recommendations.length > 0) {
-                resultHTML += '<h5 class="mt-3">Recommendations:</h5>';
-                resultHTML += '<ul class="list-group">';
-                data.recommendations.forEach(rec => {
-                    resultHTML += `<li class="list-group-item list-group-item-info">${rec}</li>`;
-                });
-                resultHTML += '</ul>';
-            }
+            data.results.forEach(result => {
+                resultHTML += `<h5 class="mt-3">${result.medication_name || 'Unknown medication'} ${result.dosage || ''}</h5>`;
+                
+                if (result.is_appropriate) {
+                    resultHTML += '<div class="alert alert-success">✓ Dosage appears to be appropriate</div>';
+                } else {
+                    resultHTML += '<div class="alert alert-danger">⚠ Dosage may not be appropriate</div>';
+                }
+                
+                if (result.warnings && result.warnings.length > 0) {
+                    resultHTML += '<h6>Warnings:</h6>';
+                    resultHTML += '<ul class="list-group mb-2">';
+                    result.warnings.forEach(warning => {
+                        resultHTML += `<li class="list-group-item list-group-item-warning">${warning}</li>`;
+                    });
+                    resultHTML += '</ul>';
+                }
+                
+                if (result.recommendations && result.recommendations.length > 0) {
+                    resultHTML += '<h6>Recommendations:</h6>';
+                    resultHTML += '<ul class="list-group mb-2">';
+                    result.recommendations.forEach(rec => {
+                        resultHTML += `<li class="list-group-item list-group-item-info">${rec}</li>`;
+                    });
+                    resultHTML += '</ul>';
+                }
+            });
             
             resultHTML += '</div></div>';
             
@@ -3,6 +3,24 @@
 let scanner = null;
 let videoStream = null;
 
+// How often to ask the server whether a scan job has finished (ms)
+const SCAN_POLL_INTERVAL = 1000;
+
+// Captured frames are scaled down to at most this many pixels on the long side
+const SCAN_MAX_DIMENSION = 1600;
+const SCAN_JPEG_QUALITY = 0.85;
+
+// Scan pipeline stages in order, with the message shown once each is reached
+const SCAN_STAGES = [
+    ['queued', 'Waiting for the scanner...'],
+    ['decoded', 'Image received, preparing it for reading...'],
+    ['preprocessed', 'Reading the prescription text...'],
+    ['ocr_done', 'Text read, looking for medications...'],
+    ['extraction_done', 'Medications found, matching them with our database...'],
+    ['resolved', 'Medications matched'],
+    ['done', 'Done']
+];
+
 /**
  * Initialize the prescription scanner
  */
@@ -105,43 +123,156 @@ function initScanner() {
     
     // Capture button click
     captureButton.addEventListener('click', () => {
-        // Create a canvas and draw the video frame
+        // Draw the video frame, scaled down so the upload stays small
+        const scale = Math.min(1, SCAN_MAX_DIMENSION / Math.max(videoElement.videoWidth, videoElement.videoHeight));
         const canvas = document.createElement('canvas');
-        canvas.width = videoElement.videoWidth;
-        canvas.height = videoElement.videoHeight;
+        canvas.width = Math.round(videoElement.videoWidth * scale);
+        canvas.height = Math.round(videoElement.videoHeight * scale);
         
         const context = canvas.getContext('2d');
         context.drawImage(videoElement, 0, 0, canvas.width, canvas.height);
         
-        // Get the image as base64 data URL
-        const imageDataUrl = canvas.toDataURL('image/jpeg');
+        // Get the image as a compressed JPEG blob
+        canvas.toBlob(imageBlob => {
+            if (!imageBlob) {
+                showAlert('Could not capture the image', 'danger');
+                return;
+            }
+            
+            // Show preview
+            scanPreview.src = URL.createObjectURL(imageBlob);
+            scanPreview.onload = () => URL.revokeObjectURL(scanPreview.src);
+            scanPreview.classList.remove('d-none');
+            
+            // Show loading indicator
+            loadingIndicator.classList.remove('d-none');
+            
+            // Send the image for processing
+            processScan(imageBlob);
+        }, 'image/jpeg', SCAN_JPEG_QUALITY);
+    });
+    
+    /**
+     * Show how far a scan job has got, with any partial results
+     * @param {Object} update - Stage event data from the server
+     */
+    function showScanProgress(update) {
+        const index = SCAN_STAGES.findIndex(([stage]) => stage === update.stage);
+        const progressText = document.getElementById('scan-progress-text');
+        const progressBar = document.getElementById('scan-progress-bar');
         
-        // Show preview
-        scanPreview.src = imageDataUrl;
-        scanPreview.classList.remove('d-none');
+        if (index >= 0) {
+            if (progressText) {
+                progressText.textContent = SCAN_STAGES[index][1];
+            }
+            if (progressBar) {
+                progressBar.style.width = `${Math.round(100 * index / (SCAN_STAGES.length - 1))}%`;
+            }
+        }
         
-        // Show loading indicator
-        loadingIndicator.classList.remove('d-none');
+        // Show results as soon as they are known, before the slower stages finish
+        if (update.extracted_text && scanResult) {
+            scanResult.classList.remove('d-none');
+            scanResult.textContent = update.extracted_text;
+        }
+        if (update.medications && update.medications.length > 0 && medListContainer) {
+            let listHtml = '<div class="card mb-4"><div class="card-header">';
+            listHtml += '<h5 class="mb-0"><i class="fas fa-spinner fa-spin me-2"></i>Medications found so far</h5></div>';
+            listHtml += '<ul class="list-group list-group-flush">';
+            update.medications.forEach(med => {
+                listHtml += `<li class="list-group-item"><strong>${med.name}</strong> ${med.dosage || ''} ${med.frequency || ''}</li>`;
+            });
+            listHtml += '</ul></div>';
+            medListContainer.innerHTML = listHtml;
+            medListContainer.classList.remove('d-none');
+        }
+    }
+    
+    /**
+     * Follow a scan job's progress stream until it has finished, then fetch
+     * its result. Falls back to polling when server-sent events aren't available.
+     * @param {Object} job - Scan job returned when the image was submitted
+     * @returns {Promise<Object>} The scan result or an error object
+     */
+    function watchScanJob(job) {
+        if (typeof EventSource === 'undefined' || !job.events_url) {
+            return pollScanJob(job.status_url, job.result_url);
+        }
         
-        // Send the image for processing
-        processScan(imageDataUrl);
-    });
+        return new Promise((resolve, reject) => {
+            const source = new EventSource(job.events_url);
+            
+            const fetchResult = () => {
+                source.close();
+                fetch(job.result_url)
+                .then(response => response.json())
+                .then(resolve)
+                .catch(reject);
+            };
+            
+            source.addEventListener('stage', event => showScanProgress(JSON.parse(event.data)));
+            source.addEventListener('done', fetchResult);
+            source.addEventListener('failed', fetchResult);
+            source.onerror = () => {
+                // The browser reconnects by itself unless the stream was refused
+                if (source.readyState === EventSource.CLOSED) {
+                    pollScanJob(job.status_url, job.result_url).then(resolve).catch(reject);
+                }
+            };
+        });
+    }
+    
+    /**
+     * Poll a scan job until it has finished, then fetch its result
+     * @param {string} statusUrl - URL reporting the job status
+     * @param {string} resultUrl - URL returning the scan result
+     * @returns {Promise<Object>} The scan result or an error object
+     */
+    function pollScanJob(statusUrl, resultUrl) {
+        return new Promise((resolve, reject) => {
+            const check = () => {
+                fetch(statusUrl)
+                .then(response => response.json())
+                .then(job => {
+                    if (job.error && job.status !== 'failed') {
+                        resolve(job);
+                    } else if (job.status === 'done' || job.status === 'failed') {
+                        fetch(resultUrl)
+                        .then(response => response.json())
+                        .then(resolve)
+                        .catch(reject);
+                    } else {
+                        setTimeout(check, SCAN_POLL_INTERVAL);
+                    }
+                })
+                .catch(reject);
+            };
+            check();
+        });
+    }
     
     /**
      * Process the scanned prescription image
-     * @param {string} imageDataUrl - Base64 encoded image data
+     * @param {Blob} imageBlob - JPEG encoded image
      */
-    function processScan(imageDataUrl) {
-        // Create form data for the image
+    function processScan(imageBlob) {
+        // Upload the image as a binary file, not a base64 string
         const formData = new FormData();
-        formData.append('image_data', imageDataUrl);
+        formData.append('image', imageBlob, 'scan.jpg');
         
-        // Send to the server for OCR processing
-        fetch('/process-scan', {
+        // Submit a scan job, then poll it until the result is ready
+        fetch('/api/scan-jobs', {
             method: 'POST',
             body: formData
         })
         .then(response => response.json())
+        .then(job => {
+            if (job.error) {
+                return job;
+            }
+            showScanProgress(job);
+            return watchScanJob(job);
+        })
         .then(data => {
             // Hide loading indicator
             loadingIndicator.classList.add('d-none');
@@ -197,7 +328,8 @@ function initScanner() {
                         <div class="row">
                             <div class="col-md-6 mb-2">
                                 <label for="duration-${med.id}" class="form-label">Duration</label>
-                                <input type="text" class="form-control" id="duration-${med.id}" name="duration" placeholder="e.g., 7 days">
+                                <input type="text" class="form-control" id="duration-${med.id}" name="duration" 
+                                       value="${med.duration || ''}" placeholder="e.g., 7 days">
                             </div>
                             <div class="col-md-6 mb-2">
                                 <label for="instructions-${med.id}" class="form-label">Instructions</label>
@@ -4,6 +4,8 @@ Test configuration and fixtures for MedScanner application
 import pytest
 import tempfile
 import os
+import sys
+import shutil
 from app import app, db
 from models import User, Medication, DrugInteraction, Role
 from werkzeug.security import generate_password_hash
@@ -19,6 +21,7 @@ def test_app():
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
     app.config['WTF_CSRF_ENABLED'] = False
     app.config['SECRET_KEY'] = 'test-secret-key'
+    app.config['SCAN_STORE_DIR'] = scan_store_dir = tempfile.mkdtemp()
     
     # Set OpenAI API key for testing (will use environment variable)
     if not os.environ.get('OPENAI_API_KEY'):
@@ -32,6 +35,7 @@ def test_app():
     # Clean up
     os.close(db_fd)
     os.unlink(db_path)
+    shutil.rmtree(scan_store_dir, ignore_errors=True)
 
 
 @pytest.fixture
@@ -178,4 +182,52 @@ def sample_prescription_data():
                 'instructions': 'as needed for pain'
             }
         ]
-    }
\ No newline at end of file
+    }
+
+@pytest.fixture
+def db_client(test_db):
+    """Test client for requests against the populated test database.
+
+    Unlike ``test_app`` it does not keep request contexts alive between
+    requests, so it can be torn down cleanly alongside ``test_db``.
+    """
+    return app.test_client()
+
+
+@pytest.fixture
+def login_as(db_client):
+    """Helper to log the ``db_client`` in as one of the test users."""
+    def _login_as(username):
+        user = User.query.filter_by(username=username).first()
+        with db_client.session_transaction() as sess:
+            sess['_user_id'] = str(user.id)
+            sess['_fresh'] = True
+        return user
+    return _login_as
+
+
+@pytest.fixture(autouse=True)
+def reset_ai_circuit_breaker():
+    """Keep AI failures in one test from opening the breaker for the next."""
+    yield
+    ocr = sys.modules.get('utils.ocr')
+    if ocr is not None:
+        ocr.ai_breaker.record_success()
+
+
+@pytest.fixture(autouse=True)
+def reset_scan_backends():
+    """Go back to the default OCR/vision/extraction backends after each test."""
+    yield
+    backends = sys.modules.get('utils.backends')
+    if backends is not None:
+        backends.reset_backends()
+
+
+@pytest.fixture(autouse=True)
+def reset_interval_indexes():
+    """Patient IDs repeat across test databases, so drop cached interval indexes."""
+    yield
+    intervals = sys.modules.get('utils.intervals')
+    if intervals is not None:
+        intervals.invalidate_patient_intervals()
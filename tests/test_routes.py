@@ -6,7 +6,7 @@ import json
 import base64
 from unittest.mock import patch, MagicMock
 from flask import session
-from models import User, Medication, Prescription
+from models import User, Medication, Prescription, PrescriptionMedication
 
 
 class TestPublicRoutes:
@@ -136,6 +136,242 @@ class TestScanRoutes:
         assert 'No image data provided' in data['error']
 
 
+
+class TestScanJobRoutes:
+    """Test cases for the asynchronous scan job API"""
+    
+    @patch('utils.ocr.extract_text_from_image')
+    @patch('utils.ocr.extract_medications_from_text')
+    def test_scan_job_lifecycle(self, mock_extract_meds, mock_extract_text, db_client):
+        """Test submitting a scan job, polling it and fetching the result"""
+        from utils.scan_jobs import get_scan_job
+        
+        mock_extract_text.return_value = "Medication: Ibuprofen 200mg"
+        mock_extract_meds.return_value = [{'name': 'Ibuprofen', 'dosage': '200mg'}]
+        
+        sample_image_data = "data:image/jpeg;base64," + base64.b64encode(b"fake_image_data").decode()
+        response = db_client.post('/api/scan-jobs', data={'image_data': sample_image_data})
+        
+        assert response.status_code == 202
+        job = json.loads(response.data)
+        assert job['job_id']
+        assert response.headers['Location'] == job['status_url']
+        
+        assert get_scan_job(job['job_id']).wait(timeout=5)
+        
+        status = json.loads(db_client.get(job['status_url']).data)
+        assert status['status'] == 'done'
+        assert status['stage'] == 'done'
+        
+        response = db_client.get(job['result_url'])
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['success'] is True
+        assert data['medications'][0]['name'] == 'Ibuprofen'
+        
+        # The result is kept in the session for confirming the prescription
+        with db_client.session_transaction() as sess:
+            assert sess['scan_data']['medications'] == data['medications']
+    
+    @patch('utils.ocr.extract_text_from_image')
+    @patch('utils.ocr.extract_medications_from_text')
+    def test_scan_job_result_keeps_duration(self, mock_extract_meds, mock_extract_text, db_client):
+        """Test the detected course duration reaches the job result for prefilling the form"""
+        from utils.scan_jobs import get_scan_job
+        
+        mock_extract_text.return_value = "Medication: Ibuprofen 200mg twice daily for 7 days"
+        mock_extract_meds.return_value = [{'name': 'Ibuprofen', 'dosage': '200mg', 'duration': '7 days'}]
+        
+        sample_image_data = "data:image/jpeg;base64," + base64.b64encode(b"fake_image_data").decode()
+        job = json.loads(db_client.post('/api/scan-jobs', data={'image_data': sample_image_data}).data)
+        assert get_scan_job(job['job_id']).wait(timeout=5)
+        
+        data = json.loads(db_client.get(job['result_url']).data)
+        assert [(med['name'], med['duration']) for med in data['medications']] == [('Ibuprofen', '7 days')]
+        
+        with db_client.session_transaction() as sess:
+            assert sess['scan_data']['medications'][0]['duration'] == '7 days'
+    
+    def test_scan_job_result_pending(self, db_client):
+        """Test fetching the result of a job that has not finished"""
+        from utils.scan_jobs import ScanJob, scan_jobs
+        
+        job = ScanJob()
+        scan_jobs._jobs[job.id] = job
+        
+        response = db_client.get(f'/api/scan-jobs/{job.id}/result')
+        assert response.status_code == 202
+        assert json.loads(response.data)['status'] == 'queued'
+    
+    def test_scan_job_not_found(self, db_client):
+        """Test polling an unknown scan job"""
+        assert db_client.get('/api/scan-jobs/missing').status_code == 404
+        assert db_client.get('/api/scan-jobs/missing/result').status_code == 404
+    
+    def test_scan_job_events_stream(self, db_client):
+        """Test scan progress is streamed as server-sent events"""
+        from utils.scan_jobs import ScanJob, scan_jobs
+        
+        job = ScanJob()
+        scan_jobs._jobs[job.id] = job
+        job.set_stage('extraction_done', {'medications': [{'name': 'Ibuprofen'}]})
+        job.finish(result={'extracted_text': '', 'medications': []})
+        
+        response = db_client.get(f'/api/scan-jobs/{job.id}/events')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        
+        body = response.get_data(as_text=True)
+        assert 'id: 0\nevent: stage\ndata: {"stage": "extraction_done", "medications": [{"name": "Ibuprofen"}]}' in body
+        assert 'id: 1\nevent: done\n' in body
+        
+        # A reconnecting client only gets what it missed
+        resumed = db_client.get(f'/api/scan-jobs/{job.id}/events', headers={'Last-Event-ID': '0'})
+        assert 'event: stage' not in resumed.get_data(as_text=True)
+        
+        assert db_client.get('/api/scan-jobs/missing/events').status_code == 404
+    
+    def test_submit_scan_missing_image_data(self, db_client):
+        """Test submitting a scan job without image data"""
+        response = db_client.post('/api/scan-jobs', data={})
+        assert response.status_code == 400
+    
+    @patch('utils.ocr.extract_text_from_image')
+    @patch('utils.ocr.extract_medications_from_text')
+    def test_submit_scan_multipart_upload(self, mock_extract_meds, mock_extract_text, db_client):
+        """Test submitting a scan job as a binary multipart file"""
+        import io
+        from utils.scan_jobs import get_scan_job
+        
+        mock_extract_text.return_value = "Medication: Ibuprofen 200mg"
+        mock_extract_meds.return_value = [{'name': 'Ibuprofen', 'dosage': '200mg'}]
+        
+        response = db_client.post('/api/scan-jobs', data={
+            'image': (io.BytesIO(b"fake_image_data"), 'scan.jpg', 'image/jpeg')
+        }, content_type='multipart/form-data')
+        
+        assert response.status_code == 202
+        job = get_scan_job(json.loads(response.data)['job_id'])
+        assert job.wait(timeout=5)
+        assert job.status == 'done'
+        assert job.result['medications'][0]['name'] == 'Ibuprofen'
+    
+    @patch('routes.submit_scan_job')
+    def test_submit_scan_raw_body(self, mock_submit, db_client):
+        """Test submitting a scan job as a raw image request body"""
+        from utils.scan_jobs import ScanJob
+        
+        mock_submit.return_value = ScanJob()
+        response = db_client.post('/api/scan-jobs', data=b"\xff\xd8raw_jpeg",
+                                  content_type='image/jpeg')
+        
+        assert response.status_code == 202
+        assert bytes(mock_submit.call_args[0][0]) == b"\xff\xd8raw_jpeg"
+    
+    def test_submit_scan_too_large(self, db_client):
+        """Test uploads over the size cap are rejected"""
+        import io
+        from app import app
+        
+        with patch.dict(app.config, {'SCAN_MAX_UPLOAD_BYTES': 1024}):
+            raw = db_client.post('/api/scan-jobs', data=b"x" * 2048, content_type='image/jpeg')
+            multipart = db_client.post('/api/scan-jobs', data={
+                'image': (io.BytesIO(b"x" * 2048), 'scan.jpg', 'image/jpeg')
+            }, content_type='multipart/form-data')
+        
+        assert raw.status_code == 413
+        assert multipart.status_code == 413
+        assert 'too large' in json.loads(raw.data)['error']
+    
+    @patch('utils.ocr.extract_text_from_image')
+    @patch('utils.ocr.extract_medications_from_text')
+    def test_batch_scan(self, mock_extract_meds, mock_extract_text, db_client):
+        """Test submitting several pages as one batch scan job"""
+        import io
+        from utils.scan_jobs import get_scan_job
+        
+        mock_extract_text.return_value = "Medication: Warfarin 5mg"
+        mock_extract_meds.return_value = [{'name': 'Warfarin', 'dosage': '5mg'}]
+        
+        response = db_client.post('/api/scan-batch', data={
+            'images': [(io.BytesIO(b'page one'), 'page1.jpg'),
+                       (io.BytesIO(b'page two'), 'page2.jpg')]
+        }, content_type='multipart/form-data')
+        
+        assert response.status_code == 202
+        job = json.loads(response.data)
+        assert job['pages'] == 2
+        assert get_scan_job(job['job_id']).wait(timeout=5)
+        
+        data = json.loads(db_client.get(job['result_url']).data)
+        assert len(data['pages']) == 2
+        assert [med['name'] for med in data['medications']] == ['Warfarin']
+    
+    @patch('routes.submit_batch_scan_job')
+    def test_batch_scan_too_large(self, mock_submit, db_client):
+        """Test a batch over the upload cap is rejected without queueing a job"""
+        import io
+        from app import app
+        
+        with patch.dict(app.config, {'SCAN_MAX_UPLOAD_BYTES': 1024}):
+            response = db_client.post('/api/scan-batch', data={
+                'images': [(io.BytesIO(b'x' * 600), 'page1.jpg'),
+                           (io.BytesIO(b'x' * 600), 'page2.jpg')]
+            }, content_type='multipart/form-data')
+        
+        assert response.status_code == 413
+        assert 'too large' in json.loads(response.data)['error']
+        mock_submit.assert_not_called()
+    
+    @patch('utils.scan_jobs.split_scan_pages')
+    @patch('routes.submit_batch_scan_job')
+    def test_batch_scan_counts_pages_before_splitting(self, mock_submit, mock_split, db_client):
+        """Test a multi-page file over the page limit is refused before it is split"""
+        import io
+        from PIL import Image
+        from app import app
+        
+        buffer = io.BytesIO()
+        frames = [Image.new('L', (20, 20), shade) for shade in (0, 128, 255)]
+        frames[0].save(buffer, format='TIFF', save_all=True, append_images=frames[1:])
+        
+        with patch.dict(app.config, {'SCAN_BATCH_MAX_PAGES': 2}):
+            response = db_client.post('/api/scan-batch', data={
+                'images': [(io.BytesIO(buffer.getvalue()), 'fax.tiff')]
+            }, content_type='multipart/form-data')
+        
+        assert response.status_code == 400
+        assert 'Too many pages' in json.loads(response.data)['error']
+        mock_submit.assert_not_called()
+        mock_split.assert_not_called()
+    
+    @patch('utils.scan_jobs.run_batch_scan_pipeline')
+    def test_batch_scan_splits_pages_in_job(self, mock_pipeline, db_client):
+        """Test multi-page files are split by the background job"""
+        import io
+        from PIL import Image
+        from utils.scan_jobs import get_scan_job
+        
+        buffer = io.BytesIO()
+        frames = [Image.new('L', (20, 20), shade) for shade in (0, 255)]
+        frames[0].save(buffer, format='TIFF', save_all=True, append_images=frames[1:])
+        mock_pipeline.return_value = {'extracted_text': '', 'medications': [], 'pages': []}
+        
+        response = db_client.post('/api/scan-batch', data={
+            'images': [(io.BytesIO(buffer.getvalue()), 'fax.tiff'), (io.BytesIO(b'page three'), 'page3.jpg')]
+        }, content_type='multipart/form-data')
+        
+        assert response.status_code == 202
+        job = json.loads(response.data)
+        assert job['pages'] == 3
+        assert get_scan_job(job['job_id']).wait(timeout=5)
+        assert len(mock_pipeline.call_args[0][0]) == 3
+    
+    def test_batch_scan_without_images(self, db_client):
+        """Test submitting a batch scan with no files"""
+        response = db_client.post('/api/scan-batch', data={})
+        assert response.status_code == 400
+
 class TestMedicationSearchRoutes:
     """Test cases for medication search routes"""
     
@@ -281,4 +517,362 @@ class TestSessionHandling:
         
         # Verify session was cleared
         with test_app.session_transaction() as sess:
-            assert 'temp_medications' not in sess
\ No newline at end of file
+            assert 'temp_medications' not in sess
+
+
+class TestPrescriptionScanRoutes:
+    """Test cases for stored prescription scans"""
+    
+    def test_prescription_scan_thumbnail(self, db_client, login_as):
+        """Test the prescription view serves a thumbnail of the stored scan"""
+        import hashlib
+        import cv2
+        import numpy as np
+        from app import db
+        from utils.scan_store import store_scan_image
+        
+        patient = login_as('testpatient')
+        data = cv2.imencode('.png', np.full((800, 600, 3), 255, dtype=np.uint8))[1].tobytes()
+        prescription = Prescription(user_id=patient.id,
+                                    scan_image_path=store_scan_image(data, hashlib.sha256(data).hexdigest()))
+        without_scan = Prescription(user_id=patient.id)
+        db.session.add_all([prescription, without_scan])
+        db.session.commit()
+        
+        response = db_client.get(f'/prescription/{prescription.id}/scan-thumbnail')
+        assert response.status_code == 200
+        assert response.mimetype == 'image/jpeg'
+        assert 'max-age' in response.headers['Cache-Control']
+        
+        assert db_client.get(f'/prescription/{without_scan.id}/scan-thumbnail').status_code == 404
+    
+    def test_prescription_scan_thumbnail_other_patient(self, db_client, login_as, test_db):
+        """Test patients can't see scans of other patients' prescriptions"""
+        from app import db
+        
+        doctor = User.query.filter_by(username='testdoctor').first()
+        prescription = Prescription(user_id=doctor.id, scan_image_path='ab/abc.png')
+        db.session.add(prescription)
+        db.session.commit()
+        
+        login_as('testpatient')
+        assert db_client.get(f'/prescription/{prescription.id}/scan-thumbnail').status_code == 403
+
+
+class TestDosageVerificationRoutes:
+    """Test cases for batch dosage verification"""
+    
+    def test_verify_dosages_lines(self, db_client, login_as):
+        """Test every line of a prescription is checked in one request"""
+        login_as('testdoctor')
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        acetaminophen = Medication.query.filter_by(name='Acetaminophen').first()
+        
+        response = db_client.post('/api/verify-dosages', json={
+            'lines': [
+                {'medication_id': ibuprofen.id, 'dosage': '400mg', 'frequency': 'every 6 hours'},
+                {'medication_id': acetaminophen.id, 'dosage': '1 g', 'frequency': 'every 4 hours'},
+                {'medication_id': 99999, 'dosage': '10mg'}
+            ],
+            'patient_weight': 70,
+            'patient_age': 40
+        })
+        
+        assert response.status_code == 200
+        results = response.get_json()['results']
+        assert [result['is_appropriate'] for result in results] == [True, False, False]
+        assert results[1]['doses_per_day'] == 6
+        assert results[2]['error'] == 'Medication not found'
+    
+    def test_verify_dosages_prescriptions(self, db_client, login_as):
+        """Test stored prescriptions are checked against their own patient"""
+        from datetime import date
+        from app import db
+        
+        login_as('testpharmacist')
+        patient = User.query.filter_by(username='testpatient').first()
+        patient.weight = 20
+        patient.date_of_birth = date(date.today().year - 8, 1, 1)
+        acetaminophen = Medication.query.filter_by(name='Acetaminophen').first()
+        prescription = Prescription(user_id=patient.id)
+        db.session.add(prescription)
+        db.session.flush()
+        db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=acetaminophen.id,
+                                              dosage='500mg', frequency='every 6 hours'))
+        db.session.commit()
+        
+        response = db_client.post('/api/verify-dosages', json={'prescription_ids': [prescription.id, 99999]})
+        
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['missing'] == [99999]
+        result = data['prescriptions'][0]['results'][0]
+        assert result['is_appropriate'] is False
+        assert "Maximum recommended dose: 300 mg per dose" in result['recommendations']
+    
+    def test_verify_dosages_requires_clinician(self, db_client, login_as):
+        """Test patients can't use the batch verification API"""
+        login_as('testpatient')
+        response = db_client.post('/api/verify-dosages', json={'lines': [{'medication_id': 1, 'dosage': '10mg'}]})
+        assert response.status_code == 403
+    
+    def test_verify_dosages_missing_lines(self, db_client, login_as):
+        """Test a request without lines or prescriptions is rejected"""
+        login_as('testdoctor')
+        assert db_client.post('/api/verify-dosages', json={}).status_code == 400
+    
+    def test_verify_dosages_malformed_lines(self, db_client, login_as):
+        """Test lines that aren't a list of objects are rejected"""
+        login_as('testdoctor')
+        
+        for lines in (5, 'Ibuprofen 400mg', ['x'], [{'medication_id': 1, 'dosage': '10mg'}, None]):
+            response = db_client.post('/api/verify-dosages', json={'lines': lines})
+            assert response.status_code == 400
+            assert response.get_json()['error'] == 'lines must be a list of objects'
+        
+        response = db_client.post('/api/verify-dosages', json={'prescription_ids': 3})
+        assert response.status_code == 400
+    
+    def test_verify_dosages_medication_id_strings(self, db_client, login_as):
+        """Test numeric string IDs are looked up and other IDs fail on their own line"""
+        login_as('testdoctor')
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        
+        response = db_client.post('/api/verify-dosages', json={'lines': [
+            {'medication_id': str(ibuprofen.id), 'dosage': '400mg', 'frequency': 'every 6 hours'},
+            {'medication_id': 'ibuprofen', 'dosage': '400mg'},
+            {'medication_id': [ibuprofen.id], 'dosage': '400mg'}
+        ]})
+        
+        assert response.status_code == 200
+        results = response.get_json()['results']
+        assert results[0]['medication_name'] == 'Ibuprofen'
+        assert results[0]['medication_id'] == ibuprofen.id
+        assert results[0]['is_appropriate'] is True
+        assert [result['error'] for result in results[1:]] == ['Invalid medication ID', 'Invalid medication ID']
+        assert results[1]['medication_id'] == 'ibuprofen'
+    
+    def test_interaction_report_uses_dosage_rules(self, db_client, login_as):
+        """Test report generation flags dosages with the shared dosage checks"""
+        from app import db
+        from routes import generate_interaction_report
+        
+        patient = login_as('testpatient')
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        prescription = Prescription(user_id=patient.id)
+        db.session.add(prescription)
+        db.session.flush()
+        db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=ibuprofen.id,
+                                              dosage='0.9 g', frequency='once daily'))
+        db.session.commit()
+        
+        report = generate_interaction_report(prescription.id)
+        
+        assert report.has_dosage_issues is True
+        dosage_details = [detail for detail in report.details if detail.interaction_type == 'dosage']
+        assert len(dosage_details) == 1
+        assert "maximum single dose of 800 mg" in dosage_details[0].description
+
+
+class TestInteractionReports:
+    """Test cases for interaction report generation"""
+    
+    def test_report_includes_overlapping_prescriptions(self, db_client, login_as):
+        """Test interactions with medications the patient is still taking are reported"""
+        from datetime import datetime, timedelta
+        from app import db
+        from routes import generate_interaction_report
+        
+        patient = login_as('testpatient')
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        
+        finished = Prescription(user_id=patient.id, date_prescribed=datetime.utcnow() - timedelta(days=60))
+        ongoing = Prescription(user_id=patient.id, date_prescribed=datetime.utcnow() - timedelta(days=3))
+        new = Prescription(user_id=patient.id)
+        db.session.add_all([finished, ongoing, new])
+        db.session.flush()
+        db.session.add_all([
+            PrescriptionMedication(prescription_id=finished.id, medication_id=warfarin.id,
+                                   dosage='5mg', duration='10 days'),
+            PrescriptionMedication(prescription_id=ongoing.id, medication_id=warfarin.id,
+                                   dosage='5mg', duration='30 days'),
+            PrescriptionMedication(prescription_id=new.id, medication_id=aspirin.id, dosage='81mg'),
+        ])
+        db.session.commit()
+        
+        report = generate_interaction_report(new.id)
+        
+        assert report.has_interactions is True
+        details = [detail for detail in report.details if detail.interaction_type == 'drug-drug']
+        assert len(details) == 1
+        assert f"prescription #{ongoing.id}" in details[0].description
+
+
+class TestInventoryRoutes:
+    """Test cases for inventory adjustment routes"""
+    
+    def test_inventory_adjustments_api(self, db_client, login_as):
+        """Test a delivery of several medications is applied in one request"""
+        login_as('testpharmacist')
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        ibuprofen_stock = ibuprofen.stock_quantity
+        aspirin_stock = aspirin.stock_quantity
+        
+        response = db_client.post('/api/inventory/adjustments', json={'adjustments': [
+            {'medication_id': ibuprofen.id, 'quantity_change': 200, 'reason': 'Wholesaler delivery'},
+            {'medication_id': aspirin.id, 'quantity_change': 50, 'reason': 'Wholesaler delivery'},
+            {'medication_id': 99999, 'quantity_change': 10, 'reason': 'Wholesaler delivery'},
+        ]})
+        
+        assert response.status_code == 200
+        data = response.get_json()
+        assert [line['stock_quantity'] for line in data['applied']] == [ibuprofen_stock + 200, aspirin_stock + 50]
+        assert data['failed'] == [{'index': 2, 'medication_id': 99999, 'error': 'Medication not found'}]
+    
+    def test_update_inventory_route_reports_refusal(self, db_client, login_as):
+        """Test a refused stock change is reported instead of flashed as a success"""
+        login_as('testpharmacist')
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        stock = warfarin.stock_quantity
+        
+        response = db_client.post('/update-inventory', data={
+            'medication_id': warfarin.id, 'quantity_change': -(stock + 1), 'reason': 'Expired'
+        }, follow_redirects=True)
+        
+        assert b'not enough Warfarin in stock' in response.data
+        assert b'Inventory updated successfully' not in response.data
+        
+        response = db_client.post('/update-inventory', data={
+            'medication_id': warfarin.id, 'quantity_change': -5, 'reason': 'Expired'
+        }, follow_redirects=True)
+        assert b'Inventory updated successfully' in response.data
+    
+    def test_inventory_adjustments_api_requires_pharmacist(self, db_client, login_as):
+        """Test only pharmacists can adjust inventory"""
+        login_as('testdoctor')
+        
+        response = db_client.post('/api/inventory/adjustments', json={'adjustments': [
+            {'medication_id': 1, 'quantity_change': 5, 'reason': 'Delivery'}
+        ]})
+        
+        assert response.status_code == 403
+    
+    def test_inventory_adjustments_api_limits_batch_size(self, db_client, login_as):
+        """Test oversized batches are rejected"""
+        from app import app
+        
+        login_as('testpharmacist')
+        max_lines = app.config['INVENTORY_BATCH_MAX_LINES']
+        
+        response = db_client.post('/api/inventory/adjustments', json={'adjustments': [
+            {'medication_id': 1, 'quantity_change': 1, 'reason': 'Delivery'}
+        ] * (max_lines + 1)})
+        
+        assert response.status_code == 400
+    
+    def test_inventory_usage_page(self, db_client, login_as):
+        """Test the usage view and its CSV export read the daily rollups"""
+        from utils.inventory import update_inventory
+        
+        user = login_as('testpharmacist')
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        update_inventory(warfarin.id, 25, 'New stock received', user.id)
+        
+        page = db_client.get(f'/inventory/usage?medication_id={warfarin.id}&days=7')
+        assert page.status_code == 200
+        assert b'Warfarin' in page.data
+        
+        export = db_client.get(f'/inventory/usage?medication_id={warfarin.id}&format=csv')
+        assert export.mimetype == 'text/csv'
+        assert export.data.decode().splitlines()[1].endswith(f'{warfarin.id},Warfarin,25,0,0,75')
+    
+    def test_inventory_pages_show_forecast(self, db_client, login_as):
+        """Test the inventory page and dashboard use the forecast reorder levels"""
+        from app import db
+        
+        login_as('testpharmacist')
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        warfarin.daily_demand = 10
+        warfarin.suggested_minimum_stock = 70
+        db.session.commit()
+        
+        inventory_page = db_client.get('/inventory')
+        assert inventory_page.status_code == 200
+        assert b'5 days of supply' in inventory_page.data
+        
+        dashboard = db_client.get('/dashboard')
+        assert dashboard.status_code == 200
+        assert b'<td>70</td>' in dashboard.data
+
+class TestPrescriptionFillRoutes:
+    """Test cases for confirming, filling and cancelling prescriptions"""
+    
+    def _prescribe(self, patient, medication):
+        from app import db
+        
+        prescription = Prescription(user_id=patient.id)
+        db.session.add(prescription)
+        db.session.flush()
+        db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=medication.id,
+                                              dosage='1 tablet', frequency='once daily', duration='7 days'))
+        db.session.commit()
+        return prescription
+    
+    def test_fill_selected_prescriptions(self, db_client, login_as):
+        """Test a pharmacist can fill several prescriptions at once"""
+        from app import db
+        
+        login_as('testpharmacist')
+        patient = User.query.filter_by(username='testpatient').first()
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        prescriptions = [self._prescribe(patient, ibuprofen) for _ in range(2)]
+        
+        dashboard = db_client.get('/dashboard')
+        assert b'Fill Selected' in dashboard.data
+        
+        response = db_client.post('/fill-prescriptions', data={
+            'prescription_id': [str(prescription.id) for prescription in prescriptions]
+        })
+        
+        assert response.status_code == 302
+        db.session.expire_all()
+        assert [prescription.status for prescription in prescriptions] == ['filled', 'filled']
+        assert db.session.get(Medication, ibuprofen.id).stock_quantity == 86
+    
+    def test_confirm_then_cancel_prescription(self, db_client, login_as):
+        """Test confirming reserves stock and cancelling releases it"""
+        from app import db
+        
+        login_as('testpharmacist')
+        patient = User.query.filter_by(username='testpatient').first()
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        prescription = self._prescribe(patient, aspirin)
+        
+        page = db_client.get(f'/prescription/{prescription.id}')
+        assert b'Confirm &amp; Reserve' in page.data
+        
+        response = db_client.post(f'/prescription/{prescription.id}/confirm')
+        assert response.status_code == 302
+        db.session.expire_all()
+        assert prescription.status == 'confirmed'
+        assert db.session.get(Medication, aspirin.id).reserved_quantity == 7
+        
+        db_client.post(f'/prescription/{prescription.id}/cancel')
+        db.session.expire_all()
+        assert prescription.status == 'cancelled'
+        assert db.session.get(Medication, aspirin.id).reserved_quantity == 0
+    
+    def test_fill_requires_pharmacist(self, db_client, login_as):
+        """Test only pharmacists can fill prescriptions"""
+        from app import db
+        
+        patient = login_as('testpatient')
+        prescription = self._prescribe(patient, Medication.query.filter_by(name='Aspirin').first())
+        
+        db_client.post(f'/prescription/{prescription.id}/fill')
+        
+        db.session.expire_all()
+        assert prescription.status == 'pending'
+
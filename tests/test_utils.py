@@ -1,11 +1,13 @@
 """
 Tests for utility functions
 """
+import json
 import pytest
 from unittest.mock import patch, MagicMock
-from utils.dosage import parse_dosage, calculate_age, verify_dosage
+from utils.dosage import parse_dosage, calculate_age, verify_dosage, parse_quantity, medication_strength, dose_amount
+from utils.dosing_rules import DosingRuleIndex, get_dosing_rules, load_dosing_rules
 from utils.drug_interaction import check_drug_interactions
-from utils.inventory import update_inventory, get_low_stock_medications
+from utils.inventory import update_inventory, get_low_stock_medications, adjust_stock, apply_inventory_adjustments
 from datetime import date, datetime
 from models import Medication, DrugInteraction
 
@@ -87,6 +89,133 @@ class TestDosageUtils:
         assert len(result['warnings']) > 0
 
 
+class TestDosageUnits:
+    """Test cases for unit normalization in dosage checks"""
+    
+    def test_parse_quantity_normalizes_mass(self):
+        """Test grams and micrograms are converted to milligrams"""
+        assert parse_quantity("0.5 g") == parse_quantity("500mg")
+        assert parse_quantity("250 mcg").value == pytest.approx(0.25)
+        assert parse_quantity("250 mcg").unit == "mg"
+    
+    def test_parse_quantity_concentration(self):
+        """Test liquid strengths become an amount per ml"""
+        strength = parse_quantity("250mg/5ml")
+        assert strength.dimension == "concentration"
+        assert strength.unit == "mg/ml"
+        assert strength.value == pytest.approx(50.0)
+        assert parse_quantity("100 IU/ml").unit == "iu/ml"
+    
+    def test_parse_quantity_invalid(self):
+        """Test text without a number can't be parsed"""
+        assert parse_quantity("invalid dosage") is None
+        assert parse_quantity("") is None
+    
+    def test_dose_amount_converts_tablets_and_volumes(self):
+        """Test tablet counts and volumes are converted using the strength"""
+        assert dose_amount(parse_quantity("2 tablets"), parse_quantity("200mg")).value == pytest.approx(400.0)
+        assert dose_amount(parse_quantity("10 ml"), parse_quantity("250mg/5ml")).value == pytest.approx(500.0)
+        assert dose_amount(parse_quantity("2 tablets")) is None
+    
+    def test_medication_strength_cached_until_changed(self, test_db):
+        """Test a medication's strength is parsed again only when it changes"""
+        medication = Medication.query.filter_by(name='Ibuprofen').first()
+        first = medication_strength(medication)
+        assert first.value == pytest.approx(200.0)
+        
+        with patch('utils.dosage.parse_quantity') as mock_parse:
+            assert medication_strength(medication) is first
+            mock_parse.assert_not_called()
+        
+        medication.strength = '0.4 g'
+        assert medication_strength(medication).value == pytest.approx(400.0)
+    
+    def test_verify_dosage_compares_scaled_units(self, test_db):
+        """Test a dose in grams is compared with a strength in milligrams"""
+        medication = Medication.query.filter_by(name='Acetaminophen').first()
+        
+        result = verify_dosage(medication, "0.5 g", weight=70, age=30)
+        
+        assert result['is_appropriate'] is True
+        assert not any("doesn't match" in warning for warning in result['warnings'])
+    
+    def test_verify_dosage_high_dose_in_grams(self, test_db):
+        """Test a dose above 4x the strength is flagged after conversion"""
+        medication = Medication.query.filter_by(name='Ibuprofen').first()
+        
+        result = verify_dosage(medication, "1 g", weight=None, age=None)
+        
+        assert result['is_appropriate'] is False
+        assert any("more than 4x" in warning for warning in result['warnings'])
+
+
+class TestDosingRules:
+    """Test cases for the dosing rule table"""
+    
+    def test_rules_resolved_once_per_medication(self, test_db):
+        """Test a medication's rules are looked up from the cache after the first check"""
+        medication = Medication.query.filter_by(name='Ibuprofen').first()
+        index = DosingRuleIndex([{'names': ['ibuprofen'], 'rules': [{'check': 'dose', 'limit': 800, 'warning': 'Too much'}]}])
+        
+        rules = index.rules_for(medication)
+        assert len(rules) == 1
+        with patch.object(index, '_resolve') as mock_resolve:
+            assert index.rules_for(medication) is rules
+            mock_resolve.assert_not_called()
+    
+    def test_rules_match_longer_names(self):
+        """Test products named after a drug get its rules"""
+        index = DosingRuleIndex([{'names': ['ibuprofen'], 'rules': [{'check': 'dose', 'limit': 800, 'warning': 'Too much'}]}])
+        medication = Medication(name="Children's Ibuprofen", generic_name=None)
+        
+        assert len(index.rules_for(medication)) == 1
+        assert index.rules_for(Medication(name='Lisinopril', generic_name='lisinopril')) == []
+    
+    def test_unknown_check_rejected(self):
+        """Test rules with an unknown check are refused"""
+        with pytest.raises(ValueError):
+            DosingRuleIndex([{'names': ['x'], 'rules': [{'check': 'weekly', 'limit': 1, 'warning': 'x'}]}])
+    
+    def test_load_rules_from_file(self, test_db, tmp_path, monkeypatch):
+        """Test rules can be loaded in bulk from a JSON file"""
+        monkeypatch.setattr('utils.dosing_rules._index', None)
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'medications': [
+            {'names': ['lisinopril'], 'rules': [{'check': 'dose', 'limit': 40, 'warning': 'Above {limit:g} mg'}]}
+        ]}))
+        
+        load_dosing_rules(str(rules_file))
+        medication = Medication.query.filter_by(name='Ibuprofen').first()
+        medication.name = 'Lisinopril'
+        result = verify_dosage(medication, "80mg")
+        
+        assert result['is_appropriate'] is False
+        assert 'Above 40 mg' in result['warnings']
+        assert get_dosing_rules().rules_for(Medication(name='Ibuprofen')) == []
+    
+    def test_daily_maximum(self, test_db):
+        """Test the daily maximum is checked when the number of doses is known"""
+        medication = Medication.query.filter_by(name='Acetaminophen').first()
+        
+        assert verify_dosage(medication, "1000mg", doses_per_day=4)['is_appropriate'] is True
+        result = verify_dosage(medication, "1000mg", doses_per_day=6)
+        assert result['is_appropriate'] is False
+        assert any("6000 mg" in warning for warning in result['warnings'])
+    
+    def test_age_bands(self, test_db):
+        """Test age-specific rules only apply inside their age band"""
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        
+        assert verify_dosage(aspirin, "81mg", age=8)['is_appropriate'] is False
+        assert verify_dosage(aspirin, "81mg", age=30)['is_appropriate'] is True
+        
+        elderly = verify_dosage(warfarin, "7.5mg", age=80)
+        assert elderly['is_appropriate'] is True
+        assert "Elderly patients may require lower warfarin doses" in elderly['warnings']
+        assert verify_dosage(warfarin, "7.5mg", age=40)['warnings'] == []
+
+
 class TestDrugInteractionUtils:
     """Test cases for drug interaction utility functions"""
     
@@ -183,6 +312,97 @@ class TestInventoryUtils:
         test_db.session.refresh(medication)
         assert medication.stock_quantity >= 0
     
+    def test_update_inventory_refuses_negative_stock(self, test_db):
+        """Test a removal larger than the stock changes nothing"""
+        from models import InventoryLog
+        
+        medication = Medication.query.filter_by(name='Warfarin').first()
+        initial_stock = medication.stock_quantity
+        
+        assert update_inventory(medication.id, -(initial_stock + 1), "Test removal", user_id=1) is False
+        
+        test_db.session.refresh(medication)
+        assert medication.stock_quantity == initial_stock
+        assert InventoryLog.query.filter_by(medication_id=medication.id).count() == 0
+    
+    def test_update_inventory_refusal_keeps_pending_changes(self, test_db):
+        """Test a refused change doesn't discard the caller's other changes"""
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        aspirin.description = 'Low dose'
+        
+        assert update_inventory(warfarin.id, -1000, "Test removal", user_id=1) is False
+        test_db.session.commit()
+        
+        test_db.session.expire_all()
+        assert Medication.query.filter_by(name='Aspirin').first().description == 'Low dose'
+    
+    def test_update_inventory_unknown_medication(self, test_db):
+        """Test updating a medication that doesn't exist"""
+        assert update_inventory(9999, 5, "Stock replenishment", user_id=1) is False
+    
+    def test_update_inventory_applies_concurrent_changes(self, test_db):
+        """Test a change made elsewhere after loading the medication isn't lost"""
+        from sqlalchemy import text
+        
+        medication = Medication.query.filter_by(name='Ibuprofen').first()
+        initial_stock = medication.stock_quantity
+        test_db.session.commit()
+        
+        # Another pharmacist dispenses 30 after this one loaded the medication
+        with test_db.engine.begin() as connection:
+            connection.execute(text("UPDATE medication SET stock_quantity = stock_quantity - 30 WHERE id = :id"),
+                               {'id': medication.id})
+        
+        assert update_inventory(medication.id, -20, "Prescription filled", user_id=1) is True
+        
+        test_db.session.refresh(medication)
+        assert medication.stock_quantity == initial_stock - 50
+    
+    def test_adjust_stock_returns_new_quantity(self, test_db):
+        """Test adjust_stock returns the new stock and updates loaded objects"""
+        medication = Medication.query.filter_by(name='Aspirin').first()
+        initial_stock = medication.stock_quantity
+        
+        assert adjust_stock(medication.id, 7) == initial_stock + 7
+        assert medication.stock_quantity == initial_stock + 7
+        assert adjust_stock(medication.id, -(initial_stock + 8)) is None
+        assert medication.stock_quantity == initial_stock + 7
+    
+    def test_apply_inventory_adjustments(self, test_db):
+        """Test a batch applies valid lines and reports the others"""
+        from models import InventoryLog
+        
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        ibuprofen_stock = ibuprofen.stock_quantity
+        warfarin_stock = warfarin.stock_quantity
+        
+        result = apply_inventory_adjustments([
+            {'medication_id': ibuprofen.id, 'quantity_change': 100, 'reason': 'Delivery'},
+            {'medication_id': warfarin.id, 'quantity_change': -(warfarin_stock + 1), 'reason': 'Dispensed'},
+            {'medication_id': 9999, 'quantity_change': 5, 'reason': 'Delivery'},
+            {'medication_id': ibuprofen.id, 'quantity_change': 'many', 'reason': 'Delivery'},
+            {'medication_id': warfarin.id, 'quantity_change': 10, 'reason': ''},
+            {'medication_id': ibuprofen.id, 'quantity_change': -30, 'reason': 'Dispensed'},
+        ], user_id=1)
+        
+        assert 'error' not in result
+        assert [(line['index'], line['stock_quantity']) for line in result['applied']] == [
+            (0, ibuprofen_stock + 100), (5, ibuprofen_stock + 70)
+        ]
+        assert [line['index'] for line in result['failed']] == [1, 2, 3, 4]
+        assert result['failed'][1]['error'] == 'Medication not found'
+        
+        test_db.session.refresh(ibuprofen)
+        test_db.session.refresh(warfarin)
+        assert ibuprofen.stock_quantity == ibuprofen_stock + 70
+        assert warfarin.stock_quantity == warfarin_stock
+        logs = InventoryLog.query.order_by(InventoryLog.id).all()
+        assert [(log.medication_id, log.quantity_change, log.recorded_by_id) for log in logs] == [
+            (ibuprofen.id, 100, 1), (ibuprofen.id, -30, 1)
+        ]
+    
     def test_get_low_stock_medications(self, test_db):
         """Test getting medications with low stock"""
         # Set a medication to low stock
@@ -280,4 +500,1790 @@ class TestOCRUtils:
         result = extract_medications_from_text("Some prescription text")
         
         assert isinstance(result, list)
-        assert len(result) == 0  # Should return empty list on error
\ No newline at end of file
+        assert len(result) == 0  # Should return empty list on error
+
+
+class TestScanJobUtils:
+    """Test cases for the in-process scan job store"""
+    
+    def test_job_store_runs_job(self):
+        """Test a submitted job reports its stages and result"""
+        from utils.scan_jobs import ScanJobStore
+        
+        store = ScanJobStore(max_workers=1)
+        
+        def body(job, value):
+            job.set_stage('ocr')
+            return {'value': value}
+        
+        job = store.submit(body, 42)
+        
+        assert job.wait(timeout=5)
+        assert store.get(job.id) is job
+        assert job.status == 'done'
+        assert job.result == {'value': 42}
+    
+    def test_job_store_records_failure(self):
+        """Test a job that raises is marked as failed"""
+        from utils.scan_jobs import ScanJobStore
+        
+        store = ScanJobStore(max_workers=1)
+        
+        def body(job):
+            raise RuntimeError("OCR crashed")
+        
+        job = store.submit(body)
+        
+        assert job.wait(timeout=5)
+        assert job.status == 'failed'
+        assert job.error == "OCR crashed"
+    
+    def test_job_store_prunes_expired_jobs(self):
+        """Test finished jobs are forgotten after the TTL"""
+        from utils.scan_jobs import ScanJobStore
+        
+        store = ScanJobStore(max_workers=1, ttl=0)
+        job = store.submit(lambda job: {})
+        job.wait(timeout=5)
+        job.updated_at -= 1
+        
+        store.submit(lambda job: {}).wait(timeout=5)
+        assert store.get(job.id) is None
+
+
+
+    def test_job_publishes_stage_events(self):
+        """Test stage changes and completion are recorded as events"""
+        from utils.scan_jobs import ScanJob
+        
+        job = ScanJob()
+        job.set_stage('ocr_done', {'extracted_text': 'Ibuprofen 200mg'})
+        job.set_stage('resolved', {'medications': [{'name': 'Ibuprofen'}]})
+        job.finish(result={'medications': []})
+        
+        events = job.events_since(0)
+        assert [event['event'] for event in events] == ['stage', 'stage', 'done']
+        assert events[0]['data'] == {'stage': 'ocr_done', 'extracted_text': 'Ibuprofen 200mg'}
+        assert events[2]['data']['status'] == 'done'
+        assert job.events_since(2) == events[2:]
+    
+    def test_events_since_waits_for_new_events(self):
+        """Test waiting for events returns as soon as one is published"""
+        import threading
+        from utils.scan_jobs import ScanJob
+        
+        job = ScanJob()
+        assert job.events_since(0, timeout=0.01) == []
+        
+        threading.Timer(0.05, job.set_stage, args=('decoded',)).start()
+        events = job.events_since(0, timeout=5)
+        assert events[0]['data'] == {'stage': 'decoded'}
+
+
+def make_prescription_image(lines, width=640, height=480):
+    """Render text lines onto a white image, encoded as PNG"""
+    import cv2
+    import numpy as np
+    
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    for i, line in enumerate(lines):
+        cv2.putText(image, line, (30, 80 + 60 * i), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+    return image
+
+
+class TestScanStore:
+    """Test cases for the content-addressed scan store"""
+    
+    def test_difference_hash_matches_recompressed_scan(self):
+        """Test a rescaled, recompressed copy hashes close to the original"""
+        import cv2
+        from utils.scan_store import difference_hash, hamming_distances, DUPLICATE_DISTANCE
+        
+        original = make_prescription_image(["Ibuprofen 200mg", "twice daily"])
+        _, encoded = cv2.imencode('.jpg', cv2.resize(original, (480, 360)), [cv2.IMWRITE_JPEG_QUALITY, 60])
+        copy = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        other = make_prescription_image(["Warfarin 5mg", "once daily", "for 30 days"])
+        
+        distances = hamming_distances(difference_hash(original), [difference_hash(copy), difference_hash(other)])
+        assert distances[0] <= DUPLICATE_DISTANCE
+        assert distances[1] > DUPLICATE_DISTANCE
+    
+    def test_pipeline_reuses_stored_scan(self, test_db):
+        """Test the same image uploaded twice by a user is only processed once"""
+        import cv2
+        from utils.scan_pipeline import run_scan_pipeline
+        from models import ScanRecord
+        
+        image = make_prescription_image(["Ibuprofen 200mg", "twice daily"])
+        png = cv2.imencode('.png', image)[1].tobytes()
+        
+        with patch('utils.ocr.extract_text_from_image', return_value="Medication: Ibuprofen 200mg") as mock_extract, \
+             patch('utils.ocr.extract_medications_from_text', return_value=[]):
+            first = run_scan_pipeline(image_bytes=png, user_id=1)
+            exact = run_scan_pipeline(image_bytes=png, user_id=1)
+        
+        assert mock_extract.call_count == 1
+        assert first['scan_id'] == exact['scan_id']
+        assert exact['medications'] == first['medications']
+        
+        record = ScanRecord.query.get(first['scan_id'])
+        assert record.user_id == 1
+        assert record.image_path == f"{record.sha256[:2]}/{record.sha256}.png"
+        assert ScanRecord.query.count() == 1
+    
+    def test_stored_scans_are_not_shared_between_users(self, test_db):
+        """Test another user's identical upload runs the whole pipeline"""
+        import cv2
+        from utils.scan_pipeline import run_scan_pipeline
+        from models import ScanRecord
+        
+        png = cv2.imencode('.png', make_prescription_image(["Ibuprofen 200mg"]))[1].tobytes()
+        
+        with patch('utils.ocr.extract_text_from_image', return_value="Medication: Ibuprofen 200mg") as mock_extract, \
+             patch('utils.ocr.extract_medications_from_text', return_value=[]):
+            first = run_scan_pipeline(image_bytes=png, user_id=1)
+            other = run_scan_pipeline(image_bytes=png, user_id=2)
+            anonymous = run_scan_pipeline(image_bytes=png)
+            anonymous_again = run_scan_pipeline(image_bytes=png)
+        
+        assert mock_extract.call_count == 4
+        assert first['scan_id'] != other['scan_id']
+        assert ScanRecord.query.filter_by(user_id=2).one().id == other['scan_id']
+        # Anonymous scans can't be reused, so they aren't kept
+        assert 'scan_id' not in anonymous and 'scan_id' not in anonymous_again
+        assert ScanRecord.query.count() == 2
+    
+    def test_similar_scan_is_only_a_hint(self, test_db):
+        """Test a similar looking scan is reused only when OCR finds the same text"""
+        import cv2
+        from utils.scan_pipeline import run_scan_pipeline
+        
+        first_page = make_prescription_image(["Patient: John Doe", "Warfarin 5mg"])
+        other_page = make_prescription_image(["Patient: Jane Roe", "Aspirin 81mg"])
+        recompressed = cv2.imencode('.jpg', first_page, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+        
+        texts = ["Medication: Warfarin", "medication:  warfarin", "Medication: Aspirin"]
+        with patch('utils.ocr.extract_text_from_image', side_effect=texts) as mock_extract, \
+             patch('utils.scan_pipeline.extract_medications', return_value=[]) as mock_extract_meds, \
+             patch('utils.scan_store.DUPLICATE_DISTANCE', 256):
+            first = run_scan_pipeline(image_bytes=cv2.imencode('.png', first_page)[1].tobytes(), user_id=1)
+            again = run_scan_pipeline(image_bytes=recompressed, user_id=1)
+            other = run_scan_pipeline(image_bytes=cv2.imencode('.png', other_page)[1].tobytes(), user_id=1)
+        
+        # Every upload is OCRed, only the one with matching text skips extraction
+        assert mock_extract.call_count == 3
+        assert mock_extract_meds.call_count == 2
+        assert again['medications'] == first['medications']
+        assert [med['name'] for med in other['medications']] == ['Aspirin']
+        assert again['extracted_text'] == "medication:  warfarin"
+    
+    def test_prune_scan_store(self, test_db):
+        """Test old scans and unused images are deleted, prescription images kept"""
+        import os
+        import cv2
+        import time
+        import hashlib
+        from datetime import timedelta
+        from models import ScanRecord, Prescription
+        from utils.scan_store import store_scan_image, get_store_dir, get_scan_thumbnail, prune_scan_store
+        
+        def stored(lines, user_id, age_days):
+            data = cv2.imencode('.png', make_prescription_image(lines))[1].tobytes()
+            digest = hashlib.sha256(data).hexdigest()
+            record = ScanRecord(user_id=user_id, sha256=digest, dhash='00', image_path=store_scan_image(data, digest),
+                                created_at=datetime.utcnow() - timedelta(days=age_days))
+            test_db.session.add(record)
+            test_db.session.commit()
+            get_scan_thumbnail(record.image_path)
+            return record.image_path
+        
+        recent = stored(["Ibuprofen"], 1, 1)
+        expired = stored(["Warfarin"], 1, 60)
+        prescribed = stored(["Aspirin"], 1, 60)
+        anonymous = stored(["Acetaminophen"], None, 1)
+        test_db.session.add(Prescription(user_id=1, scan_image_path=prescribed))
+        test_db.session.commit()
+        
+        # Files just written may belong to a scan that is still being saved
+        assert prune_scan_store(30) == {'records': 3, 'files': 0}
+        
+        with patch('utils.scan_store.time.time', return_value=time.time() + 7200):
+            assert prune_scan_store(30) == {'records': 0, 'files': 4}
+        
+        store_dir = get_store_dir()
+        assert [record.image_path for record in ScanRecord.query.all()] == [recent]
+        assert os.path.exists(os.path.join(store_dir, recent))
+        assert os.path.exists(os.path.join(store_dir, prescribed))
+        assert not os.path.exists(os.path.join(store_dir, expired))
+        assert not os.path.exists(os.path.join(store_dir, anonymous))
+    
+    def test_scan_thumbnail_is_cached(self, test_app):
+        """Test thumbnails are generated once and scaled down"""
+        import os
+        import cv2
+        import hashlib
+        from utils.scan_store import store_scan_image, get_scan_thumbnail
+        
+        data = cv2.imencode('.png', make_prescription_image(["Ibuprofen"], 1200, 900))[1].tobytes()
+        image_path = store_scan_image(data, hashlib.sha256(data).hexdigest())
+        
+        thumbnail = get_scan_thumbnail(image_path, size=300)
+        assert cv2.imread(thumbnail).shape[:2] == (225, 300)
+        
+        modified = os.path.getmtime(thumbnail)
+        assert get_scan_thumbnail(image_path, size=300) == thumbnail
+        assert os.path.getmtime(thumbnail) == modified
+        assert get_scan_thumbnail('ab/missing.png') is None
+
+
+class TestScanPipelineUtils:
+    """Test cases for the scan pipeline helpers"""
+    
+    def test_merge_detected_medications(self):
+        """Test medications found on several pages are de-duplicated"""
+        from utils.scan_pipeline import merge_detected_medications
+        
+        merged = merge_detected_medications([
+            [{'name': 'Ibuprofen', 'dosage': '200mg', 'frequency': ''}],
+            [{'name': ' ibuprofen ', 'dosage': '400mg', 'frequency': 'twice daily'},
+             {'name': 'Warfarin', 'dosage': '5mg'}],
+            None
+        ])
+        
+        assert [med['name'] for med in merged] == ['Ibuprofen', 'Warfarin']
+        # First occurrence wins, missing fields are filled from later pages
+        assert merged[0]['dosage'] == '200mg'
+        assert merged[0]['frequency'] == 'twice daily'
+    
+    def test_resolve_medications_deduplicates_catalog_matches(self, test_db):
+        """Test names matching the same catalog entry resolve once"""
+        from utils.scan_pipeline import resolve_medications
+        
+        medications = resolve_medications([
+            {'name': 'Warfarin', 'dosage': '5mg', 'duration': '30 days'},
+            {'name': 'warfarin sodium'},
+            {'name': 'Unknownium', 'duration': '5 days'}
+        ])
+        
+        assert [med['name'] for med in medications] == ['Warfarin', 'Unknownium']
+        assert medications[0]['dosage'] == '5mg'
+        assert [med['duration'] for med in medications] == ['30 days', '5 days']
+        assert str(medications[1]['id']).startswith('temp_')
+    
+    def test_run_scan_pipeline_decodes_bytes_in_memory(self, test_db):
+        """Test an uploaded image is decoded without being written to disk"""
+        import cv2
+        import numpy as np
+        from utils.scan_pipeline import run_scan_pipeline
+        
+        image = np.full((40, 60, 3), 255, dtype=np.uint8)
+        _, encoded = cv2.imencode('.png', image)
+        stages = []
+        
+        with patch('utils.ocr.extract_text_from_image', return_value="Medication: Ibuprofen 200mg") as mock_extract, \
+             patch('utils.ocr.extract_medications_from_text', return_value=[]):
+            result = run_scan_pipeline(image_bytes=encoded.tobytes(),
+                                       progress=lambda stage, data: stages.append(stage))
+        
+        assert stages == ['decoded', 'ocr_done', 'extraction_done', 'resolved']
+        assert mock_extract.call_args[0][0] is None
+        assert mock_extract.call_args[1]['image'].shape == (40, 60, 3)
+        assert result['medications'][0]['name'] == 'Ibuprofen'
+    
+    def test_decode_image_rejects_garbage(self):
+        """Test bytes that aren't an image decode to None"""
+        from utils.ocr import decode_image
+        
+        assert decode_image(b"not an image") is None
+        assert decode_image(b"") is None
+    
+    def test_split_scan_pages_multipage_tiff(self):
+        """Test a multi-page TIFF is split into one image per page"""
+        import io
+        from PIL import Image
+        from utils.scan_pipeline import split_scan_pages
+        
+        frames = [Image.new('L', (20, 20), color) for color in (0, 128, 255)]
+        buffer = io.BytesIO()
+        frames[0].save(buffer, format='TIFF', save_all=True, append_images=frames[1:])
+        
+        pages = split_scan_pages('fax.tiff', buffer.getvalue())
+        
+        assert len(pages) == 3
+        assert Image.open(io.BytesIO(pages[1])).getpixel((0, 0)) == (128, 128, 128)
+    
+    def test_split_scan_pages_single_image(self):
+        """Test a single-page upload is passed through unchanged"""
+        from utils.scan_pipeline import split_scan_pages
+        
+        assert split_scan_pages('scan.jpg', b'not really an image') == [b'not really an image']
+    
+    @patch('utils.ocr.extract_medications_from_text')
+    @patch('utils.ocr.extract_text_from_image')
+    def test_run_batch_scan_pipeline(self, mock_extract_text, mock_extract_meds, test_db):
+        """Test pages are OCRed separately and merged into one result"""
+        from utils.scan_pipeline import run_batch_scan_pipeline
+        
+        mock_extract_text.side_effect = lambda path: f"text of {path}"
+        mock_extract_meds.side_effect = lambda text: [{'name': 'Ibuprofen', 'dosage': '200mg'}]
+        
+        result = run_batch_scan_pipeline(['page1.png', 'page2.png'])
+        
+        assert [page['extracted_text'] for page in result['pages']] == ['text of page1.png', 'text of page2.png']
+        assert len(result['medications']) == 1
+        assert result['medications'][0]['name'] == 'Ibuprofen'
+
+
+class FakeOCREngine:
+    """Stand-in for a long-lived OCR engine"""
+    
+    instances = 0
+    
+    def __init__(self, text="fake text", is_healthy=True):
+        FakeOCREngine.instances += 1
+        self.text = text
+        self.is_healthy = is_healthy
+        self.calls = 0
+        self.closed = False
+    
+    name = 'fake'
+    
+    def image_to_string(self, image):
+        self.calls += 1
+        return self.text
+    
+    def healthy(self):
+        return self.is_healthy
+    
+    def close(self):
+        self.closed = True
+
+
+class TestOCREnginePool:
+    """Test cases for the pooled OCR engines"""
+    
+    def test_pool_reuses_started_engines(self):
+        """Test engines are created once and reused across scans"""
+        from utils.ocr_engine import OCREnginePool
+        
+        FakeOCREngine.instances = 0
+        pool = OCREnginePool(factory=FakeOCREngine, size=2, fallback=FakeOCREngine("fallback"))
+        
+        assert pool.start() == 2
+        for _ in range(5):
+            assert pool.image_to_string(None) == "fake text"
+        
+        # Two pooled engines plus the fallback, none created per scan
+        assert FakeOCREngine.instances == 3
+    
+    def test_pool_falls_back_when_engines_unavailable(self):
+        """Test the subprocess path is used when no engine can start"""
+        from utils.ocr_engine import OCREnginePool
+        
+        def broken_factory():
+            raise ImportError("tesserocr is not installed")
+        
+        pool = OCREnginePool(factory=broken_factory, size=2, fallback=FakeOCREngine("fallback"))
+        
+        assert pool.start() == 0
+        assert pool.image_to_string(None) == "fallback"
+    
+    def test_health_check_replaces_unhealthy_engines(self):
+        """Test the health check swaps out engines that stopped working"""
+        from utils.ocr_engine import OCREnginePool
+        
+        pool = OCREnginePool(factory=FakeOCREngine, size=2, fallback=FakeOCREngine("fallback"))
+        pool.start()
+        
+        with pool.engine() as engine:
+            engine.is_healthy = False
+            broken = engine
+        
+        report = pool.health_check()
+        
+        assert broken.closed
+        assert report['size'] == 2
+        assert report['healthy'] == 2
+        assert report['fallback'] == 'fake'
+    
+    def test_health_check_shrinks_pool_when_replacement_fails(self):
+        """Test an engine that can't be replaced is no longer waited for"""
+        import time
+        from utils.ocr_engine import OCREnginePool
+        
+        engines = [FakeOCREngine(is_healthy=False)]
+        
+        def factory():
+            if not engines:
+                raise RuntimeError("tesseract crashed")
+            return engines.pop()
+        
+        pool = OCREnginePool(factory=factory, size=1, fallback=FakeOCREngine("fallback"))
+        assert pool.start() == 1
+        
+        report = pool.health_check()
+        assert report['size'] == 0
+        assert report['healthy'] == 0
+        
+        with patch('utils.ocr_engine.OCR_ACQUIRE_TIMEOUT', 30):
+            started = time.monotonic()
+            assert pool.image_to_string(None) == "fallback"
+            assert time.monotonic() - started < 5
+    
+    @patch('utils.ocr.recognize_words')
+    def test_extract_text_uses_pool(self, mock_recognize, tmp_path):
+        """Test OCR goes through the engine pool instead of a new process"""
+        import cv2
+        import numpy as np
+        from utils.ocr import extract_text_from_image
+        
+        image_path = str(tmp_path / "scan.png")
+        cv2.imwrite(image_path, np.full((40, 40, 3), 255, dtype=np.uint8))
+        mock_recognize.return_value = [
+            {'text': 'Ibuprofen', 'conf': 95.0, 'left': 0, 'top': 0, 'width': 20, 'height': 10, 'line': 1},
+            {'text': '200mg', 'conf': 90.0, 'left': 22, 'top': 0, 'width': 10, 'height': 10, 'line': 1}
+        ]
+        
+        assert extract_text_from_image(image_path) == "Ibuprofen 200mg"
+        mock_recognize.assert_called_once()
+
+
+def make_word(text, conf, left, top, line):
+    return {'text': text, 'conf': conf, 'left': left, 'top': top,
+            'width': 30, 'height': 12, 'line': line}
+
+
+class TestRegionReOCR:
+    """Test cases for word-level OCR and selective region retries"""
+    
+    def test_group_words_into_lines(self):
+        """Test words are grouped with a bounding box and mean confidence"""
+        from utils.ocr import group_words_into_lines
+        
+        lines = group_words_into_lines([
+            make_word('Ibuprofen', 90, 10, 10, 1),
+            make_word('200mg', 70, 50, 12, 1),
+            make_word('bid', 40, 10, 40, 2),
+        ])
+        
+        assert [line['text'] for line in lines] == ['Ibuprofen 200mg', 'bid']
+        assert lines[0]['conf'] == 80
+        assert lines[0]['box'] == (10, 10, 80, 24)
+    
+    def test_only_low_confidence_lines_are_retried(self):
+        """Test confident lines are kept and unsure ones re-OCRed from a crop"""
+        import numpy as np
+        from utils.ocr import group_words_into_lines, reocr_low_confidence_lines
+        
+        gray = np.full((100, 200), 255, dtype=np.uint8)
+        lines = group_words_into_lines([
+            make_word('Warfarin', 92, 10, 10, 1),
+            make_word('5rng', 35, 10, 40, 2),
+        ])
+        
+        with patch('utils.ocr.recognize_words') as mock_recognize, \
+             patch('utils.ocr.analyze_region_with_ai') as mock_vision:
+            mock_recognize.return_value = [make_word('5mg', 88, 0, 0, 1)]
+            lines = reocr_low_confidence_lines(gray, lines)
+        
+        assert mock_recognize.call_count == 1
+        # The crop is the padded line box, upscaled 2x by the reprocessing
+        assert mock_recognize.call_args[0][0].shape == (48, 84)
+        mock_vision.assert_not_called()
+        assert [line['text'] for line in lines] == ['Warfarin', '5mg']
+        assert lines[1]['source'] == 'reprocessed'
+    
+    def test_unreadable_region_goes_to_vision_model(self):
+        """Test the vision model only receives the cropped region"""
+        import numpy as np
+        from utils.ocr import group_words_into_lines, reocr_low_confidence_lines
+        
+        gray = np.full((400, 300), 255, dtype=np.uint8)
+        lines = group_words_into_lines([make_word('l0mg', 20, 100, 200, 1)])
+        
+        with patch('utils.ocr.recognize_words', return_value=[]), \
+             patch('utils.ocr.analyze_region_with_ai', return_value='10mg') as mock_vision:
+            lines = reocr_low_confidence_lines(gray, lines)
+        
+        region = mock_vision.call_args[0][0]
+        assert region.shape == (24, 42)
+        assert lines[0]['text'] == '10mg'
+        assert lines[0]['source'] == 'vision'
+
+
+class TestLocalMedicationExtractor:
+    """Test cases for the rule-based medication extractor"""
+    
+    @pytest.fixture
+    def catalog(self):
+        from utils.med_extractor import CatalogDictionary
+        return CatalogDictionary([
+            (1, 'Ibuprofen', 'Ibuprofen'),
+            (2, 'Acetaminophen', 'Paracetamol'),
+            (3, 'Warfarin', 'Warfarin Sodium'),
+        ])
+    
+    def test_extracts_dose_frequency_and_instructions(self, catalog):
+        """Test structured fields are read from the medication's lines"""
+        from utils.med_extractor import extract_medications_locally
+        
+        text = ("Patient: John Doe\n"
+                "Ibuprofen 400 mg bid x 7 days\n"
+                "Take with food\n"
+                "Paracetamol 500mg every 6 hours as needed")
+        
+        medications, confidence = extract_medications_locally(text, catalog)
+        
+        assert [med['name'] for med in medications] == ['Ibuprofen', 'Acetaminophen']
+        assert medications[0]['dosage'] == '400mg'
+        assert medications[0]['frequency'] == 'twice daily'
+        assert medications[0]['duration'] == '7 days'
+        assert medications[0]['instructions'] == 'take with food'
+        assert medications[1]['frequency'] == 'every 6 hours'
+        assert medications[0]['confidence'] == 1.0
+        # Overall confidence is that of the least certain medication
+        assert confidence == medications[1]['confidence'] == 0.95
+    
+    def test_unknown_medications_lower_confidence(self, catalog):
+        """Test drugs missing from the catalog send the scan to the LLM"""
+        from utils.med_extractor import extract_medications_locally, LOCAL_CONFIDENCE_THRESHOLD
+        
+        text = ("Ibuprofen 400mg twice daily\n"
+                "Take with food\n"
+                "Amoxicillin 500mg three times a day for 7 days\n"
+                "Metformin 850 mg bid")
+        
+        medications, confidence = extract_medications_locally(text, catalog)
+        
+        assert [med['name'] for med in medications] == ['Ibuprofen']
+        assert medications[0]['instructions'] == 'take with food'
+        # The Amoxicillin line's details aren't given to Ibuprofen
+        assert medications[0]['duration'] == ''
+        assert confidence < LOCAL_CONFIDENCE_THRESHOLD
+    
+    @patch('utils.backends.get_backend')
+    def test_unknown_medications_use_llm(self, mock_get_backend, catalog):
+        """Test the extraction backend is called when a drug isn't in the catalog"""
+        from utils.scan_pipeline import extract_medications
+        
+        detected = [{'name': 'Ibuprofen'}, {'name': 'Amoxicillin', 'duration': '7 days'}]
+        mock_get_backend.return_value.extract_medications.return_value = detected
+        
+        text = "Ibuprofen 400mg twice daily\nAmoxicillin 500mg for 7 days"
+        assert extract_medications(text, catalog) == detected
+        mock_get_backend.assert_called_once_with('extraction')
+    
+    def test_continuation_lines_and_concentrations(self, catalog):
+        """Test details on following lines and liquid concentrations"""
+        from utils.med_extractor import extract_medications_locally
+        
+        medications, confidence = extract_medications_locally(
+            "Medication: Acetaminophen 160 mg/5 ml\nDosage: 5 ml three times a day", catalog)
+        
+        assert medications[0]['dosage'] == '160mg/5ml'
+        assert medications[0]['frequency'] == 'three times daily'
+        assert confidence == 0.95
+    
+    def test_misspelled_name_has_lower_confidence(self, catalog):
+        """Test OCR misspellings match fuzzily with reduced confidence"""
+        from utils.med_extractor import extract_medications_locally
+        
+        medications, confidence = extract_medications_locally("Ibuprofin 200mg", catalog)
+        
+        assert medications[0]['name'] == 'Ibuprofen'
+        assert confidence == 0.6
+    
+    def test_no_medications(self, catalog):
+        """Test text without catalog medications"""
+        from utils.med_extractor import extract_medications_locally
+        
+        assert extract_medications_locally("Patient: John Doe\nDate: 2024-01-01", catalog) == ([], 0.0)
+    
+    def test_catalog_dictionary_from_database(self, test_db):
+        """Test the dictionary covers names and generic names"""
+        from utils.med_extractor import get_catalog_dictionary
+        
+        catalog = get_catalog_dictionary()
+        
+        assert catalog.lookup('warfarin sodium') == 'Warfarin'
+        assert catalog.lookup('acetylsalicylic acid') == 'Aspirin'
+    
+    @patch('utils.ocr.extract_medications_from_text')
+    def test_confident_local_extraction_skips_llm(self, mock_extract_meds, test_db):
+        """Test the LLM is not called when local extraction is confident"""
+        from utils.scan_pipeline import extract_medications
+        
+        medications = extract_medications("Warfarin 5mg once daily")
+        
+        assert medications[0]['name'] == 'Warfarin'
+        mock_extract_meds.assert_not_called()
+    
+    @patch('utils.ocr.extract_medications_from_text')
+    def test_low_confidence_falls_back_to_llm(self, mock_extract_meds, test_db):
+        """Test the LLM is used when local extraction is unsure"""
+        from utils.scan_pipeline import extract_medications
+        
+        mock_extract_meds.return_value = [{'name': 'Lisinopril', 'dosage': '10mg'}]
+        
+        medications = extract_medications("Lisinoprl 10 mg")
+        
+        assert medications == [{'name': 'Lisinopril', 'dosage': '10mg'}]
+        mock_extract_meds.assert_called_once()
+
+
+class StubOpenAIServer:
+    """Local HTTP server standing in for the OpenAI chat completions API"""
+    
+    def __init__(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        
+        stub = self
+        self.requests = 0
+        # One (delay, status) entry per request, the last one repeats
+        self.behaviour = [(0, 200)]
+        self.content = '{"medications": [{"name": "Ibuprofen", "dosage": "200mg"}]}'
+        self._lock = threading.Lock()
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                import json as _json
+                import time
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with stub._lock:
+                    index = stub.requests
+                    stub.requests += 1
+                delay, status = stub.behaviour[min(index, len(stub.behaviour) - 1)]
+                time.sleep(delay)
+                body = _json.dumps({
+                    'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o',
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': stub.content}}]
+                } if status == 200 else {'error': {'message': 'upstream error'}}).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/v1'
+    
+    def client(self):
+        from openai import OpenAI
+        return OpenAI(api_key='test-key', base_url=self.base_url, max_retries=0)
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestAIResilience:
+    """Test cases for latency budgets, circuit breaking and hedging of AI calls"""
+    
+    @pytest.fixture
+    def stub_server(self):
+        server = StubOpenAIServer()
+        with patch('utils.ocr.openai_client', server.client()):
+            yield server
+        server.close()
+    
+    def test_nested_deadline_never_extends_budget(self):
+        """Test an inner scope can't outlive the enclosing budget"""
+        from utils.resilience import deadline_scope, current_deadline
+        
+        assert current_deadline() is None
+        with deadline_scope(1) as outer:
+            with deadline_scope(10) as inner:
+                assert inner is outer
+                assert current_deadline().remaining() <= 1
+        assert current_deadline() is None
+    
+    def test_expired_deadline_refuses_calls(self):
+        """Test no call is attempted without budget left"""
+        from utils.resilience import Deadline, DeadlineExceeded
+        
+        with pytest.raises(DeadlineExceeded):
+            Deadline(0).timeout()
+        assert Deadline(10).timeout(cap=2) == 2
+    
+    def test_circuit_breaker_opens_and_recovers(self):
+        """Test the breaker opens after failures and closes after a good trial"""
+        from utils.resilience import CircuitBreaker, CircuitOpenError
+        
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+        
+        def fail():
+            raise RuntimeError("upstream down")
+        
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                breaker.call(fail)
+        
+        assert breaker.state == 'open'
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: 'ok')
+        
+        import time
+        time.sleep(0.06)
+        assert breaker.state == 'half-open'
+        assert breaker.call(lambda: 'ok') == 'ok'
+        assert breaker.state == 'closed'
+    
+    def test_slow_upstream_is_cut_off_by_budget(self, stub_server):
+        """Test a hanging API call returns within the scan budget"""
+        import time
+        from utils.ocr import extract_medications_from_text
+        from utils.resilience import deadline_scope
+        
+        stub_server.behaviour = [(3, 200)]
+        
+        start = time.monotonic()
+        with deadline_scope(0.5):
+            result = extract_medications_from_text("Ibuprofen 200mg")
+        
+        assert result == []
+        assert time.monotonic() - start < 2
+    
+    def test_breaker_skips_failing_upstream(self, stub_server):
+        """Test the API stops being called while it keeps failing"""
+        from utils.ocr import extract_medications_from_text, ai_breaker
+        
+        stub_server.behaviour = [(0, 500)]
+        
+        for _ in range(5):
+            assert extract_medications_from_text("Ibuprofen 200mg") == []
+        
+        assert stub_server.requests == ai_breaker.failure_threshold
+        assert ai_breaker.state == 'open'
+    
+    def test_hedged_request_beats_slow_first_attempt(self, stub_server):
+        """Test a hedged request answers when the first one stalls"""
+        import time
+        from utils.ocr import extract_medications_from_text
+        
+        stub_server.behaviour = [(3, 200), (0, 200)]
+        
+        start = time.monotonic()
+        with patch('utils.ocr.AI_HEDGE_AFTER', 0.2):
+            result = extract_medications_from_text("Ibuprofen 200mg")
+        
+        assert result == [{'name': 'Ibuprofen', 'dosage': '200mg'}]
+        assert stub_server.requests == 2
+        assert time.monotonic() - start < 2
+    
+    def test_stub_server_success(self, stub_server):
+        """Test the client talks to the stub like the real API"""
+        from utils.ocr import extract_medications_from_text
+        
+        assert extract_medications_from_text("Ibuprofen 200mg")[0]['name'] == 'Ibuprofen'
+
+
+class TestVisionEncoding:
+    """Test cases for preparing images for the vision model"""
+    
+    @staticmethod
+    def make_page(width, height, font_scale):
+        import cv2
+        import numpy as np
+        page = np.full((height, width, 3), 255, dtype=np.uint8)
+        for i, line in enumerate(["Ibuprofen 200mg", "1 tablet every 6 hours"]):
+            cv2.putText(page, line, (40, 200 + i * int(120 * font_scale)),
+                        cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), max(1, int(font_scale * 2)))
+        return page
+    
+    def test_large_text_is_downscaled_to_legible_size(self):
+        """Test a high resolution page is shrunk while text stays readable"""
+        import base64
+        import cv2
+        import numpy as np
+        from utils.ocr import encode_for_vision, estimate_text_height, VISION_MIN_TEXT_HEIGHT
+        
+        page = self.make_page(3000, 2000, font_scale=4)
+        encoded = base64.b64decode(encode_for_vision(page))
+        decoded = cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_GRAYSCALE)
+        
+        assert encoded[:2] == b'\xff\xd8'  # JPEG
+        assert decoded.shape[1] < 3000
+        _, binary = cv2.threshold(decoded, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        assert estimate_text_height(binary) >= VISION_MIN_TEXT_HEIGHT * 0.8
+    
+    def test_small_text_is_not_downscaled(self):
+        """Test pages with small print are kept at full resolution"""
+        import base64
+        import cv2
+        import numpy as np
+        from utils.ocr import encode_for_vision
+        
+        page = self.make_page(800, 600, font_scale=0.6)
+        decoded = cv2.imdecode(np.frombuffer(base64.b64decode(encode_for_vision(page)), np.uint8),
+                               cv2.IMREAD_COLOR)
+        
+        assert decoded.shape[:2] == (600, 800)
+    
+    @patch('utils.ocr.openai_client')
+    def test_analyze_reuses_decoded_frame(self, mock_openai):
+        """Test the vision call uses the decoded frame instead of the file"""
+        from utils.ocr import analyze_prescription_with_ai
+        
+        mock_response = MagicMock()
+        mock_response.choices[0].message.content = "Ibuprofen 200mg"
+        mock_openai.chat.completions.create.return_value = mock_response
+        
+        result = analyze_prescription_with_ai("/does/not/exist.jpg", image=self.make_page(1000, 800, 2))
+        
+        assert result == "Ibuprofen 200mg"
+        content = mock_openai.chat.completions.create.call_args.kwargs['messages'][1]['content']
+        assert content[1]['image_url']['url'].startswith('data:image/jpeg;base64,/9j/')
+
+
+class TestScanBackends:
+    """Test cases for the pluggable OCR, vision and extraction backends"""
+    
+    def test_default_and_unknown_backends(self):
+        """Test the real backends are used unless another one is selected"""
+        from utils.backends import get_backend, use_backend, TesseractOCRBackend, FakeOCRBackend
+        
+        assert isinstance(get_backend('ocr'), TesseractOCRBackend)
+        assert isinstance(use_backend('ocr', 'fake'), FakeOCRBackend)
+        assert isinstance(get_backend('ocr'), FakeOCRBackend)
+        
+        with pytest.raises(ValueError):
+            use_backend('ocr', 'missing')
+    
+    def test_fake_backend_latency(self):
+        """Test fake backends take about as long as configured"""
+        import time
+        import numpy as np
+        from utils.backends import FakeOCRBackend
+        
+        backend = FakeOCRBackend(latency=0.05, jitter=0.01)
+        image = np.zeros((10, 10), dtype=np.uint8)
+        
+        start = time.perf_counter()
+        words = backend.recognize_words(image)
+        assert time.perf_counter() - start >= 0.04
+        assert words == FakeOCRBackend().recognize_words(image)
+    
+    def test_corpus_is_deterministic(self):
+        """Test the synthetic corpus only depends on its seed"""
+        from utils.scan_corpus import generate_corpus, SAMPLE_PRESCRIPTIONS
+        
+        corpus = generate_corpus(3, seed=1)
+        assert corpus == generate_corpus(3, seed=1)
+        assert corpus != generate_corpus(3, seed=2)
+        assert [lines for lines, _ in corpus] == SAMPLE_PRESCRIPTIONS[:3]
+    
+    def test_pipeline_runs_offline_with_fake_backends(self, test_db):
+        """Test a full scan needs neither Tesseract nor the OpenAI API"""
+        from utils.backends import use_backend
+        from utils.scan_corpus import generate_corpus
+        from utils.scan_pipeline import run_scan_pipeline
+        
+        for kind in ('ocr', 'vision', 'extraction'):
+            use_backend(kind, 'fake')
+        _, image_bytes = generate_corpus(1)[0]
+        
+        with patch('utils.ocr.get_openai_client', side_effect=AssertionError("network used")):
+            result = run_scan_pipeline(image_bytes=image_bytes)
+        
+        assert result['extracted_text']
+        assert result['medications']
+
+
+class TestLazyImports:
+    """Test cases for keeping the OCR and AI stack out of app startup"""
+    
+    def run_import(self, **env):
+        import os
+        import subprocess
+        import sys
+        
+        code = "import sys, app; print(','.join(m for m in ('cv2', 'numpy', 'PIL', 'openai', 'utils.ocr') if m in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                env={**os.environ, 'DATABASE_URL': 'sqlite://', **env})
+        assert result.returncode == 0, result.stderr
+        return result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ''
+    
+    def test_app_import_does_not_load_scan_stack(self):
+        """Test importing the app leaves OCR and AI modules unloaded"""
+        assert self.run_import() == ''
+    
+    def test_preload_loads_scan_stack(self):
+        """Test SCAN_PRELOAD loads the scan stack at startup"""
+        assert 'utils.ocr' in self.run_import(SCAN_PRELOAD='1').split(',')
+
+
+class TestDatabaseBootstrap:
+    """Test cases for the one-time schema and role bootstrap"""
+    
+    def test_bootstrap_is_idempotent(self, test_app):
+        """Test bootstrapping twice creates roles and records the version once"""
+        from models import Role, SchemaVersion
+        from utils.bootstrap import bootstrap_database, check_schema_version, SCHEMA_VERSION
+        
+        first = bootstrap_database()
+        second = bootstrap_database()
+        
+        assert first['roles_created'] == ['patient', 'doctor', 'pharmacist']
+        assert second == {'from_version': SCHEMA_VERSION, 'to_version': SCHEMA_VERSION, 'roles_created': []}
+        assert Role.query.count() == 3
+        assert SchemaVersion.query.count() == 1
+        assert check_schema_version()
+    
+    def test_bootstrap_applies_pending_migrations(self, test_app):
+        """Test an older database gets only the migrations it is missing"""
+        from sqlalchemy import inspect
+        from app import db
+        from utils import bootstrap
+        
+        bootstrap.bootstrap_database()
+        current = bootstrap.SCHEMA_VERSION
+        migrations = bootstrap.MIGRATIONS + [(current + 1, ["ALTER TABLE role ADD COLUMN description VARCHAR(100)"])]
+        
+        with patch.object(bootstrap, 'SCHEMA_VERSION', current + 1), patch.object(bootstrap, 'MIGRATIONS', migrations):
+            assert not bootstrap.check_schema_version()
+            assert bootstrap.bootstrap_database()['from_version'] == current
+            # Already at the new version, the ALTER TABLE must not run again
+            assert bootstrap.bootstrap_database()['from_version'] == current + 1
+        
+        columns = [column['name'] for column in inspect(db.engine).get_columns('role')]
+        assert 'description' in columns
+    
+    def test_dose_schedule_migration_backfills_rows(self, test_app):
+        """Test a version 1 database gets the dose schedule columns filled in"""
+        from sqlalchemy import text
+        from app import db
+        from models import Medication, Prescription, PrescriptionMedication, User
+        from utils import bootstrap
+        
+        bootstrap.bootstrap_database()
+        user = User(username='migrated', email='migrated@test.com', password_hash='x')
+        medication = Medication(name='Ibuprofen', generic_name='Ibuprofen', strength='200mg')
+        db.session.add_all([user, medication])
+        db.session.flush()
+        prescription = Prescription(user_id=user.id)
+        db.session.add(prescription)
+        db.session.flush()
+        db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=medication.id,
+                                              dosage='400mg', frequency='twice daily', duration='5 days'))
+        db.session.commit()
+        
+        # Turn it back into a version 1 database
+        for column in ('doses_per_day', 'course_days', 'daily_mg', 'starts_at', 'ends_at'):
+            db.session.execute(text(f"ALTER TABLE prescription_medication DROP COLUMN {column}"))
+        db.session.execute(text("UPDATE schema_version SET version = 1"))
+        db.session.commit()
+        db.session.expire_all()
+        
+        assert bootstrap.bootstrap_database()['from_version'] == 1
+        row = PrescriptionMedication.query.first()
+        assert row.daily_mg == pytest.approx(800.0)
+        assert row.course_days == pytest.approx(5.0)
+        assert row.ends_at is not None
+
+
+class TestDosageAudit:
+    """Test cases for the vectorized dosage audit"""
+    
+    ROWS = [
+        # dosage, frequency, medication, weight, age
+        ('200mg', 'every 6 hours', 'Ibuprofen', 70.0, 30),
+        ('1.2 g', 'once daily', 'Ibuprofen', 70.0, 30),
+        ('2 tablets', 'every 2 hours', 'Acetaminophen', 80.0, 40),
+        ('500mg', None, 'Acetaminophen', 20.0, 8),
+        ('81mg', 'once daily', 'Aspirin', None, 8),
+        ('7.5mg', 'once daily', 'Warfarin', None, 80),
+        ('lots', None, 'Warfarin', None, None),
+    ]
+    
+    def _columns(self, ages):
+        from utils.dosage_audit import DosageAuditColumns
+        
+        today = date(2025, 6, 1)
+        rows = []
+        for i, (dosage, frequency, name, weight, age) in enumerate(self.ROWS):
+            medication = Medication.query.filter_by(name=name).first()
+            birth_date = date(today.year - age, 1, 1) if age is not None else None
+            ages.append(age)
+            # One prescription per row, so rows don't add up to daily totals
+            rows.append((i + 1, i + 1, None, medication.id, dosage, frequency, medication.strength,
+                         medication.name, medication.generic_name, weight, birth_date))
+        return DosageAuditColumns.from_rows(rows), today
+    
+    def test_audit_matches_verify_dosage(self, test_db):
+        """Test the vectorized audit flags the same rows as verify_dosage"""
+        from utils.dosage import doses_per_day
+        from utils.dosage_audit import audit_dosage_columns
+        
+        ages = []
+        columns, today = self._columns(ages)
+        audit = audit_dosage_columns(columns, today=today, daily_totals={})
+        
+        flagged = dict(zip(audit['flagged'].tolist(), audit['is_appropriate'].tolist()))
+        for i, (dosage, frequency, name, weight, age) in enumerate(self.ROWS):
+            medication = Medication.query.filter_by(name=name).first()
+            expected = verify_dosage(medication, dosage, weight, ages[i], doses_per_day=doses_per_day(frequency))
+            assert flagged.get(i, True) == expected['is_appropriate'], dosage
+            assert (i in flagged) == bool(expected['warnings'] or not expected['is_appropriate']), dosage
+    
+    def test_audit_parses_each_value_once(self, test_db):
+        """Test repeated dosages and strengths are parsed only once"""
+        from utils.dosage_audit import DosageAuditColumns, audit_dosage_columns
+        
+        medication = Medication.query.filter_by(name='Ibuprofen').first()
+        rows = [(i, i, None, medication.id, '1200mg', 'twice daily', medication.strength,
+                 medication.name, medication.generic_name, 70.0, None) for i in range(1, 1001)]
+        columns = DosageAuditColumns.from_rows(rows)
+        
+        with patch('utils.dosage_audit.parse_quantity', wraps=parse_quantity) as mock_parse:
+            audit = audit_dosage_columns(columns, daily_totals={})
+        
+        assert mock_parse.call_count == 2
+        assert len(audit['flagged']) == 1000
+        assert audit['daily_mg'][0] == pytest.approx(2400.0)
+    
+    def test_audit_dosages_writes_csv(self, test_db, tmp_path):
+        """Test the audit reads prescriptions from the database and writes the flagged rows"""
+        import csv
+        from app import db
+        from models import Prescription, PrescriptionMedication, User
+        from utils.dosage_audit import audit_dosages
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        prescription = Prescription(user_id=patient.id)
+        db.session.add(prescription)
+        db.session.flush()
+        db.session.add_all([
+            PrescriptionMedication(prescription_id=prescription.id, medication_id=ibuprofen.id, dosage='200mg'),
+            PrescriptionMedication(prescription_id=prescription.id, medication_id=ibuprofen.id, dosage='1000mg'),
+        ])
+        db.session.commit()
+        
+        output = tmp_path / 'audit.csv'
+        summary = audit_dosages(str(output))
+        
+        assert summary == {'rows': 2, 'flagged': 1, 'inappropriate': 1}
+        with open(output) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 1
+        assert rows[0]['dosage'] == '1000mg'
+        assert rows[0]['is_appropriate'] == 'False'
+        assert 'dose > 4x strength' in rows[0]['reasons']
+    
+    def test_audit_matches_verify_prescription_dosages(self, test_db):
+        """Test the audit and the prescription check agree on the same stored rows"""
+        from datetime import timedelta
+        from app import db
+        from models import Prescription, PrescriptionMedication, User
+        from utils.dosage import verify_prescription_dosages
+        from utils.dosage_audit import load_audit_columns, audit_dosage_columns
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        patient.weight = 100.0
+        child = User.query.filter_by(username='testdoctor').first()
+        child.date_of_birth = (datetime.utcnow() - timedelta(days=8 * 365)).date()
+        child.weight = 30.0
+        meds = {med.name: med for med in Medication.query.all()}
+        
+        prescribed = [
+            # Ibuprofen 2400 + 1200 mg a day over two prescriptions is above 3200
+            (patient, 'pending', [('Ibuprofen', '800mg', 'three times daily')]),
+            (patient, 'pending', [('Ibuprofen', '600mg', 'twice daily')]),
+            # Cancelled prescriptions don't count towards other prescriptions
+            (patient, 'cancelled', [('Ibuprofen', '800mg', 'four times daily')]),
+            # Acetaminophen 4000 + 500 mg a day within one prescription
+            (patient, 'pending', [('Acetaminophen', '1000mg', 'four times daily'),
+                                  ('Acetaminophen', '500mg', 'once daily'),
+                                  ('Warfarin', '5 ml', 'once daily')]),
+            # Contraindicated for a child, parseable or not
+            (child, 'pending', [('Aspirin', '81mg', 'once daily'), ('Aspirin', 'lots', None)]),
+        ]
+        for user, status, lines in prescribed:
+            prescription = Prescription(user_id=user.id, status=status)
+            db.session.add(prescription)
+            db.session.flush()
+            db.session.add_all([PrescriptionMedication(prescription_id=prescription.id, medication_id=meds[name].id,
+                                                       dosage=dosage, frequency=frequency)
+                                for name, dosage, frequency in lines])
+        db.session.commit()
+        
+        columns = load_audit_columns()
+        audit = audit_dosage_columns(columns)
+        flagged = {int(columns.ids[row]): (bool(appropriate), reasons) for row, appropriate, reasons
+                   in zip(audit['flagged'], audit['is_appropriate'], audit['reasons'])}
+        
+        expected = {}
+        for results in verify_prescription_dosages(Prescription.query.all()).values():
+            for result in results:
+                if result['warnings'] or not result['is_appropriate']:
+                    expected[result['prescription_medication_id']] = (result['is_appropriate'], len(result['warnings']))
+        
+        assert {row_id: (appropriate, len(reasons.split('; '))) for row_id, (appropriate, reasons)
+                in flagged.items()} == expected
+        assert len(expected) == 8
+        reasons = sorted(reasons for _, reasons in flagged.values())
+        # The cancelled prescription is still checked against the active ones
+        assert reasons.count('daily dose > 3200 mg') == 3
+        assert reasons.count('daily dose > 4000 mg') == 2
+        assert "dosage unit doesn't match strength" in reasons
+        assert 'unparseable dosage' in reasons
+
+
+class TestDoseSchedules:
+    """Test cases for parsed frequencies, durations and daily totals"""
+    
+    def test_course_days(self):
+        """Test durations are turned into a number of days"""
+        from utils.dosage import course_days
+        
+        assert course_days("7 days") == 7
+        assert course_days("for 2 weeks") == 14
+        assert course_days("1 month") == 30
+        assert course_days("until finished") is None
+        assert course_days(None) is None
+    
+    def test_dose_schedule(self):
+        """Test a dose every 2 hours counts 12 times a day"""
+        from utils.dosage import dose_schedule
+        
+        schedule = dose_schedule('400mg', 'every 2 hours', '3 days', '200mg')
+        assert schedule == {'dose_mg': 400.0, 'doses_per_day': 12.0, 'course_days': 3.0, 'daily_mg': 4800.0}
+        assert dose_schedule('2 tablets', 'as needed', None, '500mg')['daily_mg'] is None
+    
+    def _prescribe(self, patient, medication, dosage, frequency, duration=None, status='pending'):
+        from app import db
+        from models import Prescription, PrescriptionMedication
+        
+        prescription = Prescription(user_id=patient.id, status=status)
+        db.session.add(prescription)
+        db.session.flush()
+        db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=medication.id,
+                                              dosage=dosage, frequency=frequency, duration=duration))
+        db.session.commit()
+        return prescription
+    
+    def test_schedule_stored_on_save(self, test_db):
+        """Test saving a prescription line stores its parsed schedule"""
+        from models import User
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        prescription = self._prescribe(patient, ibuprofen, '2 tablets', 'three times daily', '10 days')
+        
+        line = prescription.medications[0]
+        assert line.doses_per_day == 3
+        assert line.daily_mg == pytest.approx(1200.0)
+        assert line.course_days == 10
+        assert (line.ends_at - prescription.date_prescribed).days == 10
+        
+        line.frequency = 'once daily'
+        test_db.session.commit()
+        assert line.daily_mg == pytest.approx(400.0)
+    
+    def test_active_daily_totals(self, test_db):
+        """Test daily totals only count active prescriptions"""
+        from datetime import timedelta
+        from models import User
+        from utils.dosage import active_daily_totals, patient_daily_totals
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        self._prescribe(patient, ibuprofen, '400mg', 'three times daily')
+        self._prescribe(patient, ibuprofen, '400mg', 'twice daily', status='cancelled')
+        finished = self._prescribe(patient, ibuprofen, '200mg', 'once daily', '5 days')
+        finished.date_prescribed = datetime.utcnow() - timedelta(days=30)
+        finished.medications[0].dosage = '200 mg'
+        test_db.session.commit()
+        
+        totals = patient_daily_totals(active_daily_totals([patient.id]), patient.id)
+        assert totals == {'ibuprofen': pytest.approx(1200.0)}
+    
+    def test_daily_maximum_across_prescriptions(self, test_db):
+        """Test doses of the same drug in separate prescriptions add up"""
+        from models import User
+        from utils.dosage import verify_prescription_dosages
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        first = self._prescribe(patient, ibuprofen, '400mg', 'every 6 hours')
+        second = self._prescribe(patient, ibuprofen, '400mg', 'every 4 hours')
+        
+        alone = verify_prescription_dosages([first])[first.id][0]
+        assert alone['daily_total_mg'] == pytest.approx(4000.0)
+        assert alone['is_appropriate'] is False
+        
+        test_db.session.delete(second.medications[0])
+        test_db.session.commit()
+        assert verify_prescription_dosages([first])[first.id][0]['is_appropriate'] is True
+
+
+class TestMedicationIntervals:
+    """Test cases for medication course intervals and overlap screening"""
+    
+    def test_interval_tree_matches_brute_force(self):
+        """Test the interval tree finds exactly the overlapping intervals"""
+        import random
+        from utils.intervals import IntervalTree
+        
+        rng = random.Random(1)
+        intervals = []
+        for i in range(300):
+            start = rng.randint(0, 1000)
+            intervals.append((start, start + rng.randint(0, 80), i))
+        tree = IntervalTree(intervals)
+        
+        for _ in range(200):
+            start = rng.randint(-50, 1050)
+            end = start + rng.randint(0, 120)
+            expected = {item for s, e, item in intervals if s <= end and e >= start}
+            found = tree.overlapping(start, end)
+            assert len(found) == len(expected)
+            assert set(found) == expected
+    
+    def _prescribe(self, patient, medication, days_ago, duration=None):
+        from datetime import timedelta
+        from app import db
+        from models import Prescription, PrescriptionMedication
+        
+        prescription = Prescription(user_id=patient.id, date_prescribed=datetime.utcnow() - timedelta(days=days_ago))
+        db.session.add(prescription)
+        db.session.flush()
+        db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=medication.id,
+                                              dosage='1 tablet', frequency='once daily', duration=duration))
+        db.session.commit()
+        return prescription
+    
+    def test_course_starts_when_filled(self, test_db):
+        """Test filling a prescription moves its courses to the fill date"""
+        from datetime import timedelta
+        from models import User
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        prescription = self._prescribe(patient, warfarin, days_ago=10, duration='7 days')
+        line = prescription.medications[0]
+        assert line.ends_at - line.starts_at == timedelta(days=7)
+        
+        filled = datetime.utcnow()
+        prescription.date_filled = filled
+        test_db.session.commit()
+        
+        assert line.starts_at == filled
+        assert line.ends_at == filled + timedelta(days=7)
+    
+    def test_screening_ignores_finished_courses(self, test_db):
+        """Test only courses overlapping the new prescription are screened"""
+        from models import User
+        from utils.drug_interaction import screen_prescription_interactions
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        self._prescribe(patient, warfarin, days_ago=90, duration='14 days')
+        new = self._prescribe(patient, aspirin, days_ago=0, duration='7 days')
+        
+        assert screen_prescription_interactions(new) == []
+        
+        # A one-off course without a duration doesn't count as taken forever
+        self._prescribe(patient, warfarin, days_ago=400)
+        assert screen_prescription_interactions(new) == []
+        
+        ongoing = self._prescribe(patient, warfarin, days_ago=10)
+        found = screen_prescription_interactions(new)
+        assert len(found) == 1
+        assert found[0]['severity'] == 'severe'
+        assert found[0]['other_prescription_id'] == ongoing.id
+    
+    def test_screening_within_prescription(self, test_db):
+        """Test medications on the same prescription are always paired"""
+        from app import db
+        from models import User, PrescriptionMedication
+        from utils.drug_interaction import screen_prescription_interactions
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        prescription = self._prescribe(patient, warfarin, days_ago=0, duration='3 days')
+        db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=ibuprofen.id,
+                                              dosage='200mg', duration='1 day'))
+        db.session.commit()
+        
+        found = screen_prescription_interactions(prescription)
+        assert [(item['drug1_name'], item['drug2_name'], item['other_prescription_id']) for item in found] == [
+            ('Warfarin', 'Ibuprofen', None)
+        ]
+    
+    def test_interval_index_rebuilt_after_write(self, test_db):
+        """Test the cached interval index is dropped when prescriptions change"""
+        from models import User
+        from utils.intervals import get_patient_interval_index
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        index = get_patient_interval_index(patient.id)
+        assert get_patient_interval_index(patient.id) is index
+        
+        self._prescribe(patient, warfarin, days_ago=0)
+        rebuilt = get_patient_interval_index(patient.id)
+        assert rebuilt is not index
+        assert len(rebuilt.overlapping(datetime.utcnow())) == 1
+    
+    def test_interval_indexes_are_bounded(self, test_db):
+        """Test the least recently used patients' indexes are dropped"""
+        from utils import intervals
+        
+        with patch.object(intervals, 'INTERVAL_INDEX_MAX_PATIENTS', 2):
+            first = intervals.get_patient_interval_index(101)
+            intervals.get_patient_interval_index(102)
+            assert intervals.get_patient_interval_index(101) is first
+            intervals.get_patient_interval_index(103)
+            
+            assert list(intervals._indexes) == [101, 103]
+    
+    def test_interval_index_dropped_on_rollback(self, test_db):
+        """Test an index built from rolled back rows isn't kept"""
+        from models import User, Prescription, PrescriptionMedication
+        from utils.intervals import get_patient_interval_index
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        prescription = Prescription(user_id=patient.id, date_prescribed=datetime.utcnow())
+        test_db.session.add(prescription)
+        test_db.session.flush()
+        test_db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=warfarin.id,
+                                                   dosage='5mg'))
+        test_db.session.flush()
+        assert len(get_patient_interval_index(patient.id).courses) == 1
+        
+        test_db.session.rollback()
+        assert PrescriptionMedication.query.count() == 0
+        assert get_patient_interval_index(patient.id).courses == []
+    
+    def test_interval_index_follows_moved_prescription(self, test_db):
+        """Test moving a prescription to another patient drops both indexes"""
+        from models import User
+        from utils.intervals import get_patient_interval_index
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        doctor = User.query.filter_by(username='testdoctor').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        prescription = self._prescribe(patient, warfarin, days_ago=0)
+        assert len(get_patient_interval_index(patient.id).courses) == 1
+        assert get_patient_interval_index(doctor.id).courses == []
+        
+        prescription.user_id = doctor.id
+        test_db.session.commit()
+        
+        assert get_patient_interval_index(patient.id).courses == []
+        assert len(get_patient_interval_index(doctor.id).courses) == 1
+
+
+class TestDispensing:
+    """Test cases for the prescription fill workflow"""
+    
+    def _prescribe(self, medication, dosage, frequency=None, duration=None):
+        from app import db
+        from models import User, Prescription, PrescriptionMedication
+        
+        patient = User.query.filter_by(username='testpatient').first()
+        prescription = Prescription(user_id=patient.id)
+        db.session.add(prescription)
+        db.session.flush()
+        db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=medication.id,
+                                              dosage=dosage, frequency=frequency, duration=duration))
+        db.session.commit()
+        return prescription
+    
+    def test_dispense_quantity(self, test_db):
+        """Test the units dispensed follow the dose, frequency and duration"""
+        from utils.dispensing import dispense_quantity, DISPENSE_DEFAULT_DAYS
+        
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        course = self._prescribe(ibuprofen, '400mg', 'twice daily', '5 days')
+        ongoing = self._prescribe(ibuprofen, '1 tablet')
+        
+        assert dispense_quantity(course.medications[0]) == 20
+        assert dispense_quantity(ongoing.medications[0]) == DISPENSE_DEFAULT_DAYS
+    
+    def test_confirm_reserves_and_fill_dispenses(self, test_db):
+        """Test a confirmed prescription holds its stock until it is filled"""
+        from models import InventoryLog
+        from utils.dispensing import reserve_prescription, fill_prescriptions
+        
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        confirmed = self._prescribe(warfarin, '2 tablets', 'once daily', '10 days')
+        pending = self._prescribe(warfarin, '2 tablets', 'once daily', '20 days')
+        
+        assert reserve_prescription(confirmed) == {'success': True}
+        test_db.session.refresh(warfarin)
+        assert confirmed.status == 'confirmed'
+        assert warfarin.reserved_quantity == 20
+        
+        # 30 of the 50 in stock are unreserved, not enough for the pending 40
+        result = fill_prescriptions([pending, confirmed], user_id=1)
+        
+        assert result['filled'] == [confirmed.id]
+        assert result['failed'][0]['prescription_id'] == pending.id
+        assert 'Warfarin' in result['failed'][0]['error']
+        test_db.session.refresh(warfarin)
+        assert (warfarin.stock_quantity, warfarin.reserved_quantity) == (30, 0)
+        assert confirmed.status == 'filled'
+        assert confirmed.medications[0].starts_at == confirmed.date_filled
+        assert pending.status == 'pending'
+        logs = InventoryLog.query.all()
+        assert [(log.quantity_change, log.reason) for log in logs] == [(-20, f'Prescription #{confirmed.id} filled')]
+    
+    def test_fill_many_prescriptions(self, test_db):
+        """Test pending prescriptions are filled together from unreserved stock"""
+        from utils.dispensing import fill_prescriptions
+        
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        prescriptions = [self._prescribe(ibuprofen, '1 tablet', 'three times daily', '10 days') for _ in range(3)]
+        prescriptions.append(self._prescribe(aspirin, '1 tablet', 'once daily', '1 month'))
+        
+        result = fill_prescriptions(prescriptions, user_id=1)
+        
+        # 100 ibuprofen cover three courses of 30
+        assert result == {'filled': [prescription.id for prescription in prescriptions], 'failed': []}
+        test_db.session.refresh(ibuprofen)
+        test_db.session.refresh(aspirin)
+        assert ibuprofen.stock_quantity == 10
+        assert aspirin.stock_quantity == 170
+        
+        again = fill_prescriptions(prescriptions[:1], user_id=1)
+        assert again['failed'] == [{'prescription_id': prescriptions[0].id, 'error': 'Prescription is filled'}]
+    
+    def test_confirm_without_enough_stock(self, test_db):
+        """Test a prescription can't reserve more than the unreserved stock"""
+        from utils.dispensing import reserve_prescription
+        
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        prescription = self._prescribe(warfarin, '1 tablet', 'twice daily', '1 month')
+        
+        result = reserve_prescription(prescription)
+        
+        assert result['success'] is False
+        assert 'Warfarin' in result['error']
+        test_db.session.refresh(warfarin)
+        assert prescription.status == 'pending'
+        assert not warfarin.reserved_quantity
+    
+    def test_confirm_shortage_keeps_pending_changes(self, test_db):
+        """Test a refused confirmation only undoes its own reservations"""
+        from models import PrescriptionMedication
+        from utils.dispensing import reserve_prescription
+        
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        prescription = self._prescribe(ibuprofen, '1 tablet', 'once daily', '5 days')
+        test_db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=warfarin.id,
+                                                   dosage='1 tablet', quantity=500))
+        test_db.session.commit()
+        
+        aspirin.description = 'Low dose'
+        assert reserve_prescription(prescription)['success'] is False
+        test_db.session.commit()
+        
+        test_db.session.expire_all()
+        assert not Medication.query.filter_by(name='Ibuprofen').first().reserved_quantity
+        assert Medication.query.filter_by(name='Aspirin').first().description == 'Low dose'
+    
+    def test_cancel_releases_reservation(self, test_db):
+        """Test cancelling a confirmed prescription frees its stock"""
+        from utils.dispensing import reserve_prescription, cancel_prescription
+        
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        prescription = self._prescribe(aspirin, '1 tablet', 'once daily', '2 weeks')
+        reserve_prescription(prescription)
+        
+        assert cancel_prescription(prescription) == {'success': True}
+        test_db.session.refresh(aspirin)
+        assert prescription.status == 'cancelled'
+        assert (aspirin.stock_quantity, aspirin.reserved_quantity) == (200, 0)
+        assert cancel_prescription(prescription)['success'] is False
+
+
+class TestInventoryRollups:
+    """Test cases for the daily inventory rollups"""
+    
+    def test_inventory_changes_update_rollups(self, test_db):
+        """Test each logged change is added to its day's rollup"""
+        from models import InventoryDailyRollup
+        
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        update_inventory(ibuprofen.id, 50, "New stock received", user_id=1)
+        update_inventory(ibuprofen.id, -5, "Expired medication", user_id=1)
+        apply_inventory_adjustments([
+            {'medication_id': ibuprofen.id, 'quantity_change': -20, 'reason': 'Prescription filled'},
+            {'medication_id': ibuprofen.id, 'quantity_change': 10, 'reason': 'New stock received'},
+        ], user_id=1)
+        
+        rollups = InventoryDailyRollup.query.all()
+        assert len(rollups) == 1
+        rollup = rollups[0]
+        assert rollup.day == datetime.utcnow().date()
+        # A manual change isn't dispensed, whatever its reason says
+        assert (rollup.receipts, rollup.dispensed, rollup.adjustments) == (60, 0, -25)
+        assert rollup.closing_balance == 135
+    
+    def test_filled_prescriptions_count_as_dispensed(self, test_db):
+        """Test stock filled against a prescription is rolled up as dispensed"""
+        from models import User, Prescription, PrescriptionMedication, InventoryLog, InventoryDailyRollup
+        from utils.dispensing import fill_prescriptions
+        from utils.inventory_rollups import rebuild_inventory_rollups
+        
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        patient = User.query.filter_by(username='testpatient').first()
+        prescription = Prescription(user_id=patient.id)
+        test_db.session.add(prescription)
+        test_db.session.flush()
+        test_db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=aspirin.id,
+                                                   dosage='1 tablet', quantity=30))
+        test_db.session.commit()
+        
+        fill_prescriptions([prescription], user_id=1)
+        update_inventory(aspirin.id, -2, "Prescription bottle dropped", user_id=1)
+        
+        log = InventoryLog.query.filter_by(medication_id=aspirin.id, quantity_change=-30).one()
+        assert log.prescription_id == prescription.id
+        rollup = InventoryDailyRollup.query.filter_by(medication_id=aspirin.id).one()
+        assert (rollup.dispensed, rollup.adjustments) == (30, -2)
+        
+        rebuild_inventory_rollups()
+        rollup = InventoryDailyRollup.query.filter_by(medication_id=aspirin.id).one()
+        assert (rollup.dispensed, rollup.adjustments) == (30, -2)
+    
+    def test_rebuild_from_log(self, test_db):
+        """Test the rollups can be recomputed from the log with closing balances"""
+        from datetime import timedelta
+        from models import InventoryLog, InventoryDailyRollup, Prescription
+        from utils.inventory_rollups import rebuild_inventory_rollups, catch_up_inventory_rollups, get_inventory_usage
+        
+        # Ibuprofen has 100 in stock after these changes
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        prescription = Prescription(user_id=1)
+        test_db.session.add(prescription)
+        test_db.session.flush()
+        now = datetime.utcnow()
+        test_db.session.add_all([
+            InventoryLog(medication_id=ibuprofen.id, quantity_change=40, reason='New stock received',
+                         timestamp=now - timedelta(days=3)),
+            InventoryLog(medication_id=ibuprofen.id, quantity_change=-10, reason=f'Prescription #{prescription.id} filled',
+                         prescription_id=prescription.id, timestamp=now - timedelta(days=2)),
+            InventoryLog(medication_id=ibuprofen.id, quantity_change=-4, reason='Prescription filled',
+                         timestamp=now - timedelta(days=2)),
+            InventoryLog(medication_id=ibuprofen.id, quantity_change=-5, reason='Damaged inventory',
+                         timestamp=now),
+        ])
+        test_db.session.commit()
+        
+        assert rebuild_inventory_rollups() == 3
+        
+        usage = get_inventory_usage(now.date() - timedelta(days=7), now.date(), ibuprofen.id)
+        assert [(row['receipts'], row['dispensed'], row['adjustments'], row['closing_balance']) for row in usage] == [
+            (40, 0, 0, 119), (0, 10, -4, 105), (0, 0, -5, 100)
+        ]
+        assert [row['day'] for row in usage] == [(now - timedelta(days=days)).date() for days in (3, 2, 0)]
+        
+        # Catching up only recomputes the last day
+        assert catch_up_inventory_rollups() == 1
+        assert InventoryDailyRollup.query.count() == 3
+    
+    def test_link_dispensed_inventory_logs(self, test_db):
+        """Test entries written by earlier fills are linked to their prescriptions"""
+        from models import InventoryLog, Prescription
+        from utils.inventory_rollups import link_dispensed_inventory_logs
+        
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        prescription = Prescription(user_id=1)
+        test_db.session.add(prescription)
+        test_db.session.flush()
+        filled = InventoryLog(medication_id=ibuprofen.id, quantity_change=-10,
+                              reason=f'Prescription #{prescription.id} filled')
+        manual = InventoryLog(medication_id=ibuprofen.id, quantity_change=-4, reason='Prescription filled')
+        missing = InventoryLog(medication_id=ibuprofen.id, quantity_change=-2, reason='Prescription #9999 filled')
+        test_db.session.add_all([filled, manual, missing])
+        test_db.session.commit()
+        
+        assert link_dispensed_inventory_logs() == 1
+        assert filled.prescription_id == prescription.id
+        assert manual.prescription_id is None
+        assert missing.prescription_id is None
+    
+    def test_write_usage_csv(self, test_db):
+        """Test usage rows are exported as CSV"""
+        import io
+        from utils.inventory_rollups import get_inventory_usage, write_usage_csv
+        
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        update_inventory(aspirin.id, -3, "Stock adjustment", user_id=1)
+        today = datetime.utcnow().date()
+        
+        output = io.StringIO()
+        write_usage_csv(get_inventory_usage(today, today), output)
+        
+        lines = output.getvalue().splitlines()
+        assert lines[0] == 'day,medication_id,medication,receipts,dispensed,adjustments,closing_balance'
+        assert lines[1] == f'{today.isoformat()},{aspirin.id},Aspirin,0,0,-3,197'
+
+
+class TestInventoryForecast:
+    """Test cases for demand forecasting and reorder points"""
+    
+    def test_forecast_demand(self):
+        """Test demand and reorder points are computed for every row at once"""
+        import numpy as np
+        from utils.inventory_forecast import forecast_demand
+        
+        usage = np.zeros((4, 60))
+        usage[0] = 10
+        usage[1, ::2] = 20  # same average, uneven
+        usage[2, 30:] = 10  # only used lately
+        first_index = np.array([0, 0, -5, 60])  # the last one has no history
+        
+        forecast = forecast_demand(usage, first_index, half_life=14, lead_time=7, service_z=1.65)
+        
+        assert forecast['daily_demand'][0] == pytest.approx(10)
+        assert forecast['reorder_point'][0] == 70
+        assert forecast['daily_demand'][1] == pytest.approx(10, rel=0.05)
+        assert forecast['reorder_point'][1] > 70
+        assert 5 < forecast['daily_demand'][2] < 10
+        assert np.isnan(forecast['daily_demand'][3])
+        assert list(forecast['history_days']) == [60, 60, 60, 0]
+    
+    def test_forecast_inventory_sets_reorder_levels(self, test_db):
+        """Test the forecast drives the low stock check"""
+        from datetime import timedelta
+        from models import InventoryDailyRollup
+        from utils.inventory_forecast import forecast_inventory
+        
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        today = datetime.utcnow().date()
+        test_db.session.add_all(
+            InventoryDailyRollup(medication_id=ibuprofen.id, day=today - timedelta(days=days), dispensed=12)
+            for days in range(1, 31)
+        )
+        test_db.session.add_all(
+            InventoryDailyRollup(medication_id=warfarin.id, day=today - timedelta(days=days), dispensed=5)
+            for days in range(1, 4)
+        )
+        test_db.session.commit()
+        
+        assert forecast_inventory(today) == {'medications': 4, 'suggested': 1}
+        
+        test_db.session.refresh(ibuprofen)
+        test_db.session.refresh(warfarin)
+        assert ibuprofen.daily_demand == pytest.approx(12)
+        assert ibuprofen.suggested_minimum_stock == 84
+        assert ibuprofen.reorder_level == 84
+        assert ibuprofen.days_of_supply == pytest.approx(100 / 12)
+        # Too little history for a suggestion, the manual level still applies
+        assert warfarin.suggested_minimum_stock is None
+        assert warfarin.reorder_level == warfarin.minimum_stock_level
+        
+        assert 'Ibuprofen' not in [med.name for med in get_low_stock_medications()]
+        ibuprofen.stock_quantity = 80
+        test_db.session.commit()
+        assert 'Ibuprofen' in [med.name for med in get_low_stock_medications()]
+
+
+class TestLowStockFlags:
+    """Test cases for the low stock flag and its change events"""
+    
+    @pytest.fixture
+    def changes(self):
+        from utils.low_stock import add_low_stock_listener, remove_low_stock_listener
+        
+        seen = []
+        listener = add_low_stock_listener(seen.append)
+        yield seen
+        remove_low_stock_listener(listener)
+    
+    def test_update_inventory_crossing_threshold(self, test_db, changes):
+        """Test the flag follows stock changes and each crossing is announced once"""
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        
+        update_inventory(warfarin.id, -35, "Prescription filled", user_id=1)
+        assert changes == []
+        
+        update_inventory(warfarin.id, -10, "Prescription filled", user_id=1)
+        test_db.session.refresh(warfarin)
+        assert warfarin.is_low_stock is True
+        assert changes == [{'medication_id': warfarin.id, 'is_low_stock': True,
+                            'stock_quantity': 5, 'reorder_level': 10}]
+        assert [med.name for med in get_low_stock_medications()] == ['Warfarin']
+        
+        update_inventory(warfarin.id, -1, "Prescription filled", user_id=1)
+        assert len(changes) == 1
+        
+        update_inventory(warfarin.id, 100, "New stock received", user_id=1)
+        test_db.session.refresh(warfarin)
+        assert warfarin.is_low_stock is False
+        assert [change['is_low_stock'] for change in changes] == [True, False]
+        assert get_low_stock_medications() == []
+    
+    def test_refused_change_is_not_announced(self, test_db, changes):
+        """Test nothing is announced for a change that was rolled back"""
+        from utils.low_stock import record_low_stock_change
+        
+        warfarin = Medication.query.filter_by(name='Warfarin').first()
+        record_low_stock_change(warfarin.id, True, 0, 10)
+        test_db.session.rollback()
+        update_inventory(warfarin.id, -60, "Test removal", user_id=1)
+        
+        assert changes == []
+    
+    def test_fill_and_level_changes_update_flag(self, test_db, changes):
+        """Test filling prescriptions and editing levels keep the flag in step"""
+        from models import User, Prescription, PrescriptionMedication
+        from utils.dispensing import fill_prescriptions
+        
+        aspirin = Medication.query.filter_by(name='Aspirin').first()
+        ibuprofen = Medication.query.filter_by(name='Ibuprofen').first()
+        patient = User.query.filter_by(username='testpatient').first()
+        prescription = Prescription(user_id=patient.id)
+        test_db.session.add(prescription)
+        test_db.session.flush()
+        test_db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=aspirin.id,
+                                                   dosage='1 tablet', quantity=195))
+        test_db.session.commit()
+        
+        fill_prescriptions([prescription], user_id=1)
+        
+        ibuprofen.minimum_stock_level = 150
+        test_db.session.commit()
+        
+        assert [(change['medication_id'], change['is_low_stock']) for change in changes] == [
+            (aspirin.id, True), (ibuprofen.id, True)
+        ]
+        assert {med.name for med in get_low_stock_medications()} == {'Aspirin', 'Ibuprofen'}
+    
+    def test_refresh_low_stock_flags(self, test_db, changes):
+        """Test flags are recomputed after levels change outside the ORM"""
+        from sqlalchemy import text
+        from utils.low_stock import refresh_low_stock_flags
+        
+        acetaminophen = Medication.query.filter_by(name='Acetaminophen').first()
+        test_db.session.execute(text("UPDATE medication SET suggested_minimum_stock = 200 WHERE id = :id"),
+                                {'id': acetaminophen.id})
+        test_db.session.commit()
+        
+        assert refresh_low_stock_flags() == 1
+        assert refresh_low_stock_flags() == 0
+        assert changes == [{'medication_id': acetaminophen.id, 'is_low_stock': True,
+                            'stock_quantity': 150, 'reorder_level': 200}]
+        assert [med.name for med in get_low_stock_medications()] == ['Acetaminophen']
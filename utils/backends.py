@@ -0,0 +1,212 @@
+import os
+import re
+import time
+import random
+import zlib
+import logging
+import threading
+
+# Kinds of work the scan pipeline hands to a backend
+BACKEND_KINDS = ('ocr', 'vision', 'extraction')
+
+# Backend used for each kind unless another one is selected with use_backend
+DEFAULT_BACKENDS = {
+    'ocr': os.environ.get('SCAN_OCR_BACKEND', 'tesseract'),
+    'vision': os.environ.get('SCAN_VISION_BACKEND', 'openai'),
+    'extraction': os.environ.get('SCAN_EXTRACTION_BACKEND', 'openai'),
+}
+
+_registry = {kind: {} for kind in BACKEND_KINDS}
+_active = {}
+_lock = threading.Lock()
+
+def register_backend(kind, name):
+    """
+    Class decorator adding a backend to the registry
+
+    OCR backends implement recognize_words(image). Vision backends implement
+    read_page(image_path, image, binary) and read_region(region). Extraction
+    backends implement extract_medications(text).
+
+    Args:
+        kind (str): One of BACKEND_KINDS
+        name (str): Name the backend is selected by
+    """
+    def decorator(cls):
+        _registry[kind][name] = cls
+        cls.name = name
+        return cls
+    return decorator
+
+def use_backend(kind, name, **options):
+    """
+    Select the backend used for a kind of work from now on
+
+    Args:
+        kind (str): One of BACKEND_KINDS
+        name (str): Registered backend name
+        **options: Arguments for the backend's constructor
+
+    Returns:
+        The new backend instance
+    """
+    try:
+        factory = _registry[kind][name]
+    except KeyError:
+        raise ValueError(f"Unknown {kind} backend '{name}'")
+
+    backend = factory(**options)
+    with _lock:
+        _active[kind] = backend
+    logging.info(f"Using {name} {kind} backend")
+    return backend
+
+def get_backend(kind):
+    """
+    Get the backend currently selected for a kind of work
+
+    Args:
+        kind (str): One of BACKEND_KINDS
+
+    Returns:
+        The backend instance, created from DEFAULT_BACKENDS on first use
+    """
+    backend = _active.get(kind)
+    if backend is None:
+        backend = use_backend(kind, DEFAULT_BACKENDS[kind])
+    return backend
+
+def reset_backends():
+    """Go back to the default backends"""
+    with _lock:
+        _active.clear()
+
+def available_backends(kind):
+    return sorted(_registry[kind])
+
+
+@register_backend('ocr', 'tesseract')
+class TesseractOCRBackend:
+    """Tesseract, through the per-worker engine pool"""
+
+    def recognize_words(self, image):
+        from utils.ocr_engine import recognize_words
+        return recognize_words(image)
+
+
+@register_backend('vision', 'openai')
+class OpenAIVisionBackend:
+    """OpenAI vision model, within the scan's latency budget"""
+
+    def read_page(self, image_path, image=None, binary=None):
+        from utils import ocr
+        return ocr.analyze_prescription_with_ai(image_path, image=image, binary=binary)
+
+    def read_region(self, region):
+        from utils import ocr
+        return ocr.analyze_region_with_ai(region)
+
+
+@register_backend('extraction', 'openai')
+class OpenAIExtractionBackend:
+    """OpenAI chat model returning medications as JSON"""
+
+    def extract_medications(self, text):
+        from utils import ocr
+        return ocr.extract_medications_from_text(text)
+
+
+class FakeBackend:
+    """Deterministic stand-in that only simulates how long the real call takes
+
+    Args:
+        latency (float): Mean seconds each call takes
+        jitter (float): Calls take latency +/- up to jitter seconds
+        seed (int): Seed for the jitter, so runs can be repeated
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def wait(self):
+        with self._random_lock:
+            delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    @staticmethod
+    def transcript_for(image):
+        """The sample prescription a fake backend 'reads' from an image
+
+        The choice depends only on the image content, so the same image
+        always gives the same text.
+        """
+        from utils.scan_corpus import SAMPLE_PRESCRIPTIONS
+
+        data = image.tobytes() if hasattr(image, 'tobytes') else bytes(image or b'')
+        return SAMPLE_PRESCRIPTIONS[zlib.crc32(data) % len(SAMPLE_PRESCRIPTIONS)]
+
+
+@register_backend('ocr', 'fake')
+class FakeOCRBackend(FakeBackend):
+    """Returns the words of a sample prescription with a fixed confidence"""
+
+    def __init__(self, confidence=90.0, **options):
+        super().__init__(**options)
+        self.confidence = float(confidence)
+
+    def recognize_words(self, image):
+        self.wait()
+        words = []
+        for line_number, line in enumerate(self.transcript_for(image), 1):
+            left = 20
+            for text in line.split():
+                width = 12 * len(text)
+                words.append({
+                    'text': text,
+                    'conf': self.confidence,
+                    'left': left,
+                    'top': 40 * line_number,
+                    'width': width,
+                    'height': 24,
+                    'line': line_number
+                })
+                left += width + 12
+        return words
+
+
+@register_backend('vision', 'fake')
+class FakeVisionBackend(FakeBackend):
+    """Returns the text of a sample prescription"""
+
+    def read_page(self, image_path, image=None, binary=None):
+        self.wait()
+        return '\n'.join(self.transcript_for(image if image is not None else image_path))
+
+    def read_region(self, region):
+        self.wait()
+        return None
+
+
+SAMPLE_LINE_PATTERN = re.compile(r"^(?P<name>[A-Za-z][A-Za-z\- ]*?)\s+(?P<dosage>\d[\d.]*\s*\w+)\s*-?\s*(?P<frequency>.*)$")
+
+@register_backend('extraction', 'fake')
+class FakeExtractionBackend(FakeBackend):
+    """Splits lines shaped like 'Name 200mg - twice daily' into medications"""
+
+    def extract_medications(self, text):
+        self.wait()
+        medications = []
+        for line in (text or '').split('\n'):
+            match = SAMPLE_LINE_PATTERN.match(line.strip())
+            if match:
+                medications.append({
+                    'name': match.group('name'),
+                    'dosage': match.group('dosage'),
+                    'frequency': match.group('frequency'),
+                    'instructions': ''
+                })
+        return medications
@@ -0,0 +1,203 @@
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+from app import db
+from models import Role, SchemaVersion, User
+
+# Bump this with every schema change, and add a migration for databases that
+# already exist unless the change only adds new tables
+SCHEMA_VERSION = 9
+
+DEFAULT_ROLES = ['patient', 'doctor', 'pharmacist']
+
+def add_column(table, column, column_type):
+    """
+    Migration step adding a column unless the table already has it
+
+    Databases whose tables were created by create_all with newer models
+    already have the column, and ALTER TABLE would fail on them.
+
+    Returns:
+        function: The step, for MIGRATIONS
+    """
+    def step():
+        existing = [info['name'] for info in inspect(db.engine).get_columns(table)]
+        if column not in existing:
+            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+            db.session.commit()
+    return step
+
+def _backfill_dose_schedules():
+    from utils.dosage import backfill_dose_schedules
+    backfill_dose_schedules()
+
+def _refresh_low_stock_flags():
+    from utils.low_stock import refresh_low_stock_flags
+    refresh_low_stock_flags()
+
+def _link_dispensed_inventory_logs():
+    from utils.inventory_rollups import link_dispensed_inventory_logs
+    link_dispensed_inventory_logs()
+
+def _rebuild_inventory_rollups():
+    from utils.inventory_rollups import rebuild_inventory_rollups
+    rebuild_inventory_rollups()
+
+# Additive changes for existing databases as (version, [SQL statements or
+# functions]), in order. New databases get the current schema from create_all
+# and skip them.
+MIGRATIONS = [
+    (2, [
+        add_column('prescription_medication', 'doses_per_day', 'FLOAT'),
+        add_column('prescription_medication', 'course_days', 'FLOAT'),
+        add_column('prescription_medication', 'daily_mg', 'FLOAT'),
+        add_column('prescription_medication', 'ends_at', 'TIMESTAMP'),
+        "CREATE INDEX IF NOT EXISTS ix_prescription_user_id ON prescription (user_id)",
+    ]),
+    # The backfill uses the current models, so it runs once every column exists
+    (3, [
+        add_column('prescription_medication', 'starts_at', 'TIMESTAMP'),
+        _backfill_dose_schedules,
+    ]),
+    (4, [
+        add_column('medication', 'reserved_quantity', 'INTEGER DEFAULT 0'),
+        add_column('prescription_medication', 'quantity', 'INTEGER'),
+    ]),
+    # create_all adds the rollup table, this fills it from the existing log
+    (5, [
+        _rebuild_inventory_rollups,
+    ]),
+    (6, [
+        add_column('medication', 'daily_demand', 'FLOAT'),
+        add_column('medication', 'suggested_minimum_stock', 'INTEGER'),
+        add_column('medication', 'forecast_at', 'TIMESTAMP'),
+    ]),
+    (7, [
+        add_column('medication', 'is_low_stock', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+        "CREATE INDEX IF NOT EXISTS ix_medication_is_low_stock ON medication (is_low_stock)",
+        _refresh_low_stock_flags,
+    ]),
+    # Stored scans belong to their uploader, the same image may be stored once per user
+    (8, [
+        add_column('scan_record', 'user_id', 'INTEGER'),
+        "DROP INDEX IF EXISTS ix_scan_record_sha256",
+        "CREATE INDEX IF NOT EXISTS ix_scan_record_sha256 ON scan_record (sha256)",
+        "CREATE INDEX IF NOT EXISTS ix_scan_record_user_id ON scan_record (user_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_scan_record_user_sha256 ON scan_record (user_id, sha256)",
+    ]),
+    # Dispensing is recorded by linking the prescription, not by the reason text
+    (9, [
+        add_column('inventory_log', 'prescription_id', 'INTEGER'),
+        "CREATE INDEX IF NOT EXISTS ix_inventory_log_prescription_id ON inventory_log (prescription_id)",
+        _link_dispensed_inventory_logs,
+        _rebuild_inventory_rollups,
+    ]),
+]
+
+def get_schema_version():
+    """
+    Read the schema version recorded by bootstrap_database
+
+    Returns:
+        int: The version, or None if the database was never bootstrapped
+    """
+    try:
+        row = db.session.query(SchemaVersion.version).first()
+    except (OperationalError, ProgrammingError):
+        # No schema_version table yet
+        db.session.rollback()
+        return None
+    return row[0] if row else None
+
+def check_schema_version():
+    """
+    Warn when the database schema is older than the code expects
+
+    A single query, meant to run when a worker starts.
+
+    Returns:
+        bool: Whether the schema is up to date
+    """
+    version = get_schema_version()
+    if version is None or version < SCHEMA_VERSION:
+        logging.warning(f"Database schema version {version} is behind {SCHEMA_VERSION}, run 'flask bootstrap-db'")
+        return False
+    return True
+
+def _set_schema_version(version):
+    row = SchemaVersion.query.first()
+    if row:
+        row.version = version
+    else:
+        db.session.add(SchemaVersion(id=1, version=version))
+    db.session.commit()
+
+def seed_default_roles():
+    """
+    Create the default roles that don't exist yet
+
+    Returns:
+        list: Names of the roles created
+    """
+    existing = {name for (name,) in db.session.query(Role.name).filter(Role.name.in_(DEFAULT_ROLES))}
+    missing = [name for name in DEFAULT_ROLES if name not in existing]
+    if not missing:
+        return []
+
+    db.session.add_all(Role(name=name) for name in missing)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another process seeded them at the same time
+        db.session.rollback()
+        return []
+    return missing
+
+def bootstrap_database():
+    """
+    Create or upgrade the schema and seed the default roles
+
+    Safe to run any number of times. When the recorded schema version is
+    current, only the default roles are checked.
+
+    Returns:
+        dict: 'from_version', 'to_version' and 'roles_created'
+    """
+    version = get_schema_version()
+    from_version = version
+
+    if version is None or version < SCHEMA_VERSION:
+        if version is None:
+            # Databases created before bootstrap-db existed are at version 1
+            existed = inspect(db.engine).has_table(User.__tablename__)
+            version = 1 if existed else SCHEMA_VERSION
+
+        # Adds any missing tables, existing ones are left alone
+        db.create_all()
+
+        for migration_version, statements in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logging.info(f"Migrating database schema to version {migration_version}")
+            for statement in statements:
+                if callable(statement):
+                    db.session.commit()
+                    statement()
+                else:
+                    db.session.execute(text(statement))
+            version = migration_version
+            _set_schema_version(version)
+
+        try:
+            _set_schema_version(SCHEMA_VERSION)
+        except IntegrityError:
+            db.session.rollback()
+        logging.info(f"Database schema at version {SCHEMA_VERSION}")
+
+    return {
+        'from_version': from_version,
+        'to_version': SCHEMA_VERSION,
+        'roles_created': seed_default_roles()
+    }
@@ -0,0 +1,281 @@
+import os
+import math
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import bindparam, case, func, insert, select, update
+
+from app import db
+from models import Medication, InventoryLog
+from utils.dosage import parse_quantity, medication_strength
+from utils.inventory_rollups import record_inventory_rollups
+from utils.low_stock import reorder_level, is_below, record_low_stock_change
+
+# Days of supply dispensed for a course without a duration
+DISPENSE_DEFAULT_DAYS = float(os.environ.get('DISPENSE_DEFAULT_DAYS', 30))
+
+# Prescriptions in these states can still be filled
+FILLABLE_STATUSES = ('pending', 'confirmed')
+
+def units_per_dose(dosage, strength=None):
+    """
+    Number of stock units (tablets, capsules, ...) taken in one dose
+
+    Args:
+        dosage (str): Dosage, e.g. "2 tablets", "400mg"
+        strength (Quantity, optional): Parsed medication strength
+
+    Returns:
+        float: Units per dose, 1 if it can't be worked out
+    """
+    dose = parse_quantity(dosage)
+    if dose is None:
+        return 1
+    if dose.dimension == 'count' or (dose.dimension is None and dose.unit):
+        # Tablets, capsules, or units the parser doesn't know such as sachets
+        return dose.value
+    if (strength is not None and strength.value and strength.dimension in ('mass', 'activity')
+            and (dose.dimension == strength.dimension or dose.unit is None)):
+        # "400mg" of a 200mg tablet, or a bare number in the strength's unit
+        return dose.value / strength.value
+    return 1
+
+def dispense_quantity(prescription_medication):
+    """
+    Number of stock units to dispense for a prescription line
+
+    Uses the line's quantity when it has one, otherwise the units per dose
+    times doses per day times the course length, or DISPENSE_DEFAULT_DAYS
+    for courses without a duration.
+
+    Args:
+        prescription_medication (PrescriptionMedication): Prescription line
+
+    Returns:
+        int: Units to dispense, at least 1
+    """
+    if prescription_medication.quantity:
+        return prescription_medication.quantity
+
+    strength = medication_strength(prescription_medication.medication)
+    units = (units_per_dose(prescription_medication.dosage, strength)
+             * (prescription_medication.doses_per_day or 1)
+             * (prescription_medication.course_days or DISPENSE_DEFAULT_DAYS))
+    # Round up, ignoring float noise such as 10.000000001
+    return max(1, math.ceil(round(units, 6)))
+
+def prescription_needs(prescription):
+    """
+    Stock a prescription needs, storing each line's quantity as it goes
+
+    Args:
+        prescription (Prescription): Prescription object
+
+    Returns:
+        dict: Units needed by medication ID
+    """
+    needs = defaultdict(int)
+    for pm in prescription.medications:
+        pm.quantity = dispense_quantity(pm)
+        needs[pm.medication_id] += pm.quantity
+    return dict(needs)
+
+def _medication_names(medication_ids):
+    rows = db.session.execute(select(Medication.id, Medication.name).where(Medication.id.in_(medication_ids)))
+    names = dict(rows.all())
+    return ', '.join(names.get(medication_id, f'#{medication_id}') for medication_id in sorted(medication_ids))
+
+def reserve_prescription(prescription):
+    """
+    Confirm a pending prescription, holding the stock it needs
+
+    Each medication's reserved quantity is raised by a conditional UPDATE
+    that only succeeds while enough unreserved stock is left, so two
+    confirmations can't hold the same units. The UPDATEs run in a savepoint,
+    so a shortage undoes them without losing the caller's other changes.
+
+    Args:
+        prescription (Prescription): Prescription object
+
+    Returns:
+        dict: 'success', and 'error' when it couldn't be confirmed
+    """
+    if prescription.status != 'pending':
+        return {'success': False, 'error': f'Prescription is {prescription.status}'}
+
+    try:
+        stock = func.coalesce(Medication.stock_quantity, 0)
+        reserved = func.coalesce(Medication.reserved_quantity, 0)
+        needs = prescription_needs(prescription)
+        short = []
+        savepoint = db.session.begin_nested()
+        for medication_id, quantity in needs.items():
+            result = db.session.execute(
+                update(Medication)
+                .where(Medication.id == medication_id, stock - reserved >= quantity)
+                .values(reserved_quantity=reserved + quantity)
+                .execution_options(synchronize_session=False)
+            )
+            if not result.rowcount:
+                short.append(medication_id)
+
+        if short:
+            savepoint.rollback()
+            return {'success': False, 'error': f'Insufficient stock for {_medication_names(short)}'}
+        savepoint.commit()
+
+        prescription.status = 'confirmed'
+        db.session.commit()
+        logging.info(f"Reserved stock for prescription {prescription.id}")
+        return {'success': True}
+
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error reserving stock for prescription: {str(e)}")
+        return {'success': False, 'error': str(e)}
+
+def cancel_prescription(prescription):
+    """
+    Cancel a prescription that hasn't been filled, releasing its reserved stock
+
+    Args:
+        prescription (Prescription): Prescription object
+
+    Returns:
+        dict: 'success', and 'error' when it couldn't be cancelled
+    """
+    if prescription.status not in FILLABLE_STATUSES:
+        return {'success': False, 'error': f'Prescription is {prescription.status}'}
+
+    try:
+        if prescription.status == 'confirmed':
+            reserved = func.coalesce(Medication.reserved_quantity, 0)
+            for medication_id, quantity in prescription_needs(prescription).items():
+                db.session.execute(
+                    update(Medication)
+                    .where(Medication.id == medication_id)
+                    .values(reserved_quantity=case((reserved >= quantity, reserved - quantity), else_=0))
+                    .execution_options(synchronize_session=False)
+                )
+
+        prescription.status = 'cancelled'
+        db.session.commit()
+        logging.info(f"Cancelled prescription {prescription.id}")
+        return {'success': True}
+
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error cancelling prescription: {str(e)}")
+        return {'success': False, 'error': str(e)}
+
+def fill_prescriptions(prescriptions, user_id=None):
+    """
+    Fill prescriptions, taking their stock in one batched inventory write
+
+    The stock of every medication involved is read once (locked on
+    databases that support it) and shared out between the prescriptions in
+    order. Confirmed prescriptions use their reservation; pending ones may
+    only take stock nobody has reserved. A prescription that can't be fully
+    supplied is reported and left as it is. The stock of all medications is
+    then decremented with one executemany UPDATE, the log entries and daily
+    rollups are written together and everything is committed once.
+
+    Args:
+        prescriptions (list): Prescription objects, in the order to serve them
+        user_id (int, optional): ID of the pharmacist filling them
+
+    Returns:
+        dict: 'filled' prescription IDs, 'failed' prescriptions with an
+            error, and 'error' if nothing could be committed
+    """
+    filled = []
+    failed = []
+
+    try:
+        candidates = []
+        for prescription in prescriptions:
+            if prescription.status not in FILLABLE_STATUSES:
+                failed.append({'prescription_id': prescription.id,
+                               'error': f'Prescription is {prescription.status}'})
+            else:
+                candidates.append(prescription)
+
+        needs = {prescription.id: prescription_needs(prescription) for prescription in candidates}
+        medication_ids = {medication_id for need in needs.values() for medication_id in need}
+        levels = {}
+        reorder_levels = {}
+        for medication_id, stock, reserved, level in db.session.execute(
+            select(Medication.id, Medication.stock_quantity, Medication.reserved_quantity, reorder_level())
+            .where(Medication.id.in_(medication_ids))
+            .with_for_update()
+        ):
+            levels[medication_id] = [stock or 0, reserved or 0]
+            reorder_levels[medication_id] = level
+
+        taken = defaultdict(lambda: [0, 0])  # stock and reservation used, by medication ID
+        log_rows = []
+        now = datetime.utcnow()
+        for prescription in candidates:
+            need = needs[prescription.id]
+            confirmed = prescription.status == 'confirmed'
+            short = [
+                medication_id for medication_id, quantity in need.items()
+                if medication_id not in levels
+                or levels[medication_id][0] - (0 if confirmed else levels[medication_id][1]) < quantity
+            ]
+            if short:
+                failed.append({'prescription_id': prescription.id,
+                               'error': f'Insufficient stock for {_medication_names(short)}'})
+                continue
+
+            for medication_id, quantity in need.items():
+                level = levels[medication_id]
+                released = min(quantity, level[1]) if confirmed else 0
+                level[0] -= quantity
+                level[1] -= released
+                taken[medication_id][0] += quantity
+                taken[medication_id][1] += released
+                log_rows.append({'medication_id': medication_id, 'quantity_change': -quantity,
+                                 'timestamp': now, 'recorded_by_id': user_id,
+                                 'prescription_id': prescription.id,
+                                 'reason': f'Prescription #{prescription.id} filled'})
+
+            # Moves the courses' intervals to the fill date through the Prescription hook
+            prescription.status = 'filled'
+            prescription.date_filled = now
+            filled.append(prescription.id)
+
+        if taken:
+            table = Medication.__table__
+            stock = func.coalesce(table.c.stock_quantity, 0)
+            reserved = func.coalesce(table.c.reserved_quantity, 0)
+            result = db.session.execute(
+                update(table)
+                .where(table.c.id == bindparam('medication_id'),
+                       stock >= bindparam('stock_taken'), reserved >= bindparam('reserved_taken'))
+                .values(stock_quantity=stock - bindparam('stock_taken'),
+                        reserved_quantity=reserved - bindparam('reserved_taken'),
+                        is_low_stock=stock - bindparam('stock_taken') < reorder_level(table.c)),
+                [{'medication_id': medication_id, 'stock_taken': stock_taken, 'reserved_taken': reserved_taken}
+                 for medication_id, (stock_taken, reserved_taken) in taken.items()]
+            )
+            if db.engine.dialect.supports_sane_multi_rowcount and result.rowcount != len(taken):
+                raise RuntimeError('Stock changed while filling, please try again')
+
+            for medication_id, (stock_taken, _) in taken.items():
+                new_stock = levels[medication_id][0]
+                level = reorder_levels[medication_id]
+                if is_below(new_stock, level) != is_below(new_stock + stock_taken, level):
+                    record_low_stock_change(medication_id, is_below(new_stock, level), new_stock, level)
+            db.session.execute(insert(InventoryLog), log_rows)
+            record_inventory_rollups(log_rows)
+
+        db.session.commit()
+        logging.info(f"Filled {len(filled)} prescriptions, {len(failed)} could not be filled")
+        return {'filled': filled, 'failed': failed}
+
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error filling prescriptions: {str(e)}")
+        return {'filled': [], 'failed': failed, 'error': str(e)}
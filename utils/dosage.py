@@ -1,6 +1,54 @@
 import logging
 import re
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from sqlalchemy import event, func, inspect, or_, select, true, update
+
+from app import db
+from models import Medication, Prescription, PrescriptionMedication, User
+from utils.dosing_rules import get_dosing_rules
+
+DOSAGE_PATTERN = re.compile(r"(\d+\.?\d*)\s*([a-z]+)")
+NUMBER_PATTERN = re.compile(r"(\d+\.?\d*)")
+
+# Amount, unit and optional "per volume" part, e.g. "250 mg / 5 ml" or "100 IU/ml"
+QUANTITY_PATTERN = re.compile(
+    r"(\d+(?:[.,]\d+)?|\.\d+)\s*([a-zµ]+)?"
+    r"(?:\s*(?:/|per)\s*(\d+(?:[.,]\d+)?)?\s*([a-z]+))?"
+)
+
+# How often a medication is taken, as doses per day. Intervals ("every 6
+# hours", "q8h") are turned into 24 / hours, using the shortest interval of a
+# range so the daily total is never underestimated.
+FREQUENCY_DOSES = [
+    (re.compile(r"\b(?:every|q\.?)\s*(\d+(?:\.\d+)?)\s*(?:(?:-|to)\s*\d+\s*)?(?:hours?|hrs?|h)\b"), None),
+    (re.compile(r"\b(?:four|4)\s+times\b|\bq\.?i\.?d\b"), 4),
+    (re.compile(r"\b(?:three|3)\s+times\b|\bt\.?i\.?d\b"), 3),
+    (re.compile(r"\b(?:twice|two times|2\s+times)\b|\bb\.?i\.?d\b"), 2),
+    (re.compile(r"\b(?:once|one time|daily|at bedtime)\b|\bq\.?d\b|\bo\.?d\b|\bq\.?h\.?s\b"), 1),
+]
+
+# Length of a course of treatment, e.g. "7 days", "for 2 weeks", "x 1 month"
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*(days?|d|weeks?|wks?|w|months?|mos?)\b")
+DURATION_DAYS = {'d': 1, 'day': 1, 'days': 1,
+                 'w': 7, 'wk': 7, 'wks': 7, 'week': 7, 'weeks': 7,
+                 'mo': 30, 'mos': 30, 'month': 30, 'months': 30}
+
+# Factors converting each unit to the canonical unit of its dimension
+MASS_UNITS = {'mcg': 0.001, 'µg': 0.001, 'ug': 0.001, 'mg': 1.0, 'g': 1000.0, 'gm': 1000.0, 'kg': 1000000.0}
+VOLUME_UNITS = {'ml': 1.0, 'cc': 1.0, 'l': 1000.0, 'tsp': 5.0, 'tbsp': 15.0}
+ACTIVITY_UNITS = {'iu': 1.0, 'u': 1.0, 'unit': 1.0, 'units': 1.0}
+COUNT_UNITS = {'tablet', 'tablets', 'tab', 'tabs', 'capsule', 'capsules', 'cap', 'caps',
+               'pill', 'pills', 'puff', 'puffs', 'drop', 'drops', 'patch', 'patches', 'dose', 'doses'}
+
+# Canonical unit of each dimension
+CANONICAL_UNITS = {'mass': 'mg', 'volume': 'ml', 'activity': 'iu', 'count': 'dose'}
+
+# A normalized amount: value in the canonical unit of its dimension. For
+# concentrations the unit is e.g. 'mg/ml' and dimension 'concentration'.
+Quantity = namedtuple('Quantity', ['value', 'unit', 'dimension'])
 
 def parse_dosage(dosage_str):
     """
@@ -16,16 +64,12 @@ def parse_dosage(dosage_str):
         # Remove whitespace and convert to lowercase
         dosage_str = dosage_str.strip().lower()
         
-        # Regular expression to extract numeric value and unit
-        match = re.match(r"(\d+\.?\d*)\s*([a-z]+)", dosage_str)
-        
+        match = DOSAGE_PATTERN.match(dosage_str)
         if match:
-            value = float(match.group(1))
-            unit = match.group(2)
-            return value, unit
+            return float(match.group(1)), match.group(2)
         
         # Try to extract just a number if no unit is specified
-        numeric_match = re.match(r"(\d+\.?\d*)", dosage_str)
+        numeric_match = NUMBER_PATTERN.match(dosage_str)
         if numeric_match:
             return float(numeric_match.group(1)), None
             
@@ -35,6 +79,170 @@ def parse_dosage(dosage_str):
         logging.error(f"Error parsing dosage: {str(e)}")
         return None, None
 
+def _unit_dimension(unit):
+    """Dimension of a unit and its factor to the canonical unit"""
+    for dimension, units in (('mass', MASS_UNITS), ('volume', VOLUME_UNITS), ('activity', ACTIVITY_UNITS)):
+        if unit in units:
+            return dimension, units[unit]
+    if unit in COUNT_UNITS:
+        return 'count', 1.0
+    return None, None
+
+@lru_cache(maxsize=4096)
+def parse_quantity(text):
+    """
+    Parse a dosage or strength into a quantity in canonical units
+    
+    Masses are converted to mg, volumes to ml, international units to IU and
+    tablets, capsules etc. to a number of doses. Strengths such as
+    "250mg/5ml" become concentrations in mg/ml.
+    
+    Args:
+        text (str): Dosage or strength, e.g. "0.5 g", "2 tablets", "125mg/5ml"
+        
+    Returns:
+        Quantity: The normalized quantity, or None if there is no number.
+            Unknown units keep their name and have a dimension of None.
+    """
+    if not text:
+        return None
+    match = QUANTITY_PATTERN.match(text.strip().lower())
+    if not match:
+        return None
+    
+    value_text, unit, per_value_text, per_unit = match.groups()
+    value = float(value_text.replace(',', '.'))
+    if not unit:
+        return Quantity(value, None, None)
+    
+    dimension, factor = _unit_dimension(unit)
+    if dimension is None:
+        return Quantity(value, unit, None)
+    value *= factor
+    
+    per_dimension, per_factor = _unit_dimension(per_unit) if per_unit else (None, None)
+    if per_dimension == 'volume' and dimension in ('mass', 'activity'):
+        per_value = float(per_value_text.replace(',', '.')) if per_value_text else 1.0
+        return Quantity(value / (per_value * per_factor), f"{CANONICAL_UNITS[dimension]}/ml", 'concentration')
+    
+    return Quantity(value, CANONICAL_UNITS[dimension], dimension)
+
+@lru_cache(maxsize=1024)
+def doses_per_day(frequency):
+    """
+    Work out how many doses a day a frequency means
+    
+    Args:
+        frequency (str): Frequency, e.g. "twice daily", "every 6 hours", "tid"
+        
+    Returns:
+        float: Doses per day, or None for unknown or "as needed" frequencies
+    """
+    if not frequency:
+        return None
+    frequency = frequency.lower()
+    for pattern, doses in FREQUENCY_DOSES:
+        match = pattern.search(frequency)
+        if match:
+            if doses is None:
+                hours = float(match.group(1))
+                return 24.0 / hours if hours else None
+            return float(doses)
+    return None
+
+@lru_cache(maxsize=1024)
+def course_days(duration):
+    """
+    Work out how many days a course of treatment lasts
+    
+    Args:
+        duration (str): Duration, e.g. "7 days", "2 weeks", "1 month"
+        
+    Returns:
+        float: Length of the course in days, or None if it isn't given
+    """
+    if not duration:
+        return None
+    match = DURATION_PATTERN.search(duration.lower())
+    if not match:
+        return None
+    return float(match.group(1)) * DURATION_DAYS[match.group(2)]
+
+def dose_schedule(dosage, frequency=None, duration=None, strength=None):
+    """
+    Parse how much of a medication is taken, how often and for how long
+    
+    Args:
+        dosage (str): Dosage, e.g. "400mg", "2 tablets"
+        frequency (str, optional): Frequency, e.g. "every 4 hours"
+        duration (str, optional): Duration, e.g. "7 days"
+        strength (str, optional): Medication strength, to convert tablets and volumes
+        
+    Returns:
+        dict: 'dose_mg', 'doses_per_day', 'course_days' and 'daily_mg',
+            each None when it can't be worked out
+    """
+    amount = dose_amount(parse_quantity(dosage), parse_quantity(strength))
+    dose_mg = amount.value if amount and amount.unit == 'mg' else None
+    per_day = doses_per_day(frequency)
+    return {
+        'dose_mg': dose_mg,
+        'doses_per_day': per_day,
+        'course_days': course_days(duration),
+        'daily_mg': dose_mg * per_day if dose_mg is not None and per_day else None
+    }
+
+# Parsed Medication.strength by medication ID, as (strength string, Quantity)
+_strength_cache = {}
+
+def medication_strength(medication):
+    """
+    Get a medication's parsed strength, parsing it only when it changes
+    
+    Args:
+        medication (Medication): Medication object
+        
+    Returns:
+        Quantity: The normalized strength, or None if it has none
+    """
+    if medication.id is None:
+        return parse_quantity(medication.strength)
+    
+    cached = _strength_cache.get(medication.id)
+    if cached is None or cached[0] != medication.strength:
+        cached = (medication.strength, parse_quantity(medication.strength))
+        _strength_cache[medication.id] = cached
+    return cached[1]
+
+def dose_amount(dose, strength=None):
+    """
+    Amount of drug in a dose, using the strength to convert doses given as
+    a number of tablets or a volume of liquid
+    
+    Args:
+        dose (Quantity): Parsed dosage
+        strength (Quantity, optional): Parsed medication strength
+        
+    Returns:
+        Quantity: The amount in mg or IU, or None if it can't be worked out
+    """
+    if dose is None:
+        return None
+    if dose.dimension in ('mass', 'activity'):
+        return dose
+    if strength is None:
+        return None
+    
+    if dose.dimension == 'count' and strength.dimension in ('mass', 'activity'):
+        return Quantity(dose.value * strength.value, strength.unit, strength.dimension)
+    if dose.dimension == 'volume' and strength.dimension == 'concentration':
+        unit = strength.unit.split('/')[0]
+        return Quantity(dose.value * strength.value, unit, 'mass' if unit == 'mg' else 'activity')
+    if dose.unit is None and strength.dimension in ('mass', 'activity'):
+        # A bare number is taken to be in the strength's unit
+        return Quantity(dose.value, strength.unit, strength.dimension)
+    return None
+
 def calculate_age(birth_date):
     """
     Calculate age from birth date
@@ -57,7 +265,7 @@ def calculate_age(birth_date):
         
     return age
 
-def verify_dosage(medication, dosage_str, weight=None, age=None):
+def verify_dosage(medication, dosage_str, weight=None, age=None, doses_per_day=None, daily_total_mg=None):
     """
     Verify if the dosage is appropriate based on patient information
     
@@ -66,6 +274,10 @@ def verify_dosage(medication, dosage_str, weight=None, age=None):
         dosage_str (str): Dosage string (e.g., "10mg", "5 ml")
         weight (float, optional): Patient weight in kg
         age (int, optional): Patient age in years
+        doses_per_day (float, optional): Doses taken a day, for daily maxima
+        daily_total_mg (float, optional): Total mg a day of the same drug
+            across the patient's active prescriptions, checked against the
+            daily maxima instead of this dose alone
         
     Returns:
         dict: Results of dosage verification
@@ -77,66 +289,39 @@ def verify_dosage(medication, dosage_str, weight=None, age=None):
     }
     
     try:
-        # Parse the dosage
-        dosage_value, dosage_unit = parse_dosage(dosage_str)
+        # Parse the dosage and the (cached) medication strength
+        dose = parse_quantity(dosage_str)
         
-        if not dosage_value:
+        if not dose or not dose.value:
             result['is_appropriate'] = False
             result['warnings'].append("Unable to parse dosage value")
             return result
             
-        # Get medication strength for comparison
-        strength_value, strength_unit = parse_dosage(medication.strength)
-        
-        # If units don't match, we might need to convert
-        if dosage_unit and strength_unit and dosage_unit != strength_unit:
-            result['warnings'].append(f"Dosage unit ({dosage_unit}) doesn't match medication strength unit ({strength_unit})")
-        
-        # Check for weight-based dosing if weight is provided
-        if weight:
-            # Example logic for common medications
-            if "ibuprofen" in medication.name.lower():
-                # Typical dosage 5-10 mg/kg every 6-8 hours
-                max_daily_dose_per_kg = 40  # mg/kg/day
-                if (dosage_unit == "mg" or strength_unit == "mg") and dosage_value > (weight * max_daily_dose_per_kg / 4):
-                    result['is_appropriate'] = False
-                    result['warnings'].append(f"Dosage exceeds maximum recommended dose for weight ({weight} kg)")
-                    result['recommendations'].append(f"Maximum recommended dose: {weight * 10} mg per dose")
-            
-            elif "acetaminophen" in medication.name.lower() or "paracetamol" in medication.generic_name.lower():
-                # Typically 10-15 mg/kg every 4-6 hours
-                max_daily_dose_per_kg = 75  # mg/kg/day
-                if (dosage_unit == "mg" or strength_unit == "mg") and dosage_value > (weight * max_daily_dose_per_kg / 5):
-                    result['is_appropriate'] = False
-                    result['warnings'].append(f"Dosage exceeds maximum recommended dose for weight ({weight} kg)")
-                    result['recommendations'].append(f"Maximum recommended dose: {weight * 15} mg per dose")
-        
-        # Check age-specific considerations
-        if age is not None:
-            # Pediatric considerations
-            if age < 12:
-                if "aspirin" in medication.name.lower():
+        strength = medication_strength(medication)
+        amount = dose_amount(dose, strength)
+        
+        # Only warn when the units can't be converted into each other
+        if amount is None and strength and dose.unit and strength.unit:
+            result['warnings'].append(f"Dosage unit ({dose.unit}) doesn't match medication strength unit ({strength.unit})")
+        
+        # Amount of drug per dose in mg, when known
+        dose_mg = amount.value if amount and amount.unit == 'mg' else None
+        
+        # Medication-specific limits from the dosing rule table
+        for rule in get_dosing_rules().rules_for(medication):
+            broken = rule.evaluate(dose_mg, weight=weight, age=age, doses_per_day=doses_per_day,
+                                   daily_mg=daily_total_mg)
+            if broken:
+                if broken['flag']:
                     result['is_appropriate'] = False
-                    result['warnings'].append("Aspirin is not recommended for children under 12 due to risk of Reye's syndrome")
-                
-                elif "ibuprofen" in medication.name.lower() and age < 6:
-                    # Check if dose is appropriate for children
-                    if dosage_value > 100 and (dosage_unit == "mg" or strength_unit == "mg"):
-                        result['is_appropriate'] = False
-                        result['warnings'].append(f"Dosage may be too high for a {age}-year-old child")
-            
-            # Geriatric considerations            
-            elif age > 65:
-                # Elderly often need lower doses
-                if "warfarin" in medication.name.lower():
-                    if dosage_value > 5 and (dosage_unit == "mg" or strength_unit == "mg"):
-                        result['warnings'].append("Elderly patients may require lower warfarin doses")
-                        result['recommendations'].append("Consider starting with a lower dose and monitoring closely")
+                result['warnings'].append(broken['warning'])
+                if broken['recommendation']:
+                    result['recommendations'].append(broken['recommendation'])
         
         # General high-dose warnings
-        if strength_value and strength_unit == dosage_unit:
-            if dosage_value > 4 * strength_value:
-                result['warnings'].append(f"Dosage ({dosage_value} {dosage_unit}) is more than 4x the standard strength ({strength_value} {strength_unit})")
+        if amount and strength and amount.unit == strength.unit:
+            if amount.value > 4 * strength.value:
+                result['warnings'].append(f"Dosage ({amount.value:g} {amount.unit}) is more than 4x the standard strength ({strength.value:g} {strength.unit})")
                 result['is_appropriate'] = False
         
         return result
@@ -149,3 +334,294 @@ def verify_dosage(medication, dosage_str, weight=None, age=None):
             'warnings': ["Error occurred during dosage verification"],
             'recommendations': ["Verify dosage manually"]
         }
+
+def patient_dosing_context(patient):
+    """
+    Get the patient details dosage checks use
+    
+    Args:
+        patient (User): Patient, or None
+        
+    Returns:
+        tuple: (weight in kg, age in years), either of which may be None
+    """
+    if patient is None:
+        return None, None
+    age = calculate_age(patient.date_of_birth) if patient.date_of_birth else None
+    return patient.weight, age
+
+def medication_key(medication):
+    """Lowercased generic name (or name) grouping the same drug across products"""
+    return (medication.generic_name or medication.name or '').strip().lower()
+
+def active_daily_totals(patient_ids, at=None):
+    """
+    Total mg a day each patient takes of each drug, from their active prescriptions
+    
+    Uses the daily_mg stored on each prescription line, so no dosage text is
+    parsed again. Prescriptions count until cancelled or until their course
+    ends.
+    
+    Args:
+        patient_ids (iterable): Patient user IDs, or None for every patient
+        at (datetime, optional): Time the prescriptions must be active at
+        
+    Returns:
+        dict: (patient ID, prescription ID, drug key) mapped to mg a day
+    """
+    if patient_ids is not None:
+        patient_ids = list(patient_ids)
+        if not patient_ids:
+            return {}
+    at = at or datetime.utcnow()
+    drug = func.lower(func.trim(func.coalesce(func.nullif(Medication.generic_name, ''), Medication.name)))
+    rows = (db.session.query(Prescription.user_id, PrescriptionMedication.prescription_id, drug,
+                             func.sum(PrescriptionMedication.daily_mg))
+            .join(Prescription, PrescriptionMedication.prescription_id == Prescription.id)
+            .join(Medication, PrescriptionMedication.medication_id == Medication.id)
+            .filter(Prescription.user_id.in_(patient_ids) if patient_ids is not None else true(),
+                    Prescription.status != 'cancelled',
+                    PrescriptionMedication.daily_mg.isnot(None),
+                    or_(PrescriptionMedication.ends_at.is_(None), PrescriptionMedication.ends_at >= at))
+            .group_by(Prescription.user_id, PrescriptionMedication.prescription_id, drug)
+            .all())
+    return {(user_id, prescription_id, key): total for user_id, prescription_id, key, total in rows}
+
+def patient_daily_totals(totals, patient_id, exclude_prescription_id=None):
+    """
+    Add up one patient's daily totals per drug
+    
+    Args:
+        totals (dict): Result of active_daily_totals
+        patient_id (int): Patient user ID
+        exclude_prescription_id (int, optional): Prescription to leave out,
+            usually the one being checked
+        
+    Returns:
+        dict: Drug key mapped to mg a day
+    """
+    others = {}
+    for (user_id, other_id, key), total in totals.items():
+        if user_id == patient_id and other_id != exclude_prescription_id:
+            others[key] = others.get(key, 0.0) + total
+    return others
+
+def verify_dosage_lines(lines, weight=None, age=None, daily_totals=None):
+    """
+    Verify the dosage of every line of a prescription in one go
+    
+    Medications that aren't already loaded are fetched with a single query.
+    Daily maxima are checked against the total of each drug over all the
+    lines plus what the patient already takes.
+    
+    Args:
+        lines (list): Dicts with 'medication' (Medication) or 'medication_id',
+            'dosage' and optionally 'frequency' and 'duration'
+        weight (float, optional): Patient weight in kg
+        age (int, optional): Patient age in years
+        daily_totals (dict, optional): Drug key mapped to mg a day the patient
+            already takes under other prescriptions
+        
+    Returns:
+        list: One verify_dosage result per line, in the same order, with the
+            line's 'medication_id', 'dosage', 'frequency', 'doses_per_day',
+            'course_days', 'daily_mg' and 'daily_total_mg'
+    """
+    # JSON clients may send IDs as strings; None marks one that isn't a number
+    line_ids = []
+    for line in lines:
+        try:
+            line_ids.append(int(line['medication_id']) if line.get('medication_id') is not None else None)
+        except (TypeError, ValueError):
+            line_ids.append(None)
+    
+    missing_ids = {medication_id for line, medication_id in zip(lines, line_ids)
+                   if line.get('medication') is None and medication_id is not None}
+    medications = {}
+    if missing_ids:
+        medications = {med.id: med for med in Medication.query.filter(Medication.id.in_(missing_ids)).all()}
+    
+    # Work out every line's schedule first, so lines of the same drug add up
+    parsed = []
+    totals = dict(daily_totals or {})
+    for line, medication_id in zip(lines, line_ids):
+        medication = line.get('medication')
+        if medication is None:
+            medication = medications.get(medication_id)
+        schedule = dose_schedule(line.get('dosage'), line.get('frequency'), line.get('duration'),
+                                 medication.strength if medication is not None else None)
+        if medication is not None and schedule['daily_mg'] is not None:
+            key = medication_key(medication)
+            totals[key] = totals.get(key, 0.0) + schedule['daily_mg']
+        parsed.append((line, medication_id, medication, schedule))
+    
+    results = []
+    for line, medication_id, medication, schedule in parsed:
+        dosage = line.get('dosage')
+        daily_total = totals.get(medication_key(medication)) if medication is not None else None
+        
+        if medication is None and line.get('medication_id') is not None and medication_id is None:
+            result = {
+                'error': 'Invalid medication ID',
+                'is_appropriate': False,
+                'warnings': ["Invalid medication ID"],
+                'recommendations': []
+            }
+        elif medication is None:
+            result = {
+                'error': 'Medication not found',
+                'is_appropriate': False,
+                'warnings': ["Medication not found"],
+                'recommendations': []
+            }
+        elif not dosage:
+            result = {
+                'is_appropriate': False,
+                'warnings': ["No dosage given"],
+                'recommendations': []
+            }
+        else:
+            result = verify_dosage(medication, dosage, weight, age,
+                                   doses_per_day=schedule['doses_per_day'], daily_total_mg=daily_total)
+            if daily_total is not None and schedule['daily_mg'] is not None and daily_total > schedule['daily_mg']:
+                result['recommendations'].append(
+                    f"Daily total ({daily_total:g} mg) includes other prescribed doses of the same drug"
+                )
+        
+        result.update({
+            'medication_id': medication.id if medication is not None else (medication_id if medication_id is not None else line.get('medication_id')),
+            'medication_name': medication.name if medication is not None else None,
+            'dosage': dosage,
+            'frequency': line.get('frequency'),
+            'doses_per_day': schedule['doses_per_day'],
+            'course_days': schedule['course_days'],
+            'daily_mg': schedule['daily_mg'],
+            'daily_total_mg': daily_total
+        })
+        results.append(result)
+    return results
+
+def verify_prescription_dosages(prescriptions):
+    """
+    Verify every medication of one or more stored prescriptions
+    
+    Each patient's weight, age and daily totals from their other active
+    prescriptions are looked up once, however many of their prescriptions
+    are checked.
+    
+    Args:
+        prescriptions (list): Prescription objects
+        
+    Returns:
+        dict: Prescription ID mapped to its verify_dosage_lines results, with
+            'prescription_medication_id' added to each
+    """
+    patient_ids = {prescription.user_id for prescription in prescriptions}
+    patients = {}
+    if patient_ids:
+        patients = {user.id: user for user in User.query.filter(User.id.in_(patient_ids)).all()}
+    contexts = {user_id: patient_dosing_context(patients.get(user_id)) for user_id in patient_ids}
+    totals = active_daily_totals(patient_ids)
+    
+    results = {}
+    for prescription in prescriptions:
+        weight, age = contexts[prescription.user_id]
+        lines = [{
+            'medication': pm.medication,
+            'medication_id': pm.medication_id,
+            'dosage': pm.dosage,
+            'frequency': pm.frequency,
+            'duration': pm.duration
+        } for pm in prescription.medications]
+        others = patient_daily_totals(totals, prescription.user_id, prescription.id)
+        checked = verify_dosage_lines(lines, weight, age, daily_totals=others)
+        for pm, result in zip(prescription.medications, checked):
+            result['prescription_medication_id'] = pm.id
+        results[prescription.id] = checked
+    return results
+
+@event.listens_for(PrescriptionMedication, 'before_insert')
+@event.listens_for(PrescriptionMedication, 'before_update')
+def _store_dose_schedule(mapper, connection, target):
+    """Keep the parsed schedule columns in step with the free-text fields"""
+    strength = connection.execute(
+        select(Medication.strength).where(Medication.id == target.medication_id)
+    ).scalar()
+    dates = connection.execute(
+        select(Prescription.date_prescribed, Prescription.date_filled)
+        .where(Prescription.id == target.prescription_id)
+    ).first()
+    
+    schedule = dose_schedule(target.dosage, target.frequency, target.duration, strength)
+    target.doses_per_day = schedule['doses_per_day']
+    target.course_days = schedule['course_days']
+    target.daily_mg = schedule['daily_mg']
+    target.starts_at, target.ends_at = course_interval(*(dates or (None, None)), schedule['course_days'])
+
+def course_interval(prescribed, filled, days):
+    """
+    When a course of treatment is taken
+    
+    Args:
+        prescribed (datetime): When the prescription was written
+        filled (datetime): When it was filled, or None
+        days (float): Length of the course, or None if open-ended
+        
+    Returns:
+        tuple: (start, end), end being None for open-ended courses
+    """
+    start = filled or prescribed or datetime.utcnow()
+    return start, start + timedelta(days=days) if days else None
+
+@event.listens_for(Prescription, 'after_update')
+def _move_course_intervals(mapper, connection, target):
+    """Courses start when a prescription is filled, so move them when it is"""
+    history = inspect(target).attrs
+    if not (history.date_filled.history.has_changes() or history.date_prescribed.history.has_changes()):
+        return
+    
+    rows = connection.execute(
+        select(PrescriptionMedication.id, PrescriptionMedication.course_days)
+        .where(PrescriptionMedication.prescription_id == target.id)
+    ).all()
+    for row_id, days in rows:
+        starts_at, ends_at = course_interval(target.date_prescribed, target.date_filled, days)
+        connection.execute(
+            update(PrescriptionMedication.__table__)
+            .where(PrescriptionMedication.__table__.c.id == row_id)
+            .values(starts_at=starts_at, ends_at=ends_at)
+        )
+
+def backfill_dose_schedules():
+    """
+    Fill in the parsed schedule columns of prescription lines saved before they existed
+    
+    Returns:
+        int: Number of lines updated
+    """
+    rows = (db.session.query(PrescriptionMedication.id, PrescriptionMedication.dosage,
+                             PrescriptionMedication.frequency, PrescriptionMedication.duration,
+                             Medication.strength, Prescription.date_prescribed, Prescription.date_filled)
+            .join(Medication, PrescriptionMedication.medication_id == Medication.id)
+            .join(Prescription, PrescriptionMedication.prescription_id == Prescription.id)
+            .filter(PrescriptionMedication.starts_at.is_(None))
+            .all())
+    
+    updates = []
+    for row_id, dosage, frequency, duration, strength, prescribed, filled in rows:
+        schedule = dose_schedule(dosage, frequency, duration, strength)
+        starts_at, ends_at = course_interval(prescribed, filled, schedule['course_days'])
+        updates.append({
+            'id': row_id,
+            'doses_per_day': schedule['doses_per_day'],
+            'course_days': schedule['course_days'],
+            'daily_mg': schedule['daily_mg'],
+            'starts_at': starts_at,
+            'ends_at': ends_at
+        })
+    
+    if updates:
+        db.session.execute(update(PrescriptionMedication), updates)
+        db.session.commit()
+    logging.info(f"Filled in dose schedules of {len(updates)} prescription lines")
+    return len(updates)
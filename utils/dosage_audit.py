@@ -0,0 +1,434 @@
+import csv
+import logging
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+
+from app import db
+from models import Medication, Prescription, PrescriptionMedication, User
+from utils.dosage import active_daily_totals, doses_per_day, medication_key, parse_quantity
+from utils.dosing_rules import get_dosing_rules
+
+# Rows fetched from the database at a time while loading an audit
+AUDIT_BATCH_SIZE = 10000
+
+# Dimensions of parsed quantities, as small integers for the arrays. Bare
+# numbers have NO_DIMENSION, units that aren't recognized UNKNOWN_UNIT.
+(NO_DIMENSION, MASS, ACTIVITY, VOLUME, COUNT, MASS_CONCENTRATION, ACTIVITY_CONCENTRATION,
+ UNKNOWN_UNIT) = range(8)
+DIMENSION_CODES = {'mass': MASS, 'activity': ACTIVITY, 'volume': VOLUME, 'count': COUNT}
+
+AUDIT_CSV_FIELDS = ['prescription_medication_id', 'prescription_id', 'medication_id', 'medication',
+                    'dosage', 'frequency', 'strength', 'weight', 'age', 'dose_mg', 'daily_mg',
+                    'daily_total_mg', 'is_appropriate', 'reasons']
+
+# Stand-in with the attributes DosingRuleIndex.rules_for looks at
+_MedicationKey = namedtuple('_MedicationKey', ['id', 'name', 'generic_name'])
+
+
+class _Factorizer:
+    """Gives each distinct value a small integer code"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class DosageAuditColumns:
+    """Prescription medication rows held as columns
+
+    Text columns (dosage, frequency, strength) and birth dates are stored as
+    codes into lists of their distinct values, so each distinct value only
+    has to be parsed once however many rows share it.
+    """
+
+    def __init__(self, ids, prescription_ids, patient_ids, medication_ids, dosage_codes, frequency_codes,
+                 strength_codes, birth_date_codes, weights, dosages, frequencies, strengths,
+                 birth_dates, medications):
+        self.ids = ids
+        self.prescription_ids = prescription_ids
+        # -1 where the prescription has no patient
+        self.patient_ids = patient_ids
+        self.medication_ids = medication_ids
+        self.dosage_codes = dosage_codes
+        self.frequency_codes = frequency_codes
+        self.strength_codes = strength_codes
+        self.birth_date_codes = birth_date_codes
+        self.weights = weights
+        self.dosages = dosages
+        self.frequencies = frequencies
+        self.strengths = strengths
+        self.birth_dates = birth_dates
+        # Medication ID mapped to (name, generic name)
+        self.medications = medications
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build the columns from row tuples
+
+        Args:
+            rows (iterable): (prescription_medication_id, prescription_id,
+                patient_id, medication_id, dosage, frequency, strength, name,
+                generic_name, weight, date_of_birth) tuples
+
+        Returns:
+            DosageAuditColumns: The rows as columns
+        """
+        dosages, frequencies, strengths, birth_dates = _Factorizer(), _Factorizer(), _Factorizer(), _Factorizer()
+        medications = {}
+        ids, prescription_ids, patient_ids, medication_ids = [], [], [], []
+        dosage_codes, frequency_codes, strength_codes, birth_date_codes, weights = [], [], [], [], []
+
+        for (row_id, prescription_id, patient_id, medication_id, dosage, frequency, strength,
+             name, generic_name, weight, date_of_birth) in rows:
+            ids.append(row_id)
+            prescription_ids.append(prescription_id)
+            patient_ids.append(patient_id if patient_id is not None else -1)
+            medication_ids.append(medication_id)
+            if medication_id not in medications:
+                medications[medication_id] = (name, generic_name)
+            dosage_codes.append(dosages.code(dosage))
+            frequency_codes.append(frequencies.code(frequency))
+            strength_codes.append(strengths.code(strength))
+            birth_date_codes.append(birth_dates.code(date_of_birth))
+            weights.append(weight if weight is not None else np.nan)
+
+        return cls(
+            ids=np.array(ids, dtype=np.int64),
+            prescription_ids=np.array(prescription_ids, dtype=np.int64),
+            patient_ids=np.array(patient_ids, dtype=np.int64),
+            medication_ids=np.array(medication_ids, dtype=np.int64),
+            dosage_codes=np.array(dosage_codes, dtype=np.int32),
+            frequency_codes=np.array(frequency_codes, dtype=np.int32),
+            strength_codes=np.array(strength_codes, dtype=np.int32),
+            birth_date_codes=np.array(birth_date_codes, dtype=np.int32),
+            weights=np.array(weights, dtype=np.float64),
+            dosages=dosages.values,
+            frequencies=frequencies.values,
+            strengths=strengths.values,
+            birth_dates=birth_dates.values,
+            medications=medications
+        )
+
+
+def load_audit_columns(batch_size=AUDIT_BATCH_SIZE):
+    """
+    Load every prescription medication, with its strength and patient, as columns
+
+    Args:
+        batch_size (int): Rows fetched from the database at a time
+
+    Returns:
+        DosageAuditColumns: All prescription medication rows
+    """
+    query = (db.session.query(PrescriptionMedication.id, PrescriptionMedication.prescription_id,
+                              Prescription.user_id, PrescriptionMedication.medication_id, PrescriptionMedication.dosage,
+                              PrescriptionMedication.frequency, Medication.strength, Medication.name,
+                              Medication.generic_name, User.weight, User.date_of_birth)
+             .join(Medication, PrescriptionMedication.medication_id == Medication.id)
+             .join(Prescription, PrescriptionMedication.prescription_id == Prescription.id)
+             .outerjoin(User, Prescription.user_id == User.id)
+             .order_by(PrescriptionMedication.id)
+             .execution_options(yield_per=batch_size))
+    return DosageAuditColumns.from_rows(query)
+
+
+def _quantity_arrays(texts):
+    """Values and dimension codes of each distinct dosage or strength"""
+    values = np.full(len(texts), np.nan)
+    dimensions = np.zeros(len(texts), dtype=np.int8)
+    for i, text in enumerate(texts):
+        quantity = parse_quantity(text) if text else None
+        if quantity is None:
+            continue
+        values[i] = quantity.value
+        if quantity.dimension == 'concentration':
+            dimensions[i] = MASS_CONCENTRATION if quantity.unit.startswith('mg') else ACTIVITY_CONCENTRATION
+        elif quantity.unit is None:
+            dimensions[i] = NO_DIMENSION
+        else:
+            dimensions[i] = DIMENSION_CODES.get(quantity.dimension, UNKNOWN_UNIT)
+    return values, dimensions
+
+
+def _dose_amounts(dose, dose_dimension, strength, strength_dimension):
+    """Vectorized utils.dosage.dose_amount: drug per dose and whether it's mg or IU"""
+    amount = np.full(dose.shape, np.nan)
+    amount_dimension = np.zeros(dose.shape, dtype=np.int8)
+
+    direct = (dose_dimension == MASS) | (dose_dimension == ACTIVITY)
+    amount[direct] = dose[direct]
+    amount_dimension[direct] = dose_dimension[direct]
+
+    # Tablets etc. and bare numbers are in terms of the strength
+    strength_amount = (strength_dimension == MASS) | (strength_dimension == ACTIVITY)
+    counted = (dose_dimension == COUNT) & strength_amount
+    amount[counted] = dose[counted] * strength[counted]
+    amount_dimension[counted] = strength_dimension[counted]
+    bare = (dose_dimension == NO_DIMENSION) & strength_amount & ~np.isnan(dose)
+    amount[bare] = dose[bare]
+    amount_dimension[bare] = strength_dimension[bare]
+
+    # Volumes of liquids are converted with their concentration
+    for concentration, dimension in ((MASS_CONCENTRATION, MASS), (ACTIVITY_CONCENTRATION, ACTIVITY)):
+        liquid = (dose_dimension == VOLUME) & (strength_dimension == concentration)
+        amount[liquid] = dose[liquid] * strength[liquid]
+        amount_dimension[liquid] = dimension
+
+    return amount, amount_dimension
+
+
+def _daily_totals(columns, daily_mg, daily_totals):
+    """Vectorized daily_total_mg of utils.dosage.verify_dosage_lines
+
+    Each row's total is the daily mg of every row of the same drug in its
+    prescription, plus what the patient takes of the drug under their other
+    active prescriptions. NaN where neither is known.
+    """
+    # Drug key of each medication, as a lookup table by medication ID
+    drug_keys = _Factorizer()
+    largest_id = int(columns.medication_ids.max()) if len(columns) else 0
+    drug_codes = np.zeros(largest_id + 1, dtype=np.int64)
+    for medication_id, (name, generic_name) in columns.medications.items():
+        drug_codes[medication_id] = drug_keys.code(medication_key(_MedicationKey(medication_id, name, generic_name)))
+    drugs = drug_codes[columns.medication_ids]
+
+    # Rows of the same drug in the same prescription add up
+    groups, first_rows, positions = np.unique(columns.prescription_ids * max(len(drug_keys.values), 1) + drugs,
+                                              return_index=True, return_inverse=True)
+    positions = positions.reshape(-1)
+    known = ~np.isnan(daily_mg)
+    group_totals = np.bincount(positions, weights=np.where(known, daily_mg, 0.0), minlength=len(groups))
+    group_known = np.bincount(positions, weights=known, minlength=len(groups)) > 0
+
+    # Other prescriptions' totals by patient and drug, in the order
+    # patient_daily_totals adds them up
+    prescribed = {}
+    for (patient_id, prescription_id, key), total in daily_totals.items():
+        prescribed.setdefault((patient_id, key), []).append((prescription_id, total))
+    for group, row in enumerate(first_rows.tolist()):
+        key = drug_keys.values[drugs[row]]
+        others = [total for prescription_id, total in prescribed.get((int(columns.patient_ids[row]), key), ())
+                  if prescription_id != columns.prescription_ids[row]]
+        if others:
+            group_totals[group] += sum(others, 0.0)
+            group_known[group] = True
+
+    return np.where(group_known, group_totals, np.nan)[positions]
+
+
+def _rule_label(rule):
+    if rule.check == 'contraindicated':
+        label = "contraindicated"
+    elif rule.check == 'mg_per_kg_dose':
+        label = f"dose > {rule.limit:g} mg/kg"
+    elif rule.check == 'daily_dose':
+        label = f"daily dose > {rule.limit:g} mg"
+    else:
+        label = f"dose > {rule.limit:g} mg"
+    if rule.age_below is not None:
+        label += f" (age < {rule.age_below:g})"
+    if rule.age_above is not None:
+        label += f" (age > {rule.age_above:g})"
+    return label
+
+
+def audit_dosage_columns(columns, rules=None, today=None, daily_totals=None):
+    """
+    Check every row against the dosing rules with vectorized comparisons
+
+    Makes the same checks as verify_prescription_dosages: the dosing rule
+    table, the 4x-strength limit, mismatched units and unparseable dosages.
+    Daily maxima are checked against the patient's total of each drug over
+    the prescription and their other active prescriptions, and an
+    unparseable dosage isn't checked any further.
+
+    Args:
+        columns (DosageAuditColumns): Rows to audit
+        rules (DosingRuleIndex, optional): Rules to apply, the loaded table by default
+        today (date, optional): Date ages are worked out at
+        daily_totals (dict, optional): Result of active_daily_totals, loaded
+            for every patient by default
+
+    Returns:
+        dict: 'rows' (count), 'flagged' (row positions breaking at least one
+            rule), 'is_appropriate', 'reasons' (one entry per flagged row),
+            'dose_mg', 'daily_mg', 'daily_total_mg' and 'ages' (one entry per
+            row, NaN if unknown)
+    """
+    rules = rules or get_dosing_rules()
+    today = today or date.today()
+    if daily_totals is None:
+        daily_totals = active_daily_totals(None)
+    count = len(columns)
+
+    # Parse each distinct value once, then spread the results over the rows
+    dose_values, dose_dimensions = _quantity_arrays(columns.dosages)
+    strength_values, strength_dimensions = _quantity_arrays(columns.strengths)
+    daily_doses = np.array([doses_per_day(frequency) or np.nan for frequency in columns.frequencies], dtype=np.float64)
+    birth_ages = np.array([_age_on(birth_date, today) for birth_date in columns.birth_dates], dtype=np.float64)
+
+    dose = dose_values[columns.dosage_codes]
+    dose_dimension = dose_dimensions[columns.dosage_codes]
+    strength = strength_values[columns.strength_codes]
+    strength_dimension = strength_dimensions[columns.strength_codes]
+    amount, amount_dimension = _dose_amounts(dose, dose_dimension, strength, strength_dimension)
+    dose_mg = np.where(amount_dimension == MASS, amount, np.nan)
+    daily_mg = dose_mg * daily_doses[columns.frequency_codes]
+    daily_total_mg = _daily_totals(columns, daily_mg, daily_totals)
+    ages = birth_ages[columns.birth_date_codes]
+    weights = columns.weights
+
+    checks = []
+    with np.errstate(invalid='ignore'):
+        # verify_dosage stops at an unparseable dosage, so nothing else is checked
+        unparseable = np.isnan(dose) | (dose == 0)
+        parsed = ~unparseable
+        checks.append(("unparseable dosage", unparseable, True))
+        checks.append(("dosage unit doesn't match strength",
+                       parsed & np.isnan(amount) & (dose_dimension != NO_DIMENSION)
+                       & ~np.isnan(strength) & (strength_dimension != NO_DIMENSION), False))
+        checks.append(("dose > 4x strength",
+                       parsed & ((amount_dimension == MASS) | (amount_dimension == ACTIVITY))
+                       & (amount_dimension == strength_dimension)
+                       & (amount > 4 * strength), True))
+
+        # The total over the patient's prescriptions where known, otherwise this dose's
+        daily = np.where(np.isnan(daily_total_mg), daily_mg, daily_total_mg)
+
+        # Group medications by the rules that apply to them
+        medication_codes = {}
+        for medication_id, (name, generic_name) in columns.medications.items():
+            for rule in rules.rules_for(_MedicationKey(medication_id, name, generic_name)):
+                medication_codes.setdefault(id(rule), (rule, []))[1].append(medication_id)
+
+        largest_id = int(columns.medication_ids.max()) if count else 0
+        for rule, medication_ids in medication_codes.values():
+            # A lookup table by medication ID is cheaper than np.isin
+            has_rule = np.zeros(largest_id + 1, dtype=bool)
+            has_rule[medication_ids] = True
+            applies = has_rule[columns.medication_ids] & parsed
+            if rule.age_below is not None:
+                applies &= ages < rule.age_below
+            if rule.age_above is not None:
+                applies &= ages > rule.age_above
+
+            if rule.check == 'contraindicated':
+                broken = applies
+            elif rule.check == 'mg_per_kg_dose':
+                broken = applies & (weights > 0) & (dose_mg > weights * rule.limit)
+            elif rule.check == 'daily_dose':
+                broken = applies & ~np.isnan(dose_mg) & (daily > rule.limit)
+            else:
+                broken = applies & (dose_mg > rule.limit)
+            checks.append((_rule_label(rule), broken, rule.flag))
+
+    inappropriate = np.zeros(count, dtype=bool)
+    for _, broken, flag in checks:
+        if flag:
+            inappropriate |= broken
+
+    # Each row's broken checks as a bitmask (63 checks to a word), so reasons
+    # are only put into words once per distinct combination
+    checks = [check for check in checks if check[1].any()]
+    bits = np.zeros((count, len(checks) // 63 + 1), dtype=np.int64)
+    for bit, (_, broken, _) in enumerate(checks):
+        bits[:, bit // 63] |= broken.astype(np.int64) << (bit % 63)
+
+    flagged = np.flatnonzero(bits.any(axis=1))
+    if bits.shape[1] == 1:
+        combinations, positions = np.unique(bits[flagged, 0], return_inverse=True)
+        combinations = combinations[:, None]
+    else:
+        combinations, positions = np.unique(bits[flagged], axis=0, return_inverse=True)
+    wording = np.array(['; '.join(label for bit, (label, _, _) in enumerate(checks)
+                                  if combination[bit // 63] >> (bit % 63) & 1)
+                        for combination in combinations.tolist()] + [''], dtype=object)
+
+    return {
+        'rows': count,
+        'flagged': flagged,
+        'is_appropriate': ~inappropriate[flagged],
+        'reasons': wording[positions.reshape(-1)],
+        'dose_mg': dose_mg,
+        'daily_mg': daily_mg,
+        'daily_total_mg': daily_total_mg,
+        'ages': ages
+    }
+
+
+def _age_on(birth_date, today):
+    if birth_date is None:
+        return np.nan
+    return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
+
+
+def _csv_number(value):
+    return '' if np.isnan(value) else f"{value:g}"
+
+
+def write_audit_csv(columns, audit, path):
+    """
+    Write the flagged rows of an audit to a CSV file
+
+    Args:
+        columns (DosageAuditColumns): The audited rows
+        audit (dict): Result of audit_dosage_columns
+        path (str): Output file
+
+    Returns:
+        int: Number of rows written
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(AUDIT_CSV_FIELDS)
+        for position, row in enumerate(audit['flagged']):
+            medication_id = int(columns.medication_ids[row])
+            writer.writerow([
+                int(columns.ids[row]),
+                int(columns.prescription_ids[row]),
+                medication_id,
+                columns.medications[medication_id][0],
+                columns.dosages[columns.dosage_codes[row]],
+                columns.frequencies[columns.frequency_codes[row]] or '',
+                columns.strengths[columns.strength_codes[row]] or '',
+                _csv_number(columns.weights[row]),
+                _csv_number(audit['ages'][row]),
+                _csv_number(audit['dose_mg'][row]),
+                _csv_number(audit['daily_mg'][row]),
+                _csv_number(audit['daily_total_mg'][row]),
+                bool(audit['is_appropriate'][position]),
+                audit['reasons'][position]
+            ])
+    return len(audit['flagged'])
+
+
+def audit_dosages(output_path, batch_size=AUDIT_BATCH_SIZE):
+    """
+    Audit the dosage of every prescribed medication and write out the flagged rows
+
+    Args:
+        output_path (str): CSV file for the flagged rows
+        batch_size (int): Rows fetched from the database at a time
+
+    Returns:
+        dict: 'rows' audited, 'flagged' rows written and 'inappropriate' rows
+    """
+    columns = load_audit_columns(batch_size)
+    audit = audit_dosage_columns(columns)
+    written = write_audit_csv(columns, audit, output_path)
+    inappropriate = int((~audit['is_appropriate']).sum())
+    logging.info(f"Dosage audit: {written} of {audit['rows']} rows flagged, {inappropriate} inappropriate")
+    return {'rows': audit['rows'], 'flagged': written, 'inappropriate': inappropriate}
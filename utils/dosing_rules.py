@@ -0,0 +1,212 @@
+import os
+import json
+import logging
+import threading
+
+# Rule file loaded on first use; DOSING_RULES_FILE points at a different one
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dosing_rules.json')
+RULES_FILE = os.environ.get('DOSING_RULES_FILE', DEFAULT_RULES_FILE)
+
+# Kinds of check a rule can make
+#   mg_per_kg_dose: a single dose above limit mg per kg of body weight
+#   dose: a single dose above limit mg
+#   daily_dose: doses per day times the dose above limit mg
+#   contraindicated: any dose at all
+RULE_CHECKS = ('mg_per_kg_dose', 'dose', 'daily_dose', 'contraindicated')
+
+
+class DosingRule:
+    """One limit on a medication's dose, optionally for an age band
+
+    Args:
+        check (str): One of RULE_CHECKS
+        warning (str): Warning shown when the rule is broken, formatted with
+            weight, age, limit (in mg) and daily
+        limit (float, optional): Limit in mg, or mg/kg for mg_per_kg_dose
+        age_below (float, optional): Only applies to patients younger than this
+        age_above (float, optional): Only applies to patients older than this
+        flag (bool): Whether breaking the rule makes the dosage inappropriate,
+            rather than only adding a warning
+        recommendation (str, optional): Recommendation added with the warning
+    """
+
+    __slots__ = ('check', 'warning', 'limit', 'age_below', 'age_above', 'flag', 'recommendation')
+
+    def __init__(self, check, warning, limit=None, age_below=None, age_above=None, flag=True, recommendation=None):
+        if check not in RULE_CHECKS:
+            raise ValueError(f"Unknown dosing rule check '{check}'")
+        if check != 'contraindicated' and limit is None:
+            raise ValueError(f"Dosing rule '{check}' needs a limit")
+        self.check = check
+        self.warning = warning
+        self.limit = float(limit) if limit is not None else None
+        self.age_below = age_below
+        self.age_above = age_above
+        self.flag = flag
+        self.recommendation = recommendation
+
+    def applies_to(self, age):
+        if self.age_below is None and self.age_above is None:
+            return True
+        if age is None:
+            return False
+        if self.age_below is not None and not age < self.age_below:
+            return False
+        if self.age_above is not None and not age > self.age_above:
+            return False
+        return True
+
+    def evaluate(self, dose_mg, weight=None, age=None, doses_per_day=None, daily_mg=None):
+        """
+        Check a dose against the rule
+
+        Args:
+            dose_mg (float): Amount of drug in one dose, in mg
+            weight (float, optional): Patient weight in kg
+            age (int, optional): Patient age in years
+            doses_per_day (float, optional): How many doses are taken a day
+            daily_mg (float, optional): Total taken a day, when it's more
+                than this dose times doses_per_day
+
+        Returns:
+            dict: 'warning', 'recommendation' and 'flag' if the rule is
+                broken, otherwise None
+        """
+        if not self.applies_to(age):
+            return None
+
+        daily = None
+        if self.check == 'contraindicated':
+            limit = None
+        elif dose_mg is None:
+            return None
+        elif self.check == 'mg_per_kg_dose':
+            if not weight:
+                return None
+            limit = weight * self.limit
+            if dose_mg <= limit:
+                return None
+        elif self.check == 'daily_dose':
+            if daily_mg is not None:
+                daily = daily_mg
+            elif doses_per_day:
+                daily = dose_mg * doses_per_day
+            else:
+                return None
+            limit = self.limit
+            if daily <= limit:
+                return None
+        else:
+            limit = self.limit
+            if dose_mg <= limit:
+                return None
+
+        values = {'weight': weight, 'age': age, 'limit': limit, 'daily': daily}
+        return {
+            'warning': self.warning.format(**values),
+            'recommendation': self.recommendation.format(**values) if self.recommendation else None,
+            'flag': self.flag
+        }
+
+
+class DosingRuleIndex:
+    """Dosing rules compiled into lookups by medication name and ID
+
+    Rules are stored once per lowercased medication or generic name. The
+    rules for a medication are resolved on its first check and then cached
+    by its ID, so later checks are a single dictionary lookup.
+    """
+
+    def __init__(self, entries=()):
+        self.by_name = {}
+        self._by_medication = {}
+        self._lock = threading.Lock()
+        for entry in entries:
+            self.add(entry['names'], [DosingRule(**rule) for rule in entry.get('rules', [])])
+
+    def add(self, names, rules):
+        for name in names:
+            key = ' '.join(name.lower().split())
+            self.by_name.setdefault(key, []).extend(rules)
+        with self._lock:
+            self._by_medication.clear()
+
+    def _resolve(self, name, generic_name):
+        rules = []
+        matched = set()
+        for alias in (name, generic_name):
+            key = ' '.join((alias or '').lower().split())
+            if not key:
+                continue
+            if key in self.by_name:
+                matched.add(key)
+                continue
+            # Names such as "Children's Ibuprofen" still get the ibuprofen rules
+            matched.update(rule_name for rule_name in self.by_name if rule_name in key)
+        for rule_name in sorted(matched):
+            rules.extend(self.by_name[rule_name])
+        return rules
+
+    def rules_for(self, medication):
+        """
+        Get the dosing rules that apply to a medication
+
+        Args:
+            medication (Medication): Medication object
+
+        Returns:
+            list: DosingRule objects, empty if none apply
+        """
+        key = (medication.id, medication.name, medication.generic_name)
+        rules = self._by_medication.get(key)
+        if rules is None:
+            rules = self._resolve(medication.name, medication.generic_name)
+            if medication.id is not None:
+                with self._lock:
+                    self._by_medication[key] = rules
+        return rules
+
+
+_index = None
+_index_lock = threading.Lock()
+
+def load_dosing_rules(path=None):
+    """
+    Load dosing rules from a JSON file and use them from now on
+
+    The file holds a "medications" list, each entry having the "names" the
+    rules apply to and a list of "rules" with the DosingRule arguments.
+
+    Args:
+        path (str, optional): Rule file, RULES_FILE by default
+
+    Returns:
+        DosingRuleIndex: The compiled rules
+    """
+    global _index
+    path = path or RULES_FILE
+    with open(path) as f:
+        data = json.load(f)
+
+    index = DosingRuleIndex(data.get('medications', []))
+    with _index_lock:
+        _index = index
+    logging.info(f"Loaded dosing rules for {len(index.by_name)} medication names from {path}")
+    return index
+
+def get_dosing_rules():
+    """
+    Get the dosing rules in use, loading RULES_FILE on first use
+
+    Returns:
+        DosingRuleIndex: The compiled rules
+    """
+    global _index
+    if _index is None:
+        try:
+            load_dosing_rules()
+        except (OSError, ValueError, TypeError) as e:
+            logging.error(f"Error loading dosing rules: {str(e)}")
+            with _index_lock:
+                _index = DosingRuleIndex()
+    return _index
@@ -1,5 +1,7 @@
 import logging
+from datetime import datetime
 from models import Medication, DrugInteraction, PatientAllergy, User
+from utils.intervals import get_patient_interval_index, course_end
 
 def check_drug_interactions(medication_ids, patient_id=None):
     """
@@ -83,3 +85,88 @@ def check_drug_interactions(medication_ids, patient_id=None):
             'allergies': [],
             'has_severe_interaction': False
         }
+
+def find_interactions(pairs):
+    """
+    Look up the known interactions among pairs of medications in one query
+    
+    Args:
+        pairs (iterable): (medication ID, medication ID) tuples, in any order
+        
+    Returns:
+        dict: Sorted (medication ID, medication ID) tuple mapped to its DrugInteraction
+    """
+    pairs = {tuple(sorted(pair)) for pair in pairs if pair[0] != pair[1]}
+    if not pairs:
+        return {}
+    
+    ids = {medication_id for pair in pairs for medication_id in pair}
+    found = {}
+    candidates = DrugInteraction.query.filter(DrugInteraction.drug1_id.in_(ids),
+                                              DrugInteraction.drug2_id.in_(ids))
+    for interaction in candidates:
+        key = tuple(sorted((interaction.drug1_id, interaction.drug2_id)))
+        if key in pairs and key not in found:
+            found[key] = interaction
+    return found
+
+def screen_prescription_interactions(prescription):
+    """
+    Find interactions of a prescription's medications with each other and with
+    the patient's other medications taken at the same time
+    
+    Only medications whose courses overlap in time are paired: the other
+    courses come from the patient's interval index, so courses that ended
+    before this one started are never looked at. Courses without a duration
+    count as lasting DISPENSE_DEFAULT_DAYS.
+    
+    Args:
+        prescription (Prescription): Prescription to screen
+        
+    Returns:
+        list: Dicts with 'drug1_id', 'drug2_id', 'drug1_name', 'drug2_name',
+            'severity', 'description' and 'other_prescription_id' (None when
+            both medications are on this prescription)
+    """
+    lines = prescription.medications
+    candidates = []
+    
+    # Medications on the same prescription are taken together
+    for i, line in enumerate(lines):
+        for other in lines[i + 1:]:
+            candidates.append((line.medication_id, other.medication_id, None))
+    
+    index = get_patient_interval_index(prescription.user_id)
+    for line in lines:
+        start = line.starts_at or prescription.date_filled or prescription.date_prescribed or datetime.utcnow()
+        for course in index.overlapping(start, course_end(start, line.ends_at)):
+            if course.prescription_id != prescription.id:
+                candidates.append((line.medication_id, course.medication_id, course.prescription_id))
+    
+    interactions = find_interactions((drug1_id, drug2_id) for drug1_id, drug2_id, _ in candidates)
+    if not interactions:
+        return []
+    
+    names = {}
+    ids = {medication_id for pair in interactions for medication_id in pair}
+    for medication in Medication.query.filter(Medication.id.in_(ids)):
+        names[medication.id] = medication.name
+    
+    results = []
+    seen = set()
+    for drug1_id, drug2_id, other_prescription_id in candidates:
+        interaction = interactions.get(tuple(sorted((drug1_id, drug2_id))))
+        key = (drug1_id, drug2_id, other_prescription_id)
+        if interaction is None or key in seen:
+            continue
+        seen.add(key)
+        results.append({
+            'drug1_id': drug1_id,
+            'drug2_id': drug2_id,
+            'drug1_name': names.get(drug1_id),
+            'drug2_name': names.get(drug2_id),
+            'severity': interaction.severity,
+            'description': interaction.description,
+            'other_prescription_id': other_prescription_id
+        })
+    return results
@@ -0,0 +1,256 @@
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from models import Prescription, PrescriptionMedication
+from utils.dispensing import DISPENSE_DEFAULT_DAYS
+
+# Seconds a patient's interval index is reused. Writes in this process drop it
+# straight away; the limit bounds how stale other workers' copies can get.
+INTERVAL_INDEX_TTL = float(os.environ.get('INTERVAL_INDEX_TTL', 60))
+
+# Most patients whose interval index is kept, the least recently used go first
+INTERVAL_INDEX_MAX_PATIENTS = int(os.environ.get('INTERVAL_INDEX_MAX_PATIENTS', 1000))
+
+# End of an open-ended query range
+OPEN_END = datetime.max
+
+# One prescribed medication's course in a patient's interval index
+MedicationCourse = namedtuple('MedicationCourse', ['id', 'prescription_id', 'medication_id', 'start', 'end'])
+
+
+class IntervalTree:
+    """Centered interval tree over closed [start, end] intervals
+
+    Finds the intervals overlapping a query range in O(log n + k) instead of
+    comparing it with every interval.
+
+    Args:
+        intervals (list): (start, end, item) tuples
+    """
+
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, intervals):
+        self.left = self.right = None
+        self.by_start = self.by_end = []
+        self.center = None
+        if not intervals:
+            return
+
+        points = sorted(point for start, end, _ in intervals for point in (start, end))
+        self.center = points[len(points) // 2]
+
+        here, left, right = [], [], []
+        for interval in intervals:
+            start, end, _ = interval
+            if end < self.center:
+                left.append(interval)
+            elif start > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        self.by_start = sorted(here, key=lambda interval: interval[0])
+        self.by_end = sorted(here, key=lambda interval: interval[1], reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def overlapping(self, start, end):
+        """
+        Find the intervals overlapping [start, end]
+
+        Args:
+            start: Start of the range
+            end: End of the range, inclusive
+
+        Returns:
+            list: Items of the overlapping intervals
+        """
+        found = []
+        self._collect(start, end, found)
+        return found
+
+    def _collect(self, start, end, found):
+        node = self
+        while node is not None and node.center is not None:
+            if end < node.center:
+                # Everything here reaches the center, so only the start matters
+                for interval_start, _, item in node.by_start:
+                    if interval_start > end:
+                        break
+                    found.append(item)
+                node = node.left
+            elif start > node.center:
+                for _, interval_end, item in node.by_end:
+                    if interval_end < start:
+                        break
+                    found.append(item)
+                node = node.right
+            else:
+                found.extend(item for _, _, item in node.by_start)
+                if node.left is not None:
+                    node.left._collect(start, end, found)
+                node = node.right
+
+
+class PatientIntervalIndex:
+    """A patient's medication courses, indexed by when they are taken
+
+    Args:
+        patient_id (int): Patient user ID
+        courses (list): MedicationCourse tuples
+    """
+
+    def __init__(self, patient_id, courses):
+        self.patient_id = patient_id
+        self.courses = courses
+        self.built_at = time.monotonic()
+        self.tree = IntervalTree([(course.start, course.end, course) for course in courses])
+
+    def overlapping(self, start, end=None):
+        """
+        Courses active at any time between start and end
+
+        Args:
+            start (datetime): Start of the period
+            end (datetime, optional): End of the period, open-ended if None
+
+        Returns:
+            list: MedicationCourse tuples
+        """
+        return self.tree.overlapping(start, end or OPEN_END)
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+def course_end(start, ends_at):
+    """
+    When a prescribed course ends, for screening
+
+    Courses without a duration are taken to last as long as the supply
+    dispensed for them, DISPENSE_DEFAULT_DAYS, rather than forever.
+
+    Args:
+        start (datetime): Start of the course
+        ends_at (datetime): Its stored end, None without a duration
+
+    Returns:
+        datetime: End of the course
+    """
+    return ends_at or start + timedelta(days=DISPENSE_DEFAULT_DAYS)
+
+def load_patient_courses(patient_id):
+    """
+    Load the courses of a patient's prescriptions that haven't been cancelled
+
+    Args:
+        patient_id (int): Patient user ID
+
+    Returns:
+        list: MedicationCourse tuples
+    """
+    rows = (db.session.query(PrescriptionMedication.id, PrescriptionMedication.prescription_id,
+                             PrescriptionMedication.medication_id, PrescriptionMedication.starts_at,
+                             PrescriptionMedication.ends_at, Prescription.date_prescribed)
+            .join(Prescription, PrescriptionMedication.prescription_id == Prescription.id)
+            .filter(Prescription.user_id == patient_id, Prescription.status != 'cancelled')
+            .all())
+    courses = []
+    for row_id, prescription_id, medication_id, starts_at, ends_at, prescribed in rows:
+        start = starts_at or prescribed or datetime.utcnow()
+        courses.append(MedicationCourse(row_id, prescription_id, medication_id, start, course_end(start, ends_at)))
+    return courses
+
+def get_patient_interval_index(patient_id):
+    """
+    Get a patient's interval index, building it on first use
+
+    Args:
+        patient_id (int): Patient user ID
+
+    Returns:
+        PatientIntervalIndex: The patient's indexed courses
+    """
+    with _indexes_lock:
+        index = _indexes.get(patient_id)
+        if index is not None and time.monotonic() - index.built_at <= INTERVAL_INDEX_TTL:
+            _indexes.move_to_end(patient_id)
+            return index
+
+    index = PatientIntervalIndex(patient_id, load_patient_courses(patient_id))
+    with _indexes_lock:
+        _indexes[patient_id] = index
+        _indexes.move_to_end(patient_id)
+        while len(_indexes) > INTERVAL_INDEX_MAX_PATIENTS:
+            _indexes.popitem(last=False)
+    return index
+
+def invalidate_patient_intervals(patient_id=None):
+    """
+    Drop a patient's cached interval index, or every patient's
+
+    Args:
+        patient_id (int, optional): Patient user ID, all patients if None
+    """
+    with _indexes_lock:
+        if patient_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(patient_id, None)
+
+
+def _patient_changed(target, patient_id):
+    # Drop the index now for reads in this transaction, and again once it
+    # commits in case another request rebuilt it from the old rows meanwhile
+    invalidate_patient_intervals(patient_id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_interval_patients', set()).add(patient_id)
+
+
+@event.listens_for(Prescription, 'after_insert')
+@event.listens_for(Prescription, 'after_update')
+@event.listens_for(Prescription, 'after_delete')
+def _prescription_changed(mapper, connection, target):
+    _patient_changed(target, target.user_id)
+
+
+@event.listens_for(Prescription.user_id, 'set', active_history=True)
+def _prescription_moved(target, value, old_patient_id, initiator):
+    # The new patient is handled when the row is flushed, the old one only
+    # shows up here; active_history loads it if the row was expired
+    if old_patient_id is not None and old_patient_id != value and inspect(target).persistent:
+        _patient_changed(target, old_patient_id)
+
+
+@event.listens_for(PrescriptionMedication, 'after_insert')
+@event.listens_for(PrescriptionMedication, 'after_update')
+@event.listens_for(PrescriptionMedication, 'after_delete')
+def _prescription_medication_changed(mapper, connection, target):
+    patient_id = connection.execute(
+        select(Prescription.user_id).where(Prescription.id == target.prescription_id)
+    ).scalar()
+    # The prescription may be gone already if both were deleted together
+    _patient_changed(target, patient_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_patients(session):
+    for patient_id in session.info.pop('changed_interval_patients', ()):
+        invalidate_patient_intervals(patient_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _invalidate_rolled_back_patients(session):
+    # An index built from rows flushed in the transaction would keep the
+    # rolled back courses until it expires
+    for patient_id in session.info.pop('changed_interval_patients', ()):
+        invalidate_patient_intervals(patient_id)
@@ -1,8 +1,60 @@
 import logging
 from datetime import datetime
 
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm.attributes import set_committed_value
+
 from app import db
 from models import Medication, InventoryLog
+from utils.inventory_rollups import record_inventory_rollups
+from utils.low_stock import reorder_level, is_below, record_low_stock_change
+
+def adjust_stock(medication_id, quantity_change):
+    """
+    Add to a medication's stock in a single conditional UPDATE
+    
+    The new quantity is computed by the database and the row is only changed
+    if it stays at or above zero, so concurrent fills can neither lose an
+    update nor oversell. The low stock flag is set in the same statement.
+    The change is part of the current transaction and isn't committed.
+    
+    Args:
+        medication_id (int): ID of medication to update
+        quantity_change (int): Amount to add or remove (positive or negative)
+        
+    Returns:
+        int: New stock quantity, or None if the medication doesn't exist or
+            the change would make the stock negative
+    """
+    new_stock = func.coalesce(Medication.stock_quantity, 0) + quantity_change
+    level = reorder_level()
+    statement = (update(Medication)
+                 .where(Medication.id == medication_id, new_stock >= 0)
+                 .values(stock_quantity=new_stock, is_low_stock=new_stock < level)
+                 .execution_options(synchronize_session=False))
+    returned = (Medication.stock_quantity, Medication.is_low_stock, level)
+    
+    if db.engine.dialect.update_returning:
+        row = db.session.execute(statement.returning(*returned)).first()
+    elif db.session.execute(statement).rowcount:
+        # The UPDATE holds the row lock, so this reads our own write
+        row = db.session.execute(select(*returned).where(Medication.id == medication_id)).first()
+    else:
+        row = None
+    
+    if row is None:
+        return None
+    
+    new_quantity, low, level_value = row
+    if bool(low) != is_below(new_quantity - quantity_change, level_value):
+        record_low_stock_change(medication_id, low, new_quantity, level_value)
+    
+    # Keep an already loaded medication in step without expiring it
+    medication = db.session.identity_map.get(db.session.identity_key(Medication, medication_id))
+    if medication is not None:
+        set_committed_value(medication, 'stock_quantity', new_quantity)
+        set_committed_value(medication, 'is_low_stock', bool(low))
+    return new_quantity
 
 def update_inventory(medication_id, quantity_change, reason, user_id=None):
     """
@@ -18,21 +70,16 @@ def update_inventory(medication_id, quantity_change, reason, user_id=None):
         bool: Success status
     """
     try:
-        # Get the medication
-        medication = db.session.get(Medication, medication_id)
-        if not medication:
-            logging.error(f"Medication with ID {medication_id} not found")
-            return False
-        
-        # Update the stock quantity
-        new_quantity = medication.stock_quantity + quantity_change
-        
-        # Don't allow negative inventory
-        if new_quantity < 0:
-            logging.warning(f"Attempted to reduce inventory below zero for medication {medication_id}")
+        # Update the stock quantity, refusing to go below zero
+        new_quantity = adjust_stock(medication_id, quantity_change)
+        if new_quantity is None:
+            # The conditional UPDATE changed nothing, so the caller's other
+            # pending changes are left alone
+            if db.session.get(Medication, medication_id) is None:
+                logging.error(f"Medication with ID {medication_id} not found")
+            else:
+                logging.warning(f"Attempted to reduce inventory below zero for medication {medication_id}")
             return False
-            
-        medication.stock_quantity = new_quantity
         
         # Create inventory log entry
         log_entry = InventoryLog(
@@ -43,8 +90,10 @@ def update_inventory(medication_id, quantity_change, reason, user_id=None):
             reason=reason
         )
         
-        # Add and commit changes
+        # Add and commit changes, with the day's rollup
         db.session.add(log_entry)
+        record_inventory_rollups([{'medication_id': medication_id, 'quantity_change': quantity_change,
+                                   'timestamp': log_entry.timestamp}])
         db.session.commit()
         
         logging.info(f"Inventory updated for medication {medication_id}: {quantity_change} units, new total: {new_quantity}")
@@ -55,6 +104,81 @@ def update_inventory(medication_id, quantity_change, reason, user_id=None):
         logging.error(f"Error updating inventory: {str(e)}")
         return False
 
+def apply_inventory_adjustments(adjustments, user_id=None):
+    """
+    Apply many inventory changes in one transaction
+    
+    Each change is a conditional UPDATE like in update_inventory, so a line
+    for an unknown medication or one that would make the stock negative is
+    reported and skipped while the rest of the batch is applied. The log
+    entries and daily rollups are written together and everything is
+    committed once.
+    
+    Args:
+        adjustments (list): Dicts with medication_id, quantity_change and
+            reason, applied in order
+        user_id (int, optional): ID of user making the changes
+        
+    Returns:
+        dict: 'applied' lines with their new stock_quantity, 'failed' lines
+            with an error, and 'error' if the batch couldn't be committed
+    """
+    applied = []
+    failed = []
+    log_rows = []
+    
+    try:
+        lines = []
+        for index, adjustment in enumerate(adjustments):
+            try:
+                medication_id = int(adjustment['medication_id'])
+                quantity_change = int(adjustment['quantity_change'])
+            except (KeyError, TypeError, ValueError):
+                failed.append({'index': index, 'medication_id': adjustment.get('medication_id')
+                               if isinstance(adjustment, dict) else None,
+                               'error': 'medication_id and an integer quantity_change are required'})
+                continue
+            reason = (adjustment.get('reason') or '').strip()
+            if not reason:
+                failed.append({'index': index, 'medication_id': medication_id, 'error': 'A reason is required'})
+                continue
+            lines.append((index, medication_id, quantity_change, reason))
+        
+        known_ids = set(db.session.execute(
+            select(Medication.id).where(Medication.id.in_({line[1] for line in lines}))
+        ).scalars())
+        
+        now = datetime.utcnow()
+        for index, medication_id, quantity_change, reason in lines:
+            if medication_id not in known_ids:
+                failed.append({'index': index, 'medication_id': medication_id, 'error': 'Medication not found'})
+                continue
+            
+            new_quantity = adjust_stock(medication_id, quantity_change)
+            if new_quantity is None:
+                failed.append({'index': index, 'medication_id': medication_id,
+                               'error': 'Insufficient stock for this change'})
+                continue
+            
+            applied.append({'index': index, 'medication_id': medication_id,
+                            'quantity_change': quantity_change, 'stock_quantity': new_quantity})
+            log_rows.append({'medication_id': medication_id, 'quantity_change': quantity_change,
+                             'timestamp': now, 'recorded_by_id': user_id, 'reason': reason})
+        
+        if log_rows:
+            db.session.execute(insert(InventoryLog), log_rows)
+            record_inventory_rollups(log_rows)
+        db.session.commit()
+        
+        failed.sort(key=lambda line: line['index'])
+        logging.info(f"Inventory batch applied {len(applied)} changes, {len(failed)} failed")
+        return {'applied': applied, 'failed': failed}
+        
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error applying inventory batch: {str(e)}")
+        return {'applied': [], 'failed': failed, 'error': str(e)}
+
 def get_low_stock_medications(threshold=None):
     """
     Get list of medications with stock levels below threshold
@@ -72,10 +196,8 @@ def get_low_stock_medications(threshold=None):
                 Medication.stock_quantity < threshold
             ).all()
         else:
-            # Use each medication's defined minimum stock level
-            low_stock = Medication.query.filter(
-                Medication.stock_quantity < Medication.minimum_stock_level
-            ).all()
+            # Flagged on write against each medication's reorder level, read through its index
+            low_stock = Medication.query.filter(Medication.is_low_stock.is_(True)).all()
             
         return low_stock
         
@@ -0,0 +1,154 @@
+import os
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, update
+
+from app import db
+from models import InventoryDailyRollup, Medication
+from utils.low_stock import refresh_low_stock_flags
+
+# Days of history the forecast looks at, ending yesterday
+FORECAST_WINDOW_DAYS = int(os.environ.get('FORECAST_WINDOW_DAYS', 90))
+# Age in days at which a day's usage counts half as much as yesterday's
+FORECAST_HALF_LIFE_DAYS = float(os.environ.get('FORECAST_HALF_LIFE_DAYS', 28))
+# Medications with less history than this keep their manual minimum stock level
+FORECAST_MIN_HISTORY_DAYS = int(os.environ.get('FORECAST_MIN_HISTORY_DAYS', 14))
+# Days between reordering and the delivery arriving
+REORDER_LEAD_TIME_DAYS = float(os.environ.get('REORDER_LEAD_TIME_DAYS', 7))
+# Safety stock in standard deviations of lead time demand; 1.65 covers
+# about 95% of lead times without running out
+REORDER_SERVICE_Z = float(os.environ.get('REORDER_SERVICE_Z', 1.65))
+
+def load_consumption(medication_ids, start, days):
+    """
+    Daily units used per medication, from the inventory rollups
+
+    Usage is what was dispensed plus other removals such as expired or
+    damaged stock. Receipts don't count.
+
+    Args:
+        medication_ids (list): Medication IDs, one matrix row each
+        start (date): First day
+        days (int): Number of days, one matrix column each
+
+    Returns:
+        tuple: (usage matrix, index of each medication's first logged day,
+            negative if it is before start)
+    """
+    row_of = {medication_id: row for row, medication_id in enumerate(medication_ids)}
+    end = start + timedelta(days=days)
+    usage = np.zeros((len(medication_ids), days))
+
+    rows = (db.session.query(InventoryDailyRollup.medication_id, InventoryDailyRollup.day,
+                             InventoryDailyRollup.dispensed - InventoryDailyRollup.adjustments)
+            .filter(InventoryDailyRollup.day >= start, InventoryDailyRollup.day < end)
+            .all())
+    if rows:
+        medication_rows, days_used, amounts = zip(*rows)
+        keep = np.array([medication_id in row_of for medication_id in medication_rows])
+        matrix_rows = np.array([row_of.get(medication_id, 0) for medication_id in medication_rows])
+        columns = np.array([(day - start).days for day in days_used])
+        np.add.at(usage, (matrix_rows[keep], columns[keep]), np.array(amounts, dtype=float)[keep])
+
+    # Returned stock can make a day negative, it isn't negative demand
+    np.clip(usage, 0, None, out=usage)
+
+    first_index = np.full(len(medication_ids), days, dtype=int)
+    first_days = (db.session.query(InventoryDailyRollup.medication_id, func.min(InventoryDailyRollup.day))
+                  .group_by(InventoryDailyRollup.medication_id)
+                  .all())
+    for medication_id, first_day in first_days:
+        if medication_id in row_of:
+            first_index[row_of[medication_id]] = (first_day - start).days
+    return usage, first_index
+
+def forecast_demand(usage, first_index, half_life=None, lead_time=None, service_z=None):
+    """
+    Forecast daily demand and reorder points for every medication at once
+
+    Demand is the exponentially weighted mean of daily usage over the days
+    since each medication's first logged day. The reorder point covers the
+    expected demand during the lead time plus safety stock for its
+    variability.
+
+    Args:
+        usage (numpy.ndarray): Units used, medications by days, oldest day first
+        first_index (numpy.ndarray): Column of each medication's first logged day
+        half_life (float, optional): FORECAST_HALF_LIFE_DAYS by default
+        lead_time (float, optional): REORDER_LEAD_TIME_DAYS by default
+        service_z (float, optional): REORDER_SERVICE_Z by default
+
+    Returns:
+        dict: 'daily_demand', 'std' and 'reorder_point' arrays, NaN where a
+            medication has no history, and 'history_days'
+    """
+    half_life = FORECAST_HALF_LIFE_DAYS if half_life is None else half_life
+    lead_time = REORDER_LEAD_TIME_DAYS if lead_time is None else lead_time
+    service_z = REORDER_SERVICE_Z if service_z is None else service_z
+
+    days = usage.shape[1]
+    age = np.arange(days - 1, -1, -1)
+    observed = np.arange(days)[None, :] >= first_index[:, None]
+    weights = np.where(observed, 0.5 ** (age / half_life), 0.0)
+    total = weights.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (weights * usage).sum(axis=1) / total
+        variance = (weights * (usage - mean[:, None]) ** 2).sum(axis=1) / total
+    std = np.sqrt(variance)
+    # Round before taking the ceiling so float noise doesn't add a unit
+    reorder_point = np.ceil(np.round(mean * lead_time + service_z * std * np.sqrt(lead_time), 6))
+
+    return {
+        'daily_demand': mean,
+        'std': std,
+        'reorder_point': reorder_point,
+        'history_days': observed.sum(axis=1)
+    }
+
+def forecast_inventory(today=None):
+    """
+    Forecast demand for the whole catalog and store the suggested minimum levels
+
+    Medications with at least FORECAST_MIN_HISTORY_DAYS of history and some
+    usage get a suggested minimum stock, which the low stock checks use
+    instead of the manual level. The others have theirs cleared.
+
+    Args:
+        today (date, optional): Day to forecast from, today by default
+
+    Returns:
+        dict: 'medications' forecast and 'suggested', the number given a
+            suggested minimum stock
+    """
+    today = today or datetime.utcnow().date()
+    start = today - timedelta(days=FORECAST_WINDOW_DAYS)
+    medication_ids = [medication_id for (medication_id,) in db.session.query(Medication.id).order_by(Medication.id)]
+    if not medication_ids:
+        return {'medications': 0, 'suggested': 0}
+
+    usage, first_index = load_consumption(medication_ids, start, FORECAST_WINDOW_DAYS)
+    forecast = forecast_demand(usage, first_index)
+
+    demand = forecast['daily_demand']
+    has_demand = (forecast['history_days'] >= FORECAST_MIN_HISTORY_DAYS) & (demand > 0)
+    now = datetime.utcnow()
+    updates = [
+        {
+            'id': medication_id,
+            'daily_demand': float(demand[row]) if np.isfinite(demand[row]) else None,
+            'suggested_minimum_stock': int(forecast['reorder_point'][row]) if has_demand[row] else None,
+            'forecast_at': now
+        }
+        for row, medication_id in enumerate(medication_ids)
+    ]
+
+    db.session.execute(update(Medication), updates)
+    # New reorder points can move medications in or out of low stock
+    refresh_low_stock_flags()
+
+    suggested = int(has_demand.sum())
+    logging.info(f"Forecast demand for {len(medication_ids)} medications, {suggested} with a suggested minimum stock")
+    return {'medications': len(medication_ids), 'suggested': suggested}
@@ -0,0 +1,249 @@
+import re
+import csv
+import logging
+from datetime import date, datetime, time
+
+from sqlalchemy import and_, case, delete, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+from models import InventoryDailyRollup, InventoryLog, Medication, Prescription
+
+# Reason written by fill_prescriptions, used to link entries logged before
+# the prescription was stored on them
+FILLED_REASON_PATTERN = re.compile(r'^Prescription #(\d+) filled$')
+
+USAGE_CSV_FIELDS = ['day', 'medication_id', 'medication', 'receipts', 'dispensed', 'adjustments',
+                    'closing_balance']
+
+def rollup_amounts(quantity_change, prescription_id=None):
+    """
+    Split a logged stock change into the rollup columns
+
+    Only changes linked to a prescription count as dispensed; the reason is
+    free text and isn't looked at.
+
+    Args:
+        quantity_change (int): Logged change, negative for removals
+        prescription_id (int, optional): Prescription it was dispensed for
+
+    Returns:
+        tuple: (receipts, dispensed, adjustments)
+    """
+    if prescription_id is not None:
+        return 0, -quantity_change, 0
+    if quantity_change > 0:
+        return quantity_change, 0, 0
+    return 0, 0, quantity_change
+
+def _upsert_rollups(rows):
+    table = InventoryDailyRollup.__table__
+    dialect = db.engine.dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = dialect_insert(table).values(rows)
+        excluded = statement.excluded
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['medication_id', 'day'],
+            set_={
+                'receipts': table.c.receipts + excluded.receipts,
+                'dispensed': table.c.dispensed + excluded.dispensed,
+                'adjustments': table.c.adjustments + excluded.adjustments,
+                'closing_balance': excluded.closing_balance,
+            }
+        ))
+        return
+
+    for row in rows:
+        result = db.session.execute(
+            update(table)
+            .where(table.c.medication_id == row['medication_id'], table.c.day == row['day'])
+            .values(receipts=table.c.receipts + row['receipts'],
+                    dispensed=table.c.dispensed + row['dispensed'],
+                    adjustments=table.c.adjustments + row['adjustments'],
+                    closing_balance=row['closing_balance'])
+        )
+        if not result.rowcount:
+            db.session.execute(insert(table).values(**row))
+
+def record_inventory_rollups(log_rows):
+    """
+    Add new inventory log entries to their days' rollups
+
+    Runs in the caller's transaction, after the stock has been changed, so
+    the closing balance is the stock the change left behind. Meant for log
+    entries written as the change happens.
+
+    Args:
+        log_rows (list): Dicts with medication_id, quantity_change,
+            timestamp and optionally prescription_id, like the InventoryLog
+            rows written
+    """
+    totals = {}
+    for row in log_rows:
+        timestamp = row.get('timestamp') or datetime.utcnow()
+        key = (row['medication_id'], timestamp.date())
+        amounts = rollup_amounts(row['quantity_change'], row.get('prescription_id'))
+        totals[key] = [total + amount for total, amount in zip(totals.get(key, (0, 0, 0)), amounts)]
+    if not totals:
+        return
+
+    stock = dict(db.session.execute(
+        select(Medication.id, Medication.stock_quantity)
+        .where(Medication.id.in_({medication_id for medication_id, _ in totals}))
+    ).all())
+    _upsert_rollups([
+        {'medication_id': medication_id, 'day': day, 'receipts': receipts, 'dispensed': dispensed,
+         'adjustments': adjustments, 'closing_balance': stock.get(medication_id)}
+        for (medication_id, day), (receipts, dispensed, adjustments) in sorted(totals.items())
+    ])
+
+def _as_date(value):
+    # SQLite's date() returns text
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def rebuild_inventory_rollups(since=None):
+    """
+    Recompute the rollups from the inventory log
+
+    Catches up on log entries written without updating the rollups. Closing
+    balances are worked back from the current stock.
+
+    Args:
+        since (date, optional): First day to recompute, every day if None
+
+    Returns:
+        int: Number of rollup rows written
+    """
+    day = func.date(InventoryLog.timestamp)
+    change = InventoryLog.quantity_change
+    dispensing = InventoryLog.prescription_id.isnot(None)
+
+    query = (db.session.query(
+        InventoryLog.medication_id, day,
+        func.sum(case((and_(~dispensing, change > 0), change), else_=0)),
+        func.sum(case((dispensing, -change), else_=0)),
+        func.sum(case((and_(~dispensing, change < 0), change), else_=0)),
+        func.sum(change)
+    ).group_by(InventoryLog.medication_id, day))
+    if since is not None:
+        query = query.filter(InventoryLog.timestamp >= datetime.combine(since, time.min))
+
+    days = {}
+    for medication_id, log_day, receipts, dispensed, adjustments, net in query.all():
+        days.setdefault(medication_id, []).append((_as_date(log_day), receipts, dispensed, adjustments, net))
+
+    stock = dict(db.session.execute(
+        select(Medication.id, func.coalesce(Medication.stock_quantity, 0)).where(Medication.id.in_(days))
+    ).all())
+
+    rows = []
+    for medication_id, medication_days in days.items():
+        # Walk back from today's stock, undoing each day's changes
+        balance = stock.get(medication_id, 0)
+        for log_day, receipts, dispensed, adjustments, net in sorted(medication_days, reverse=True):
+            rows.append({'medication_id': medication_id, 'day': log_day, 'receipts': receipts,
+                         'dispensed': dispensed, 'adjustments': adjustments, 'closing_balance': balance})
+            balance -= net
+
+    try:
+        removed = delete(InventoryDailyRollup)
+        if since is not None:
+            removed = removed.where(InventoryDailyRollup.day >= since)
+        db.session.execute(removed)
+        if rows:
+            db.session.execute(insert(InventoryDailyRollup), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logging.info(f"Rebuilt {len(rows)} inventory rollups" + (f" since {since}" if since else ""))
+    return len(rows)
+
+def link_dispensed_inventory_logs():
+    """
+    Link log entries written by fill_prescriptions to their prescriptions
+
+    For entries logged before the prescription was stored with them. Only
+    the exact reason fill_prescriptions writes is recognized, and only for
+    prescriptions that exist.
+
+    Returns:
+        int: Number of entries linked
+    """
+    rows = (db.session.query(InventoryLog.id, InventoryLog.reason)
+            .filter(InventoryLog.prescription_id.is_(None), InventoryLog.reason.like('Prescription #% filled'))
+            .all())
+    links = {}
+    for log_id, reason in rows:
+        match = FILLED_REASON_PATTERN.match(reason)
+        if match:
+            links[log_id] = int(match.group(1))
+
+    existing = {prescription_id for (prescription_id,) in
+                db.session.query(Prescription.id).filter(Prescription.id.in_(set(links.values())))}
+    updates = [{'id': log_id, 'prescription_id': prescription_id}
+               for log_id, prescription_id in links.items() if prescription_id in existing]
+    try:
+        if updates:
+            db.session.execute(update(InventoryLog), updates)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logging.info(f"Linked {len(updates)} inventory log entries to their prescriptions")
+    return len(updates)
+
+def catch_up_inventory_rollups():
+    """
+    Recompute the rollups from the last rolled up day on
+
+    The last day is recomputed too, as it may have been rolled up before
+    it ended.
+
+    Returns:
+        int: Number of rollup rows written
+    """
+    last_day = db.session.query(func.max(InventoryDailyRollup.day)).scalar()
+    return rebuild_inventory_rollups(_as_date(last_day))
+
+def get_inventory_usage(start, end, medication_id=None):
+    """
+    Daily inventory movements between two days, read from the rollups
+
+    Args:
+        start (date): First day
+        end (date): Last day, inclusive
+        medication_id (int, optional): Only this medication
+
+    Returns:
+        list: Dicts with the USAGE_CSV_FIELDS, by day and medication name
+    """
+    query = (db.session.query(InventoryDailyRollup, Medication.name)
+             .join(Medication, InventoryDailyRollup.medication_id == Medication.id)
+             .filter(InventoryDailyRollup.day >= start, InventoryDailyRollup.day <= end))
+    if medication_id is not None:
+        query = query.filter(InventoryDailyRollup.medication_id == medication_id)
+
+    return [
+        {'day': rollup.day, 'medication_id': rollup.medication_id, 'medication': name,
+         'receipts': rollup.receipts, 'dispensed': rollup.dispensed, 'adjustments': rollup.adjustments,
+         'closing_balance': rollup.closing_balance}
+        for rollup, name in query.order_by(InventoryDailyRollup.day, Medication.name).all()
+    ]
+
+def write_usage_csv(usage, f):
+    """
+    Write daily inventory movements as CSV
+
+    Args:
+        usage (list): Rows from get_inventory_usage
+        f: Text file object to write to
+    """
+    writer = csv.DictWriter(f, fieldnames=USAGE_CSV_FIELDS)
+    writer.writeheader()
+    for row in usage:
+        writer.writerow({**row, 'day': row['day'].isoformat()})
@@ -0,0 +1,158 @@
+import logging
+
+from sqlalchemy import event, func, inspect, select, update
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from models import Medication
+
+# Functions called as listener(change) once a transaction that moved a
+# medication across its reorder level commits. change is a dict with
+# medication_id, is_low_stock, stock_quantity and reorder_level.
+_listeners = []
+
+def add_low_stock_listener(listener):
+    """
+    Call a function whenever a medication goes below or back above its reorder level
+
+    Usable as a decorator.
+
+    Args:
+        listener (callable): Called with a dict of medication_id,
+            is_low_stock, stock_quantity and reorder_level
+
+    Returns:
+        callable: The listener
+    """
+    _listeners.append(listener)
+    return listener
+
+def remove_low_stock_listener(listener):
+    """
+    Stop calling a function added with add_low_stock_listener
+
+    Args:
+        listener (callable): The listener
+    """
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+@add_low_stock_listener
+def _log_low_stock_change(change):
+    if change['is_low_stock']:
+        logging.warning(f"Medication {change['medication_id']} is low on stock: "
+                        f"{change['stock_quantity']} left, reorder level {change['reorder_level']}")
+    else:
+        logging.info(f"Medication {change['medication_id']} is back above its reorder level")
+
+def reorder_level(columns=None):
+    """
+    SQL expression for the level a medication's stock is measured against
+
+    Args:
+        columns (optional): Column collection to build it from, the
+            Medication ORM attributes by default
+
+    Returns:
+        ColumnElement: The forecast reorder point, else the minimum stock level
+    """
+    columns = columns if columns is not None else Medication
+    return func.coalesce(columns.suggested_minimum_stock, columns.minimum_stock_level, 0)
+
+def is_below(stock_quantity, level):
+    """Whether a stock quantity is below a reorder level, like the SQL check"""
+    return (stock_quantity or 0) < (level or 0)
+
+def record_low_stock_change(medication_id, is_low_stock, stock_quantity, level, session=None):
+    """
+    Note that a medication crossed its reorder level in the current transaction
+
+    The listeners are called once it commits, and not at all if it rolls back.
+
+    Args:
+        medication_id (int): Medication ID
+        is_low_stock (bool): Whether it is now below its reorder level
+        stock_quantity (int): Its new stock
+        level (int): Its reorder level
+        session (Session, optional): Session of the transaction, db.session by default
+    """
+    session = session if session is not None else db.session
+    session.info.setdefault('low_stock_changes', {})[medication_id] = {
+        'medication_id': medication_id,
+        'is_low_stock': bool(is_low_stock),
+        'stock_quantity': stock_quantity,
+        'reorder_level': level
+    }
+
+def refresh_low_stock_flags():
+    """
+    Recompute every medication's low stock flag in one UPDATE
+
+    For changes made without going through the ORM or adjust_stock, such as
+    a new forecast. Only rows whose flag is wrong are written, and the
+    transaction is committed.
+
+    Returns:
+        int: Number of medications whose flag changed
+    """
+    level = reorder_level()
+    below = func.coalesce(Medication.stock_quantity, 0) < level
+    statement = (update(Medication)
+                 .where(Medication.is_low_stock != below)
+                 .values(is_low_stock=below)
+                 .execution_options(synchronize_session=False))
+    returned = (Medication.id, Medication.is_low_stock, Medication.stock_quantity, level)
+
+    if db.engine.dialect.update_returning:
+        rows = db.session.execute(statement.returning(*returned)).all()
+    else:
+        rows = db.session.execute(
+            select(Medication.id, below, Medication.stock_quantity, level).where(Medication.is_low_stock != below)
+        ).all()
+        db.session.execute(statement)
+
+    for medication_id, low, stock_quantity, level_value in rows:
+        record_low_stock_change(medication_id, low, stock_quantity, level_value)
+    db.session.commit()
+    return len(rows)
+
+
+@event.listens_for(Medication, 'before_insert')
+@event.listens_for(Medication, 'before_update')
+def _store_low_stock(mapper, connection, target):
+    """Keep the flag in step when stock or levels are set through the ORM"""
+    state = inspect(target)
+    if state.persistent and not any(
+        state.attrs[name].history.has_changes()
+        for name in ('stock_quantity', 'minimum_stock_level', 'suggested_minimum_stock')
+    ):
+        return
+
+    minimum = target.minimum_stock_level
+    if minimum is None:
+        minimum = Medication.__table__.c.minimum_stock_level.default.arg
+    level = target.suggested_minimum_stock if target.suggested_minimum_stock is not None else minimum
+    low = is_below(target.stock_quantity, level)
+
+    if low != bool(target.is_low_stock):
+        target.is_low_stock = low
+        session = object_session(target)
+        if state.persistent and session is not None:
+            # New medications don't have an ID yet and aren't crossing anything
+            record_low_stock_change(target.id, low, target.stock_quantity, level, session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_low_stock_changes(session):
+    changes = session.info.pop('low_stock_changes', None)
+    for change in (changes or {}).values():
+        for listener in list(_listeners):
+            try:
+                listener(change)
+            except Exception as e:
+                logging.error(f"Error in low stock listener: {str(e)}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_low_stock_changes(session):
+    session.info.pop('low_stock_changes', None)
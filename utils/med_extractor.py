@@ -0,0 +1,247 @@
+import os
+import re
+import difflib
+import logging
+import threading
+
+from sqlalchemy import func
+
+from app import db
+from models import Medication
+
+# Scans whose local extraction scores at least this much skip the LLM
+LOCAL_CONFIDENCE_THRESHOLD = float(os.environ.get('LOCAL_EXTRACTION_THRESHOLD', 0.75))
+
+# Longest catalog name, in words, that is looked up as a phrase
+MAX_NAME_WORDS = 4
+
+DOSE_PATTERN = re.compile(
+    r"(\d+(?:[.,]\d+)?)\s*"
+    r"(mcg|µg|ug|mg|g|ml|l|iu|units?|tablets?|tabs?|capsules?|caps?|puffs?|drops?)\b"
+    r"(?:\s*/\s*(\d+(?:\.\d+)?)?\s*(ml|l))?",
+    re.IGNORECASE
+)
+
+FREQUENCY_PATTERNS = [
+    (re.compile(r"\bevery\s+(\d+)(?:\s*(?:-|to)\s*\d+)?\s*(?:hours?|hrs?|h)\b", re.IGNORECASE), None),
+    (re.compile(r"\bq\.?\s?(\d+)\s?h(?:rs?|ours?)?\b", re.IGNORECASE), None),
+    (re.compile(r"\b(?:once|one time)\s+(?:a\s+)?(?:daily|day|per day)\b", re.IGNORECASE), 'once daily'),
+    (re.compile(r"\b(?:twice|two times)\s+(?:a\s+)?(?:daily|day|per day)\b", re.IGNORECASE), 'twice daily'),
+    (re.compile(r"\b(?:three|3)\s+times\s+(?:a\s+)?(?:daily|day|per day)\b", re.IGNORECASE), 'three times daily'),
+    (re.compile(r"\b(?:four|4)\s+times\s+(?:a\s+)?(?:daily|day|per day)\b", re.IGNORECASE), 'four times daily'),
+    (re.compile(r"\b(?:b\.?i\.?d\.?)(?=\s|$|[,;])", re.IGNORECASE), 'twice daily'),
+    (re.compile(r"\b(?:t\.?i\.?d\.?)(?=\s|$|[,;])", re.IGNORECASE), 'three times daily'),
+    (re.compile(r"\b(?:q\.?i\.?d\.?)(?=\s|$|[,;])", re.IGNORECASE), 'four times daily'),
+    (re.compile(r"\b(?:q\.?d\.?|o\.?d\.?|daily)(?=\s|$|[,;])", re.IGNORECASE), 'once daily'),
+    (re.compile(r"\b(?:q\.?h\.?s\.?|at bedtime)(?=\s|$|[,;])", re.IGNORECASE), 'at bedtime'),
+    (re.compile(r"\b(?:p\.?r\.?n\.?|as needed)(?=\s|$|[,;])", re.IGNORECASE), 'as needed'),
+]
+
+DURATION_PATTERN = re.compile(
+    r"\b(?:for|x)\s*(\d+)\s*(days?|weeks?|months?)\b", re.IGNORECASE
+)
+
+INSTRUCTION_PATTERNS = [
+    re.compile(r"\b(?:take\s+)?with (?:food|meals?|water|milk)\b", re.IGNORECASE),
+    re.compile(r"\b(?:before|after) (?:meals?|food|breakfast|dinner)\b", re.IGNORECASE),
+    re.compile(r"\bon an empty stomach\b", re.IGNORECASE),
+    re.compile(r"\bdo not crush\b", re.IGNORECASE),
+]
+
+WORD_PATTERN = re.compile(r"[a-z][a-z\-]+", re.IGNORECASE)
+
+# Words that may come before the dose or frequency on a line that continues
+# the previous medication, e.g. "Take 2 tablets" or "Sig: twice daily". Any
+# other word there is most likely a drug missing from the catalog.
+DIRECTION_WORDS = {
+    'take', 'give', 'use', 'apply', 'inhale', 'inject', 'instill', 'insert', 'chew', 'dissolve',
+    'place', 'spray', 'dose', 'dosage', 'sig', 'directions', 'instructions', 'then', 'and', 'or',
+    'of', 'by', 'mouth', 'orally', 'po', 'up', 'to'
+}
+
+# Contribution of each recognized field to a medication's confidence
+NAME_EXACT_SCORE = 0.6
+NAME_FUZZY_SCORE = 0.4
+DOSE_SCORE = 0.2
+FREQUENCY_SCORE = 0.15
+EXTRA_SCORE = 0.05
+
+
+class CatalogDictionary:
+    """Lowercased medication and generic names mapped to catalog names"""
+
+    def __init__(self, medications):
+        self.names = {}
+        for med_id, name, generic_name in medications:
+            for alias in (name, generic_name):
+                if alias:
+                    key = ' '.join(alias.lower().split())
+                    self.names.setdefault(key, name)
+        self.single_words = [key for key in self.names if ' ' not in key]
+
+    def lookup(self, phrase):
+        return self.names.get(phrase)
+
+    def fuzzy_lookup(self, word):
+        # Only longer words, short ones give too many false matches
+        if len(word) < 5:
+            return None
+        matches = difflib.get_close_matches(word, self.single_words, n=1, cutoff=0.85)
+        return self.names[matches[0]] if matches else None
+
+
+_catalog = None
+_catalog_fingerprint = None
+_catalog_lock = threading.Lock()
+
+def get_catalog_dictionary():
+    """
+    Get the medication name dictionary, rebuilding it when the catalog changes
+
+    Returns:
+        CatalogDictionary: Names and generic names of all catalog medications
+    """
+    global _catalog, _catalog_fingerprint
+
+    fingerprint = tuple(db.session.query(func.count(Medication.id), func.max(Medication.id)).one())
+    with _catalog_lock:
+        if _catalog is None or fingerprint != _catalog_fingerprint:
+            rows = db.session.query(Medication.id, Medication.name, Medication.generic_name).all()
+            _catalog = CatalogDictionary(rows)
+            _catalog_fingerprint = fingerprint
+        return _catalog
+
+def _find_medication(line, catalog):
+    """Find the first catalog medication named on a line, longest phrase first"""
+    words = [match.group(0).lower() for match in WORD_PATTERN.finditer(line)]
+
+    for start in range(len(words)):
+        for length in range(min(MAX_NAME_WORDS, len(words) - start), 0, -1):
+            name = catalog.lookup(' '.join(words[start:start + length]))
+            if name:
+                return name, NAME_EXACT_SCORE
+
+    for word in words:
+        name = catalog.fuzzy_lookup(word)
+        if name:
+            return name, NAME_FUZZY_SCORE
+
+    return None, 0
+
+def _find_dose(line):
+    match = DOSE_PATTERN.search(line)
+    if not match:
+        return ''
+    value, unit, per_value, per_unit = match.groups()
+    dose = f"{value.replace(',', '.')}{unit.lower()}"
+    if per_unit:
+        dose += f"/{per_value or ''}{per_unit.lower()}"
+    return dose
+
+def _find_frequency(line):
+    for pattern, label in FREQUENCY_PATTERNS:
+        match = pattern.search(line)
+        if match:
+            return label or f"every {match.group(1)} hours"
+    return ''
+
+def _find_duration(line):
+    match = DURATION_PATTERN.search(line)
+    return f"{match.group(1)} {match.group(2).lower()}" if match else ''
+
+def _find_instructions(line):
+    found = [match.group(0).lower() for pattern in INSTRUCTION_PATTERNS
+             for match in [pattern.search(line)] if match]
+    return ', '.join(found)
+
+def _names_unknown_medication(line):
+    """Whether a line without a catalog name gives the dose or frequency of another drug"""
+    starts = [match.start() for match in [DOSE_PATTERN.search(line)] if match]
+    starts += [match.start() for pattern, _ in FREQUENCY_PATTERNS for match in [pattern.search(line)] if match]
+    if not starts:
+        return False
+    words = [word.lower() for word in WORD_PATTERN.findall(line[:min(starts)])]
+    return any(word not in DIRECTION_WORDS for word in words)
+
+def _score(med):
+    score = med['name_score']
+    if med['dosage']:
+        score += DOSE_SCORE
+    if med['frequency']:
+        score += FREQUENCY_SCORE
+    if med['duration'] or med['instructions']:
+        score += EXTRA_SCORE
+    return round(min(score, 1.0), 2)
+
+def extract_medications_locally(text, catalog=None):
+    """
+    Extract medications from prescription text without calling an AI model
+
+    Medication names are looked up in the catalog dictionary, then doses,
+    frequencies, durations and instructions are read from the same line and
+    any following lines that don't name another medication. A line with a
+    dose or frequency for a drug that isn't in the catalog drops the
+    confidence to 0, so the caller asks the LLM instead.
+
+    Args:
+        text (str): Text extracted from the prescription image
+        catalog (CatalogDictionary, optional): Name dictionary, loaded from
+            the database when omitted
+
+    Returns:
+        tuple: (medications, confidence) where medications is a list of
+            dictionaries with a per-medication 'confidence' and confidence
+            is the lowest of them, or 0.0 when nothing was found or a drug
+            wasn't recognized
+    """
+    if catalog is None:
+        catalog = get_catalog_dictionary()
+
+    medications = []
+    current = None
+    unknown_lines = 0
+
+    for line in (text or '').split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+
+        name, name_score = _find_medication(line, catalog)
+        existing = next((med for med in medications if med['name'] == name), None) if name else None
+        if existing:
+            # Repeated mention, keep adding details to the first one
+            current = existing
+            current['name_score'] = max(current['name_score'], name_score)
+        elif name:
+            current = {
+                'name': name,
+                'dosage': '',
+                'frequency': '',
+                'duration': '',
+                'instructions': '',
+                'name_score': name_score
+            }
+            medications.append(current)
+        elif _names_unknown_medication(line):
+            # Its details belong to that drug, not the previous medication
+            unknown_lines += 1
+            current = None
+            continue
+        elif current is None:
+            continue
+
+        # Fill in fields the current medication doesn't have yet
+        for field, finder in (('dosage', _find_dose), ('frequency', _find_frequency),
+                              ('duration', _find_duration), ('instructions', _find_instructions)):
+            if not current[field]:
+                current[field] = finder(line)
+
+    for med in medications:
+        med['confidence'] = _score(med)
+        del med['name_score']
+
+    confidence = min((med['confidence'] for med in medications), default=0.0)
+    if unknown_lines:
+        confidence = 0.0
+    logging.debug(f"Local extraction found {len(medications)} medications with confidence {confidence}")
+    return medications, confidence
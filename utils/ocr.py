@@ -2,30 +2,144 @@ import os
 import cv2
 import base64
 import json
-import pytesseract
 import numpy as np
 import logging
+import threading
 from PIL import Image
-from openai import OpenAI
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+from utils.backends import get_backend
+from utils.resilience import CircuitBreaker, current_deadline, hedged_call
 
-def extract_text_from_image(image_path):
+# OpenAI client, created on the first AI call so that offline backends and
+# code that never calls the API don't need a key
+openai_client = None
+_openai_client_lock = threading.Lock()
+
+# Longest a single AI request may take, even with budget to spare
+AI_REQUEST_TIMEOUT = float(os.environ.get('AI_REQUEST_TIMEOUT', 20))
+# Send a second, hedged request if the first hasn't answered after this many
+# seconds (0 disables hedging)
+AI_HEDGE_AFTER = float(os.environ.get('AI_HEDGE_AFTER', 0))
+
+# Skip the AI path for a while once it keeps failing
+ai_breaker = CircuitBreaker(
+    'openai',
+    failure_threshold=int(os.environ.get('AI_BREAKER_FAILURES', 3)),
+    reset_timeout=float(os.environ.get('AI_BREAKER_RESET', 30))
+)
+
+# Lines whose average word confidence (0-100) is below this are OCRed again
+LOW_CONFIDENCE_THRESHOLD = float(os.environ.get('OCR_LOW_CONFIDENCE', 60))
+# Upper bound on the number of regions retried for a single image
+MAX_REGION_RETRIES = int(os.environ.get('OCR_MAX_REGION_RETRIES', 8))
+# Send regions that are still unreadable to the vision model
+VISION_REGION_FALLBACK = os.environ.get('OCR_VISION_REGIONS', '1') == '1'
+# Pixels of context kept around a line when it is cropped
+REGION_PADDING = 6
+
+# Images sent to the vision model are never larger than this on the long side
+VISION_MAX_DIMENSION = int(os.environ.get('VISION_MAX_DIMENSION', 2048))
+# Typical character height, in pixels, that still reads reliably once scaled
+VISION_MIN_TEXT_HEIGHT = int(os.environ.get('VISION_MIN_TEXT_HEIGHT', 18))
+VISION_JPEG_QUALITY = int(os.environ.get('VISION_JPEG_QUALITY', 80))
+
+def get_openai_client():
+    """
+    Get the shared OpenAI client, creating it on first use
+    
+    Retries are left to hedged_call so that a slow upstream can't make a
+    single call outlive the scan's latency budget.
+    
+    Returns:
+        OpenAI: The client
+    """
+    global openai_client
+    with _openai_client_lock:
+        if openai_client is None:
+            from openai import OpenAI
+            openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"),
+                                   max_retries=int(os.environ.get("OPENAI_MAX_RETRIES", 0)))
+        return openai_client
+
+def recognize_words(image):
+    """
+    Run OCR on a preprocessed image with the selected OCR backend
+    
+    Args:
+        image (numpy.ndarray): Image to recognize
+        
+    Returns:
+        list: Words with their boxes and confidences, see
+            utils.ocr_engine.recognize_words
+    """
+    return get_backend('ocr').recognize_words(image)
+
+def create_chat_completion(**kwargs):
+    """
+    Call the OpenAI chat completions API within the current latency budget
+    
+    The request timeout is the smaller of AI_REQUEST_TIMEOUT and whatever is
+    left of the enclosing deadline_scope. Calls go through the circuit
+    breaker, and are hedged when AI_HEDGE_AFTER is set.
+    
+    Args:
+        **kwargs: Arguments for chat.completions.create
+        
+    Returns:
+        ChatCompletion: The API response
+        
+    Raises:
+        CircuitOpenError: If the AI path is currently disabled
+        DeadlineExceeded: If there is no budget left for the call
+    """
+    deadline = current_deadline()
+    timeout = deadline.timeout(cap=AI_REQUEST_TIMEOUT) if deadline else AI_REQUEST_TIMEOUT
+    
+    def request():
+        return get_openai_client().chat.completions.create(timeout=timeout, **kwargs)
+    
+    return ai_breaker.call(hedged_call, request, hedge_after=AI_HEDGE_AFTER, deadline=deadline)
+
+def decode_image(data):
+    """
+    Decode an uploaded image straight from memory
+    
+    Args:
+        data (bytes): Encoded image, e.g. JPEG or PNG
+        
+    Returns:
+        numpy.ndarray: The decoded BGR image, or None if it can't be decoded
+    """
+    if not data:
+        return None
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    try:
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    except cv2.error as e:
+        logging.error(f"Failed to decode uploaded image: {str(e)}")
+        return None
+
+def extract_text_from_image(image_path=None, image=None, progress=None):
     """
     Extract text from a prescription image using OCR
     
     Args:
-        image_path (str): Path to the image file
+        image_path (str, optional): Path to the image file
+        image (numpy.ndarray, optional): Already decoded image, used instead
+            of reading image_path
+        progress (callable, optional): Called with 'preprocessed' once the
+            image is ready for OCR
         
     Returns:
         str: Extracted text from the image
     """
+    source = image_path or 'upload'
     try:
-        # Read the image using OpenCV
-        image = cv2.imread(image_path)
+        # Read the image using OpenCV unless it was decoded already
+        if image is None and image_path:
+            image = cv2.imread(image_path)
         if image is None:
-            logging.error(f"Failed to load image from {image_path}")
+            logging.error(f"Failed to load image from {source}")
             return "Error: Could not read image"
         
         # Convert to grayscale
@@ -36,41 +150,262 @@ def extract_text_from_image(image_path):
         
         # Noise removal using median blur
         processed_img = cv2.medianBlur(threshold, 3)
+        if progress:
+            progress('preprocessed')
         
         try:
-            # Try to use Tesseract OCR first
-            pytesseract.get_tesseract_version()
-            text = pytesseract.image_to_string(processed_img)
-            logging.debug(f"Successfully extracted text with Tesseract from image: {image_path}")
+            # Try to use Tesseract OCR first, with a warm engine from the pool
+            lines = group_words_into_lines(recognize_words(processed_img))
+            
+            # Only retry the lines Tesseract wasn't sure about
+            lines = reocr_low_confidence_lines(gray, lines)
+            text = '\n'.join(line['text'] for line in lines)
+            logging.debug(f"Successfully extracted text with Tesseract from image: {source}")
         except Exception as e:
             logging.warning(f"Tesseract not available or failed: {str(e)}")
-            # If Tesseract fails, try OpenAI vision API
-            text = analyze_prescription_with_ai(image_path)
+            # If Tesseract fails, try the vision model on the frame we already decoded
+            text = get_backend('vision').read_page(image_path, image=image, binary=processed_img)
             
         return text
     
     except Exception as e:
         logging.error(f"Error during OCR processing: {str(e)}")
         # If traditional OCR fails, try AI-based analysis
-        return analyze_prescription_with_ai(image_path)
+        return get_backend('vision').read_page(image_path, image=image)
+
+def group_words_into_lines(words):
+    """
+    Group OCR words into text lines with a bounding box and confidence
+    
+    Args:
+        words (list): Words as returned by recognize_words
+        
+    Returns:
+        list: Lines in reading order, each with 'text', 'conf' (average word
+            confidence), 'box' as (left, top, right, bottom) and 'source'
+    """
+    grouped = {}
+    for word in words:
+        grouped.setdefault(word['line'], []).append(word)
+    
+    lines = []
+    for line_words in grouped.values():
+        lines.append({
+            'text': ' '.join(word['text'] for word in line_words),
+            'conf': sum(word['conf'] for word in line_words) / len(line_words),
+            'box': (
+                min(word['left'] for word in line_words),
+                min(word['top'] for word in line_words),
+                max(word['left'] + word['width'] for word in line_words),
+                max(word['top'] + word['height'] for word in line_words)
+            ),
+            'source': 'tesseract'
+        })
+    return lines
+
+def crop_region(image, box, padding=REGION_PADDING):
+    """
+    Crop a bounding box out of an image, with some padding
+    
+    Args:
+        image (numpy.ndarray): Image to crop
+        box (tuple): (left, top, right, bottom) in pixels
+        padding (int): Extra pixels to keep on each side
+        
+    Returns:
+        numpy.ndarray: The cropped region
+    """
+    height, width = image.shape[:2]
+    left, top, right, bottom = box
+    return image[max(0, top - padding):min(height, bottom + padding),
+                 max(0, left - padding):min(width, right + padding)]
+
+def reprocess_region(gray_region):
+    """
+    Alternative preprocessing for a hard-to-read region
+    
+    The region is upscaled and binarized with an adaptive threshold, which
+    copes better with uneven lighting than the global threshold used for
+    the whole page.
+    
+    Args:
+        gray_region (numpy.ndarray): Grayscale crop of the original image
+        
+    Returns:
+        numpy.ndarray: Binarized region ready for OCR
+    """
+    scaled = cv2.resize(gray_region, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    return cv2.adaptiveThreshold(scaled, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                 cv2.THRESH_BINARY, 31, 15)
+
+def reocr_low_confidence_lines(gray, lines):
+    """
+    OCR low-confidence lines again, first locally and then with the vision model
+    
+    Args:
+        gray (numpy.ndarray): Grayscale version of the whole image
+        lines (list): Lines as returned by group_words_into_lines
+        
+    Returns:
+        list: The same lines, with retried ones updated in place
+    """
+    retried = 0
+    for line in lines:
+        if line['conf'] >= LOW_CONFIDENCE_THRESHOLD:
+            continue
+        if retried >= MAX_REGION_RETRIES:
+            logging.debug("Reached the region retry limit, keeping remaining lines as they are")
+            break
+        retried += 1
+        
+        region = crop_region(gray, line['box'])
+        if region.size == 0:
+            continue
+        
+        words = recognize_words(reprocess_region(region))
+        if words:
+            conf = sum(word['conf'] for word in words) / len(words)
+            if conf > line['conf']:
+                line.update(text=' '.join(word['text'] for word in words), conf=conf, source='reprocessed')
+        
+        if line['conf'] < LOW_CONFIDENCE_THRESHOLD and VISION_REGION_FALLBACK:
+            text = get_backend('vision').read_region(region)
+            if text:
+                line.update(text=text, source='vision')
+    
+    if retried:
+        logging.debug(f"Re-OCRed {retried} low-confidence regions")
+    return lines
 
-def analyze_prescription_with_ai(image_path):
+def analyze_region_with_ai(region):
+    """
+    Use OpenAI's vision capabilities to read a single cropped line
+    
+    Args:
+        region (numpy.ndarray): Cropped part of the prescription image
+        
+    Returns:
+        str: Text in the region, or None if it could not be read
+    """
+    try:
+        ok, encoded = cv2.imencode('.png', region)
+        if not ok:
+            return None
+        base64_image = base64.b64encode(encoded.tobytes()).decode('utf-8')
+        
+        response = create_chat_completion(
+            model="gpt-4o",
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You transcribe single lines cropped from prescriptions. "
+                            "Reply with the text in the image exactly as written and nothing else."
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": f"data:image/png;base64,{base64_image}"}
+                        }
+                    ]
+                }
+            ],
+            max_tokens=100
+        )
+        
+        text = response.choices[0].message.content
+        return text.strip() if text else None
+    
+    except Exception as e:
+        logging.error(f"Error during AI region analysis: {str(e)}")
+        return None
+
+def estimate_text_height(binary):
+    """
+    Estimate the typical character height in a binarized page
+    
+    Args:
+        binary (numpy.ndarray): Black text on a white background
+        
+    Returns:
+        float: Median height of character-sized blobs, or None if no text
+            was found
+    """
+    count, _, stats, _ = cv2.connectedComponentsWithStats(cv2.bitwise_not(binary), connectivity=8)
+    heights = stats[1:count, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:count, cv2.CC_STAT_WIDTH]
+    
+    # Ignore specks, rules and blobs too large to be characters
+    max_height = binary.shape[0] / 8
+    is_char = (heights >= 4) & (heights <= max_height) & (widths <= heights * 3)
+    if not is_char.any():
+        return None
+    return float(np.median(heights[is_char]))
+
+def encode_for_vision(image, binary=None):
+    """
+    Downscale and JPEG-compress an image for the vision model
+    
+    The image is shrunk as far as it can go while characters stay at least
+    VISION_MIN_TEXT_HEIGHT pixels tall, and never beyond VISION_MAX_DIMENSION
+    on its long side. It is never enlarged.
+    
+    Args:
+        image (numpy.ndarray): Decoded BGR or grayscale image
+        binary (numpy.ndarray, optional): Binarized version of the image,
+            used to measure the text size
+        
+    Returns:
+        str: Base64-encoded JPEG data
+    """
+    height, width = image.shape[:2]
+    
+    if binary is None:
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    
+    scale = 1.0
+    text_height = estimate_text_height(binary)
+    if text_height:
+        scale = min(scale, VISION_MIN_TEXT_HEIGHT / text_height)
+    scale = min(scale, VISION_MAX_DIMENSION / max(height, width))
+    
+    if scale < 1.0:
+        image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, VISION_JPEG_QUALITY])
+    if not ok:
+        raise ValueError("Could not encode image for AI analysis")
+    
+    logging.debug(f"Encoded {width}x{height} image at scale {scale:.2f} into {len(encoded)} bytes")
+    return base64.b64encode(encoded.tobytes()).decode('utf-8')
+
+def analyze_prescription_with_ai(image_path, image=None, binary=None):
     """
     Use OpenAI's vision capabilities to analyze prescription images
     
     Args:
         image_path (str): Path to the image file
+        image (numpy.ndarray, optional): Already decoded image, so the file
+            doesn't have to be read again
+        binary (numpy.ndarray, optional): Binarized image from the OCR stage
         
     Returns:
         str: Extracted text and analysis from the image
     """
     try:
-        # Read image and convert to base64
-        with open(image_path, "rb") as img_file:
-            base64_image = base64.b64encode(img_file.read()).decode('utf-8')
+        if image is None:
+            image = cv2.imread(image_path)
+            if image is None:
+                raise ValueError(f"Could not read image {image_path}")
+        
+        # Shrink and recompress the image before sending it
+        base64_image = encode_for_vision(image, binary)
         
         # Call OpenAI API with the image
-        response = openai_client.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4o", # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
             messages=[
                 {
@@ -119,7 +454,7 @@ def extract_medications_from_text(text):
     """
     try:
         # Use AI to extract structured medication information
-        response = openai_client.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4o", # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
             messages=[
                 {
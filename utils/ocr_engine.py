@@ -0,0 +1,301 @@
+import os
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pytesseract
+from PIL import Image
+
+# Number of long-lived engines kept per worker process
+OCR_POOL_SIZE = int(os.environ.get('OCR_POOL_SIZE', min(4, os.cpu_count() or 1)))
+OCR_LANGUAGE = os.environ.get('OCR_LANGUAGE', 'eng')
+
+# How long a scan waits for a free engine before using the subprocess path
+OCR_ACQUIRE_TIMEOUT = float(os.environ.get('OCR_ACQUIRE_TIMEOUT', 5))
+
+
+class SubprocessOCREngine:
+    """Runs a new tesseract process for every image via pytesseract"""
+
+    name = 'subprocess'
+
+    # Tesseract availability is checked once per process, not once per scan
+    _available = None
+    _check_lock = threading.Lock()
+
+    def __init__(self, lang=OCR_LANGUAGE):
+        self.lang = lang
+
+    @classmethod
+    def is_available(cls):
+        with cls._check_lock:
+            if cls._available is None:
+                try:
+                    pytesseract.get_tesseract_version()
+                    cls._available = True
+                except Exception as e:
+                    logging.warning(f"Tesseract not available: {str(e)}")
+                    cls._available = False
+            return cls._available
+
+    def image_to_string(self, image):
+        if not self.is_available():
+            raise RuntimeError("Tesseract is not installed")
+        return pytesseract.image_to_string(image, lang=self.lang)
+
+    def image_to_data(self, image):
+        if not self.is_available():
+            raise RuntimeError("Tesseract is not installed")
+        data = pytesseract.image_to_data(image, lang=self.lang, output_type=pytesseract.Output.DICT)
+
+        words = []
+        for i, text in enumerate(data['text']):
+            if not text.strip():
+                continue
+            words.append({
+                'text': text.strip(),
+                'conf': float(data['conf'][i]),
+                'left': data['left'][i],
+                'top': data['top'][i],
+                'width': data['width'][i],
+                'height': data['height'][i],
+                'line': (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+            })
+        return words
+
+    def healthy(self):
+        return self.is_available()
+
+    def close(self):
+        pass
+
+
+class TesserocrEngine:
+    """A tesseract instance that stays loaded between scans (needs tesserocr)"""
+
+    name = 'tesserocr'
+
+    def __init__(self, lang=OCR_LANGUAGE):
+        # Imported here because tesserocr is an optional dependency
+        from tesserocr import PyTessBaseAPI
+        self.lang = lang
+        self._api = PyTessBaseAPI(lang=lang)
+
+    def image_to_string(self, image):
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        try:
+            self._api.SetImage(image)
+            return self._api.GetUTF8Text()
+        finally:
+            self._api.Clear()
+
+    def image_to_data(self, image):
+        from tesserocr import RIL, iterate_level
+
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+
+        words = []
+        line = 0
+        try:
+            self._api.SetImage(image)
+            self._api.Recognize()
+            for word in iterate_level(self._api.GetIterator(), RIL.WORD):
+                if word.IsAtBeginningOf(RIL.TEXTLINE):
+                    line += 1
+                text = (word.GetUTF8Text(RIL.WORD) or '').strip()
+                if not text:
+                    continue
+                left, top, right, bottom = word.BoundingBox(RIL.WORD)
+                words.append({
+                    'text': text,
+                    'conf': float(word.Confidence(RIL.WORD)),
+                    'left': left,
+                    'top': top,
+                    'width': right - left,
+                    'height': bottom - top,
+                    'line': line
+                })
+        finally:
+            self._api.Clear()
+        return words
+
+    def healthy(self):
+        try:
+            self.image_to_string(Image.new('L', (32, 32), 255))
+            return True
+        except Exception as e:
+            logging.warning(f"OCR engine failed health check: {str(e)}")
+            return False
+
+    def close(self):
+        self._api.End()
+
+
+class OCREnginePool:
+    """A fixed set of pre-initialized OCR engines shared by request threads"""
+
+    def __init__(self, factory=TesserocrEngine, size=OCR_POOL_SIZE, fallback=None):
+        self.factory = factory
+        self.size = size
+        self.fallback = fallback or SubprocessOCREngine()
+        self._engines = queue.Queue()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Create the engines, paying their startup cost once
+
+        Returns:
+            int: Number of engines that started successfully
+        """
+        with self._lock:
+            if self._started:
+                return self._engines.qsize()
+
+            for _ in range(self.size):
+                engine = self._create_engine()
+                if engine is None:
+                    break
+                self._engines.put(engine)
+
+            # Only wait for engines that actually exist
+            self.size = started = self._engines.qsize()
+            self._started = True
+
+        if started:
+            logging.info(f"Started {started} OCR engines")
+        else:
+            logging.info(f"No pooled OCR engines, using {self.fallback.name} OCR")
+        return started
+
+    def _create_engine(self):
+        try:
+            return self.factory()
+        except Exception as e:
+            logging.warning(f"Could not start OCR engine: {str(e)}")
+            return None
+
+    def _engine_lost(self):
+        # Stop waiting for an engine that couldn't be replaced
+        with self._lock:
+            self.size -= 1
+
+    @contextmanager
+    def engine(self):
+        """Borrow an engine, falling back to the subprocess path if none is free"""
+        if not self._started:
+            self.start()
+
+        try:
+            engine = self._engines.get(timeout=OCR_ACQUIRE_TIMEOUT) if self.size else None
+        except queue.Empty:
+            engine = None
+
+        if engine is None:
+            yield self.fallback
+            return
+
+        try:
+            yield engine
+        except Exception:
+            # Don't hand a possibly broken engine to the next scan
+            if not engine.healthy():
+                engine.close()
+                engine = self._create_engine()
+            raise
+        finally:
+            if engine is not None:
+                self._engines.put(engine)
+            else:
+                self._engine_lost()
+
+    def health_check(self):
+        """
+        Check every idle engine, replacing the ones that stopped working
+
+        Returns:
+            dict: Pool size, healthy engine count and the fallback engine
+        """
+        if not self._started:
+            self.start()
+
+        healthy = 0
+        engines = []
+        while True:
+            try:
+                engines.append(self._engines.get_nowait())
+            except queue.Empty:
+                break
+
+        for engine in engines:
+            if not engine.healthy():
+                engine.close()
+                engine = self._create_engine()
+            if engine is not None:
+                healthy += 1
+                self._engines.put(engine)
+            else:
+                self._engine_lost()
+
+        return {
+            'size': self.size,
+            'healthy': healthy,
+            'fallback': self.fallback.name,
+            'fallback_available': self.fallback.healthy()
+        }
+
+    def image_to_string(self, image):
+        with self.engine() as engine:
+            return engine.image_to_string(image)
+
+    def image_to_data(self, image):
+        with self.engine() as engine:
+            return engine.image_to_data(image)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_ocr_pool():
+    """
+    Get the OCR engine pool for this worker, creating it on first use
+
+    Returns:
+        OCREnginePool: The shared pool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OCREnginePool()
+        return _pool
+
+def recognize_text(image):
+    """
+    Run OCR on a preprocessed image using a pooled engine
+
+    Args:
+        image (numpy.ndarray or PIL.Image.Image): Image to recognize
+
+    Returns:
+        str: Recognized text
+    """
+    return get_ocr_pool().image_to_string(image)
+
+def recognize_words(image):
+    """
+    Run OCR on a preprocessed image, keeping word positions and confidences
+
+    Args:
+        image (numpy.ndarray or PIL.Image.Image): Image to recognize
+
+    Returns:
+        list: One dictionary per word with 'text', 'conf' (0-100), the
+            'left', 'top', 'width' and 'height' of its bounding box and a
+            'line' key shared by words on the same text line
+    """
+    return get_ocr_pool().image_to_data(image)
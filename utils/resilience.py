@@ -0,0 +1,223 @@
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class DeadlineExceeded(Exception):
+    """Raised when there is not enough of the latency budget left for a call"""
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is skipped because its circuit breaker is open"""
+
+
+class Deadline:
+    """A point in time by which a piece of work has to be finished"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap=None, minimum=0.1):
+        """
+        Time a single call may take without overrunning the deadline
+
+        Args:
+            cap (float, optional): Upper bound for the timeout
+            minimum (float): Smallest timeout worth attempting a call with
+
+        Returns:
+            float: Timeout in seconds
+
+        Raises:
+            DeadlineExceeded: If less than minimum seconds are left
+        """
+        remaining = self.remaining()
+        if remaining < minimum:
+            raise DeadlineExceeded(f"Latency budget of {self.seconds}s exhausted")
+        return min(remaining, cap) if cap else remaining
+
+    def __repr__(self):
+        return f'<Deadline {self.remaining():.2f}s of {self.seconds}s left>'
+
+
+_current_deadline = contextvars.ContextVar('deadline', default=None)
+
+@contextmanager
+def deadline_scope(seconds):
+    """
+    Run a block of work under a latency budget
+
+    Nested scopes never extend the budget of an enclosing one.
+
+    Args:
+        seconds (float): Budget for the block
+
+    Yields:
+        Deadline: The deadline in effect inside the block
+    """
+    deadline = Deadline(seconds)
+    outer = _current_deadline.get()
+    if outer is not None and outer.expires_at < deadline.expires_at:
+        deadline = outer
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+def current_deadline():
+    """
+    Get the deadline of the enclosing deadline_scope
+
+    Returns:
+        Deadline: The current deadline, or None outside any scope
+    """
+    return _current_deadline.get()
+
+def propagate_context(func):
+    """
+    Wrap func so it runs with the caller's deadline in a worker thread
+
+    Context variables are not inherited by thread pool workers, so work
+    handed to an executor has to carry them explicitly.
+
+    Args:
+        func (callable): Function to run in another thread
+
+    Returns:
+        callable: Function that runs func in a copy of the current context
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+class CircuitBreaker:
+    """Stops calling a dependency for a while after repeated failures
+
+    After failure_threshold consecutive failures the circuit opens and
+    calls are refused. Once reset_timeout seconds have passed a single
+    trial call is let through; it closes the circuit if it succeeds and
+    reopens it if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        """Whether a call may go ahead right now"""
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._trial_in_flight:
+                    logging.warning(f"Circuit breaker '{self.name}' opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func through the breaker
+
+        Raises:
+            CircuitOpenError: If the circuit is open
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit breaker '{self.name}' is open")
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+_hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+def hedged_call(func, hedge_after=None, deadline=None):
+    """
+    Call func, starting a second identical attempt if the first is slow
+
+    The first attempt to succeed wins. The slower one is left to finish in
+    the background and its result is discarded.
+
+    Args:
+        func (callable): Zero-argument function to call
+        hedge_after (float, optional): Seconds to wait before hedging, no
+            hedging when None or 0
+        deadline (Deadline, optional): Don't hedge if the deadline would
+            pass before the hedge could help
+
+    Returns:
+        The result of the first successful attempt
+
+    Raises:
+        Exception: The error of the last attempt when every attempt failed
+    """
+    if not hedge_after or (deadline is not None and deadline.remaining() <= hedge_after):
+        return func()
+
+    func = propagate_context(func)
+    pending = {_hedge_executor.submit(func)}
+    done, pending = wait(pending, timeout=hedge_after)
+
+    if not done:
+        logging.info(f"No response after {hedge_after}s, sending a hedged request")
+        pending.add(_hedge_executor.submit(func))
+
+    error = None
+    while True:
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        if not pending:
+            raise error
+        timeout = deadline.remaining() if deadline is not None else None
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            raise DeadlineExceeded("Latency budget exhausted while waiting for a response")
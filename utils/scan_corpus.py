@@ -0,0 +1,101 @@
+import os
+import logging
+
+import cv2
+import numpy as np
+
+# Medication lines of the synthetic prescriptions, in the 'Name dose - frequency'
+# shape the fake extraction backend understands
+SAMPLE_PRESCRIPTIONS = [
+    ("Ibuprofen 200mg - every 6 hours", "Acetaminophen 500mg - as needed"),
+    ("Warfarin 5mg - once daily", "Aspirin 81mg - once daily"),
+    ("Amoxicillin 500mg - three times daily", "Ibuprofen 400mg - twice daily"),
+    ("Lisinopril 10mg - once daily", "Metformin 500mg - twice daily", "Atorvastatin 20mg - at bedtime"),
+    ("Omeprazole 20mg - once daily", "Acetaminophen 1000mg - every 8 hours"),
+    ("Metformin 850mg - twice daily", "Lisinopril 20mg - once daily"),
+]
+
+PATIENT_NAMES = ["John Doe", "Jane Smith", "Alex Nguyen", "Maria Garcia", "Sam Lee"]
+
+def render_prescription(lines, rng, size=(1000, 800)):
+    """
+    Draw a prescription-like page with some of the imperfections of a photo
+
+    Args:
+        lines (list): Medication lines to write
+        rng (numpy.random.Generator): Source of the page's random variation
+        size (tuple): (height, width) of the page in pixels
+
+    Returns:
+        numpy.ndarray: The page as a BGR image
+    """
+    height, width = size
+    page = np.full((height, width, 3), 255, dtype=np.uint8)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    scale = rng.uniform(0.9, 1.2)
+
+    header = ["Rx", f"Patient: {rng.choice(PATIENT_NAMES)}", f"Date: 2024-{rng.integers(1, 13):02d}-{rng.integers(1, 29):02d}"]
+    y = 80
+    for text in header + [''] + list(lines) + ['', "Dr. Test Doctor"]:
+        if text:
+            x = int(60 + rng.integers(-10, 10))
+            cv2.putText(page, text, (x, y), font, scale, (30, 30, 30), 2, cv2.LINE_AA)
+        y += int(55 * scale)
+
+    # A slightly rotated, unevenly lit, noisy capture
+    angle = rng.uniform(-2.0, 2.0)
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    page = cv2.warpAffine(page, rotation, (width, height), borderValue=(255, 255, 255))
+    shading = np.linspace(rng.uniform(0.85, 1.0), 1.0, width, dtype=np.float32)
+    noise = rng.normal(0, 6, page.shape).astype(np.float32)
+    page = page.astype(np.float32) * shading[None, :, None] + noise
+    return np.clip(page, 0, 255).astype(np.uint8)
+
+def generate_corpus(count, seed=0, size=(1000, 800), quality=85):
+    """
+    Generate synthetic prescription scans
+
+    The same count and seed always give the same images.
+
+    Args:
+        count (int): Number of scans
+        seed (int): Random seed
+        size (tuple): (height, width) of each page
+        quality (int): JPEG quality of the encoded scans
+
+    Returns:
+        list: (lines, jpeg_bytes) tuples, lines being the medication lines
+            drawn on the page
+    """
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for i in range(count):
+        lines = SAMPLE_PRESCRIPTIONS[i % len(SAMPLE_PRESCRIPTIONS)]
+        page = render_prescription(lines, rng, size)
+        ok, encoded = cv2.imencode('.jpg', page, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("Could not encode synthetic prescription")
+        corpus.append((lines, encoded.tobytes()))
+    return corpus
+
+def write_corpus(directory, count, seed=0):
+    """
+    Write a synthetic corpus to disk as numbered JPEG files
+
+    Args:
+        directory (str): Output directory, created if needed
+        count (int): Number of scans
+        seed (int): Random seed
+
+    Returns:
+        list: Paths of the written files
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, (_, data) in enumerate(generate_corpus(count, seed), 1):
+        path = os.path.join(directory, f'prescription_{i:04d}.jpg')
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+    logging.info(f"Wrote {len(paths)} synthetic prescriptions to {directory}")
+    return paths
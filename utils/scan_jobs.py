@@ -0,0 +1,226 @@
+import os
+import logging
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app
+from utils.scan_pipeline import run_scan_pipeline, run_batch_scan_pipeline, split_scan_pages
+
+# Job states, separate from the pipeline stage the job has reached
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+class ScanJob:
+    """A prescription scan running in the background
+
+    Every stage change is also appended to events, so progress can be
+    streamed to the client as it happens instead of polled.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = JOB_QUEUED
+        self.stage = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.events = []
+        self._changed = threading.Condition()
+        self._finished = threading.Event()
+
+    @property
+    def is_finished(self):
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def _publish(self, event, data):
+        with self._changed:
+            self.events.append({'event': event, 'data': data})
+            self._changed.notify_all()
+
+    def set_stage(self, stage, data=None):
+        """
+        Record that the job reached a pipeline stage
+
+        Args:
+            stage (str): One of SCAN_STAGES
+            data (dict, optional): Partial results available at this stage
+        """
+        self.status = JOB_RUNNING
+        self.stage = stage
+        self.updated_at = time.time()
+        self._publish('stage', {'stage': stage, **(data or {})})
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.status = JOB_FAILED if error else JOB_DONE
+        self.stage = 'failed' if error else 'done'
+        self.updated_at = time.time()
+        self._finished.set()
+        self._publish(self.status, self.to_dict())
+
+    def wait(self, timeout=None):
+        """Block until the job has finished, returning whether it did"""
+        return self._finished.wait(timeout)
+
+    def events_since(self, index, timeout=None):
+        """
+        Get the events published after the first index ones
+
+        Args:
+            index (int): Number of events the caller has already seen
+            timeout (float, optional): Seconds to wait for a new event
+
+        Returns:
+            list: New events, empty if none arrived within the timeout
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > index, timeout)
+            return self.events[index:]
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'error': self.error
+        }
+
+    def __repr__(self):
+        return f'<ScanJob {self.id} {self.status}:{self.stage}>'
+
+
+class ScanJobStore:
+    """In-process registry of scan jobs backed by a small thread pool"""
+
+    def __init__(self, max_workers=2, ttl=3600):
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix='scan-job')
+        return self._executor
+
+    def _prune(self):
+        # Forget finished jobs nobody has collected within the TTL
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.is_finished and job.updated_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def submit(self, func, *args):
+        """
+        Queue a job that runs func(job, *args) on the worker pool
+
+        Args:
+            func (callable): Job body, receives the ScanJob first
+            *args: Extra positional arguments for func
+
+        Returns:
+            ScanJob: The queued job
+        """
+        job = ScanJob()
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+
+        self._get_executor().submit(self._run, job, func, *args)
+        return job
+
+    def _run(self, job, func, *args):
+        try:
+            job.finish(result=func(job, *args))
+        except Exception as e:
+            logging.error(f"Scan job {job.id} failed: {str(e)}")
+            job.finish(error=str(e))
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+
+scan_jobs = ScanJobStore(
+    max_workers=int(os.environ.get('SCAN_JOB_WORKERS', 2)),
+    ttl=int(os.environ.get('SCAN_JOB_TTL', 3600))
+)
+
+def _scan_job_body(job, image_bytes, user_id):
+    with app.app_context():
+        return run_scan_pipeline(image_bytes=image_bytes, progress=job.set_stage, user_id=user_id)
+
+def submit_scan_job(image_bytes, user_id=None):
+    """
+    Start processing a prescription image in the background
+
+    The image is decoded from memory, it never touches the disk.
+
+    Args:
+        image_bytes (bytes): Encoded image uploaded by the client
+        user_id (int, optional): ID of the uploading user
+
+    Returns:
+        ScanJob: The queued job, poll it with get_scan_job
+    """
+    job = scan_jobs.submit(_scan_job_body, bytes(image_bytes), user_id)
+    logging.info(f"Queued scan job {job.id} for a {len(image_bytes)} byte image")
+    return job
+
+def _batch_scan_job_body(job, uploads):
+    page_paths = []
+    try:
+        # PDFs are rasterized here rather than in the request that uploaded them
+        for filename, data in uploads:
+            for page in split_scan_pages(filename, data):
+                with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_file:
+                    temp_file.write(page)
+                    page_paths.append(temp_file.name)
+        job.set_stage('decoded')
+
+        with app.app_context():
+            return run_batch_scan_pipeline(page_paths, progress=job.set_stage)
+    finally:
+        for page_path in page_paths:
+            os.unlink(page_path)
+
+def submit_batch_scan_job(uploads):
+    """
+    Start processing a multi-page prescription in the background
+
+    Multi-page TIFF and PDF files are split into pages by the job, so the
+    caller should have checked their page count with count_scan_pages.
+
+    Args:
+        uploads (list): (filename, bytes) tuples, one per uploaded file, in
+            page order
+
+    Returns:
+        ScanJob: The queued job, poll it with get_scan_job
+    """
+    uploads = [(filename, bytes(data)) for filename, data in uploads]
+    job = scan_jobs.submit(_batch_scan_job_body, uploads)
+    logging.info(f"Queued batch scan job {job.id} with {len(uploads)} files")
+    return job
+
+def get_scan_job(job_id):
+    """
+    Look up a scan job by ID
+
+    Args:
+        job_id (str): ID returned by submit_scan_job
+
+    Returns:
+        ScanJob: The job, or None if it is unknown or expired
+    """
+    return scan_jobs.get(job_id)
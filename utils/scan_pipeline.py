@@ -0,0 +1,423 @@
+import io
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import or_
+
+from models import Medication
+from utils.resilience import deadline_scope, current_deadline, propagate_context
+
+# Stages reported by the scan pipeline, in the order they are reached
+SCAN_STAGES = ['queued', 'decoded', 'preprocessed', 'ocr_done', 'extraction_done', 'resolved', 'done']
+
+# Number of pages of a batch scan processed at the same time
+OCR_WORKERS = int(os.environ.get('SCAN_OCR_WORKERS', 4))
+
+# Seconds a scan may spend across OCR, vision and extraction calls
+SCAN_LATENCY_BUDGET = float(os.environ.get('SCAN_LATENCY_BUDGET', 30))
+
+def preload_scan_stack(start_ocr_pool=False):
+    """
+    Load the OCR and AI stack before the first scan instead of during it
+
+    The stack is otherwise imported on first use, so workers that never scan
+    don't pay for it. Workers dedicated to scanning can call this (or set
+    SCAN_PRELOAD=1) to move the cost to startup.
+
+    Args:
+        start_ocr_pool (bool): Also start this process's pooled OCR engines.
+            Only do this after forking, engines can't be shared between
+            processes.
+    """
+    from utils import ocr, scan_store  # noqa: F401
+    from utils.backends import BACKEND_KINDS, get_backend
+
+    for kind in BACKEND_KINDS:
+        get_backend(kind)
+    if start_ocr_pool:
+        from utils.ocr_engine import get_ocr_pool
+        get_ocr_pool().start()
+    logging.info("Preloaded the scan stack")
+
+def resolve_medications(detected_medications):
+    """
+    Map medications detected in a prescription to catalog entries
+
+    Args:
+        detected_medications (list): Dictionaries with 'name', 'dosage',
+            'frequency', 'duration' and 'instructions' keys
+
+    Returns:
+        list: Medication dictionaries ready to be shown to the user
+    """
+    medications = []
+    seen_ids = set()
+
+    names = [med_info.get('name') for med_info in detected_medications if med_info.get('name')]
+    if not names:
+        return medications
+
+    # Look up every detected name in one query, then match candidates in Python
+    candidates = Medication.query.filter(or_(*[
+        Medication.name.ilike(f'%{name}%') | Medication.generic_name.ilike(f'%{name}%')
+        for name in names
+    ])).all()
+
+    for med_info in detected_medications:
+        name = med_info.get('name')
+        if not name:
+            continue
+
+        needle = name.lower()
+        med_matches = [
+            med for med in candidates
+            if needle in med.name.lower() or (med.generic_name and needle in med.generic_name.lower())
+        ]
+
+        if med_matches:
+            # Use database entries
+            for med in med_matches:
+                # The same catalog entry can be matched by more than one name
+                if med.id in seen_ids:
+                    continue
+                seen_ids.add(med.id)
+                medications.append({
+                    'id': med.id,
+                    'name': med.name,
+                    'strength': med.strength,
+                    'dosage_form': med.dosage_form,
+                    'dosage': med_info.get('dosage', ''),
+                    'frequency': med_info.get('frequency', ''),
+                    'duration': med_info.get('duration', ''),
+                    'instructions': med_info.get('instructions', '')
+                })
+        else:
+            # Medication not found in database, create a temporary entry
+            # In a real app, you might want to add new medications to the database
+            # or notify pharmacy staff about unknown medications
+            medications.append({
+                'id': f'temp_{len(medications)}',  # Temporary ID
+                'name': name,
+                'strength': med_info.get('dosage', ''),
+                'dosage_form': '',
+                'dosage': med_info.get('dosage', ''),
+                'frequency': med_info.get('frequency', ''),
+                'duration': med_info.get('duration', ''),
+                'instructions': med_info.get('instructions', '')
+            })
+
+    return medications
+
+def parse_labelled_medications(extracted_text):
+    """
+    Fallback parser for "Medication: <name>" lines in the extracted text
+
+    Args:
+        extracted_text (str): Text extracted from the prescription image
+
+    Returns:
+        list: Medication dictionaries for catalog matches
+    """
+    medications = []
+
+    for line in extracted_text.split('\n'):
+        line = line.strip()
+        if line and ('medication:' in line.lower() or 'drug:' in line.lower()):
+            parts = line.split(':')
+            if len(parts) > 1:
+                med_name = parts[1].strip()
+                med_matches = Medication.query.filter(
+                    Medication.name.ilike(f'%{med_name}%')
+                ).all()
+
+                for med in med_matches:
+                    medications.append({
+                        'id': med.id,
+                        'name': med.name,
+                        'strength': med.strength,
+                        'dosage_form': med.dosage_form
+                    })
+
+    return medications
+
+def extract_medications(text, catalog=None):
+    """
+    Extract medications locally, only asking the extraction backend (the
+    LLM by default) when confidence is low
+
+    Args:
+        text (str): Text extracted from the prescription image
+        catalog (CatalogDictionary, optional): Medication name dictionary
+
+    Returns:
+        list: Detected medication dictionaries
+    """
+    # Imported here so the OCR and AI stack is only loaded by scanning code
+    from utils.backends import get_backend
+    from utils.med_extractor import extract_medications_locally, LOCAL_CONFIDENCE_THRESHOLD
+
+    local_medications, confidence = extract_medications_locally(text, catalog)
+    if local_medications and confidence >= LOCAL_CONFIDENCE_THRESHOLD:
+        logging.info(f"Using local extraction ({confidence:.2f} confidence), skipping the LLM")
+        return local_medications
+
+    deadline = current_deadline()
+    if deadline is not None and deadline.expired:
+        logging.warning("Scan latency budget exhausted, using local extraction only")
+        return local_medications
+
+    detected_medications = get_backend('extraction').extract_medications(text)
+    return detected_medications or local_medications
+
+def run_scan_pipeline(image_path=None, progress=None, image_bytes=None, user_id=None):
+    """
+    Run OCR, medication extraction and catalog matching on a prescription image
+
+    Uploaded images (image_bytes) are looked up in the uploading user's
+    stored scans first, and an identical earlier scan is reused instead of
+    being processed again. A similar looking one is only reused once OCR
+    shows it has the same text, saving the extraction. New scans by signed in
+    users that found medications are added to the store.
+
+    Args:
+        image_path (str, optional): Path to the image file
+        progress (callable, optional): Called as progress(stage, data) each
+            time a stage finishes, data holds partial results or is None
+        image_bytes (bytes, optional): Encoded image to decode in memory
+            instead of reading image_path
+        user_id (int, optional): ID of the uploading user, stored scans are
+            only reused for the same user
+
+    Returns:
+        dict: 'extracted_text' and 'medications' for the scan, plus
+            'scan_id' when the scan is in the store
+    """
+    # Imported here so the OCR and AI stack is only loaded by scanning code
+    from utils.ocr import decode_image, extract_text_from_image
+    from utils.scan_store import (scan_fingerprint, find_duplicate_scan, find_similar_scan, same_scan_text,
+                                  save_scan, scan_result)
+
+    def report(stage, data=None):
+        if progress:
+            progress(stage, data)
+
+    fingerprint = None
+    similar = None
+    with deadline_scope(SCAN_LATENCY_BUDGET):
+        image = None
+        if image_bytes is not None:
+            image = decode_image(image_bytes)
+            report('decoded')
+
+        if image is not None:
+            fingerprint = scan_fingerprint(image_bytes, image)
+            previous = find_duplicate_scan(fingerprint, user_id)
+            if previous is not None:
+                result = scan_result(previous)
+                report('resolved', {'medications': result['medications']})
+                return result
+            similar = find_similar_scan(fingerprint, user_id)
+
+        # Extract text from the image using enhanced OCR with AI capabilities
+        extracted_text = extract_text_from_image(image_path, image=image, progress=report)
+        report('ocr_done', {'extracted_text': extracted_text})
+
+        medications = None
+        if similar is not None and same_scan_text(similar.extracted_text, extracted_text):
+            # The same prescription photographed again, its medications are already known
+            logging.info(f"Scan has the same text as stored scan {similar.id}, reusing its medications")
+            medications = scan_result(similar)['medications']
+        else:
+            # Extract structured medication information, locally when possible
+            detected_medications = extract_medications(extracted_text)
+            report('extraction_done', {'medications': detected_medications or []})
+
+    if medications is None:
+        # Map the detected medications to database entries if possible
+        medications = resolve_medications(detected_medications or [])
+
+        # If AI extraction didn't work, fall back to the simple method
+        if not medications:
+            logging.info("Medication extraction didn't find medications, using fallback method")
+            medications = parse_labelled_medications(extracted_text)
+    report('resolved', {'medications': medications})
+
+    result = {
+        'extracted_text': extracted_text,
+        'medications': medications
+    }
+    # Failed scans aren't stored, so the next attempt runs the pipeline again.
+    # Anonymous scans could never be reused, so their images aren't kept.
+    if fingerprint is not None and medications and user_id is not None:
+        result['scan_id'] = save_scan(image_bytes, fingerprint, result, user_id).id
+    return result
+
+def merge_detected_medications(detected_lists):
+    """
+    Merge medications detected on several pages, dropping duplicates
+
+    Medications are matched on their lowercased name. Fields missing from the
+    first occurrence are filled in from later ones.
+
+    Args:
+        detected_lists (list): One list of detected medications per page
+
+    Returns:
+        list: De-duplicated medication dictionaries in first-seen order
+    """
+    merged = {}
+
+    for detected in detected_lists:
+        for med_info in detected or []:
+            name = (med_info.get('name') or '').strip()
+            if not name:
+                continue
+
+            key = ' '.join(name.lower().split())
+            if key not in merged:
+                merged[key] = dict(med_info, name=name)
+                continue
+
+            existing = merged[key]
+            for field, value in med_info.items():
+                if value and not existing.get(field):
+                    existing[field] = value
+
+    return list(merged.values())
+
+def _is_pdf(filename, data):
+    return data[:5] == b'%PDF-' or filename.lower().endswith('.pdf')
+
+def count_scan_pages(filename, data):
+    """
+    Count the pages of an uploaded scan without rasterizing them
+
+    Lets a request reject a document with too many pages before paying for
+    split_scan_pages.
+
+    Args:
+        filename (str): Name of the uploaded file
+        data (bytes): Contents of the uploaded file
+
+    Returns:
+        int: Number of pages, 1 for single images and unreadable files
+
+    Raises:
+        ValueError: If the file is a PDF that can't be read, or pdf2image
+            is not available
+    """
+    from PIL import Image
+
+    if _is_pdf(filename, data):
+        try:
+            from pdf2image import pdfinfo_from_bytes
+        except ImportError:
+            raise ValueError("PDF scans require the pdf2image package")
+        try:
+            return int(pdfinfo_from_bytes(data)['Pages'])
+        except Exception as e:
+            raise ValueError(f"Could not read PDF: {str(e)}")
+
+    try:
+        # Only the header is parsed, frames are read when they are used
+        image = Image.open(io.BytesIO(data))
+    except Exception:
+        return 1
+    return getattr(image, 'n_frames', 1)
+
+def split_scan_pages(filename, data):
+    """
+    Split an uploaded scan into single-page images
+
+    Multi-page TIFFs are split with Pillow and PDFs are rasterized with
+    pdf2image when it is installed. Any other image is returned unchanged.
+
+    Args:
+        filename (str): Name of the uploaded file
+        data (bytes): Contents of the uploaded file
+
+    Returns:
+        list: Encoded image bytes, one entry per page
+
+    Raises:
+        ValueError: If the file is a PDF and pdf2image is not available
+    """
+    from PIL import Image, ImageSequence
+
+    if _is_pdf(filename, data):
+        try:
+            from pdf2image import convert_from_bytes
+        except ImportError:
+            raise ValueError("PDF scans require the pdf2image package")
+        frames = convert_from_bytes(data, dpi=300)
+    else:
+        try:
+            image = Image.open(io.BytesIO(data))
+        except Exception:
+            # Leave it to the OCR stage to report unreadable images
+            return [data]
+        if getattr(image, 'n_frames', 1) <= 1:
+            return [data]
+        frames = [frame.copy() for frame in ImageSequence.Iterator(image)]
+
+    pages = []
+    for frame in frames:
+        buffer = io.BytesIO()
+        frame.convert('RGB').save(buffer, format='PNG')
+        pages.append(buffer.getvalue())
+    return pages
+
+def run_batch_scan_pipeline(image_paths, progress=None):
+    """
+    Scan several prescription pages, OCRing them in parallel
+
+    Args:
+        image_paths (list): Paths to the page images, in page order
+        progress (callable, optional): Called as progress(stage, data) each
+            time a stage finishes, data holds partial results or is None
+
+    Returns:
+        dict: 'extracted_text', 'medications' and per-page 'pages' results
+    """
+    # Imported here so the OCR and AI stack is only loaded by scanning code
+    from utils.ocr import extract_text_from_image
+    from utils.med_extractor import get_catalog_dictionary
+
+    def report(stage, data=None):
+        if progress:
+            progress(stage, data)
+
+    # Worker threads have no app context, so load the catalog up front
+    catalog = get_catalog_dictionary()
+
+    with deadline_scope(SCAN_LATENCY_BUDGET), \
+            ThreadPoolExecutor(max_workers=max(1, min(OCR_WORKERS, len(image_paths)))) as executor:
+        # Pages share the scan's latency budget
+        page_texts = list(executor.map(propagate_context(extract_text_from_image), image_paths))
+        report('ocr_done', {'extracted_text': '\n\n'.join(page_texts)})
+
+        page_medications = list(executor.map(
+            propagate_context(lambda text: extract_medications(text, catalog)), page_texts))
+        detected_medications = merge_detected_medications(page_medications)
+        report('extraction_done', {'medications': detected_medications})
+
+    # Resolve the merged medications against the catalog in one pass
+    medications = resolve_medications(detected_medications)
+
+    extracted_text = '\n\n'.join(page_texts)
+    if not medications:
+        logging.info("Medication extraction didn't find medications, using fallback method")
+        medications = list({
+            med['id']: med for med in parse_labelled_medications(extracted_text)
+        }.values())
+    report('resolved', {'medications': medications})
+
+    return {
+        'extracted_text': extracted_text,
+        'medications': medications,
+        'pages': [
+            {'page': number, 'extracted_text': text, 'medications': detected or []}
+            for number, (text, detected) in enumerate(zip(page_texts, page_medications), 1)
+        ]
+    }
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import Prescription, ScanRecord
+
+# Side length of the difference hash grid, giving HASH_SIZE**2 bits
+HASH_SIZE = 16
+# Scans whose perceptual hashes differ in at most this many bits may be the
+# same prescription; their OCR text is compared before anything is reused
+DUPLICATE_DISTANCE = int(os.environ.get('SCAN_DUPLICATE_DISTANCE', 8))
+# Only the most recent scans are compared for near duplicates
+DUPLICATE_WINDOW = int(os.environ.get('SCAN_DUPLICATE_WINDOW', 5000))
+# Days stored scans are kept for reuse; images of confirmed prescriptions stay
+SCAN_RETENTION_DAYS = float(os.environ.get('SCAN_RETENTION_DAYS', 30))
+# Images nothing refers to are only deleted after this many seconds, so a scan
+# still being saved isn't removed under it
+ORPHAN_GRACE_SECONDS = 3600
+# Longest side of generated thumbnails, in pixels
+THUMBNAIL_SIZE = int(os.environ.get('SCAN_THUMBNAIL_SIZE', 480))
+
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF8', '.gif'),
+    (b'BM', '.bmp'),
+    (b'RIFF', '.webp'),
+    (b'II*\x00', '.tif'),
+    (b'MM\x00*', '.tif'),
+]
+
+def get_store_dir():
+    return app.config.get('SCAN_STORE_DIR') or os.path.join(app.instance_path, 'scans')
+
+def difference_hash(image, hash_size=HASH_SIZE):
+    """
+    Perceptual hash of an image that survives rescaling and recompression
+
+    Args:
+        image (numpy.ndarray): Decoded BGR or grayscale image
+        hash_size (int): Side length of the comparison grid
+
+    Returns:
+        str: The hash as hex, hash_size**2 bits long
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return np.packbits(bits.flatten()).tobytes().hex()
+
+def scan_fingerprint(image_bytes, image):
+    """
+    Exact and perceptual hashes of an uploaded scan
+
+    Args:
+        image_bytes (bytes): Encoded image as uploaded
+        image (numpy.ndarray): The same image, decoded
+
+    Returns:
+        tuple: (sha256 hex digest, difference hash hex)
+    """
+    return hashlib.sha256(image_bytes).hexdigest(), difference_hash(image)
+
+def hamming_distances(target, hashes):
+    """
+    Number of differing bits between one hash and each of several others
+
+    Args:
+        target (str): Hex hash
+        hashes (list): Hex hashes of the same length
+
+    Returns:
+        numpy.ndarray: One distance per entry in hashes
+    """
+    if not hashes:
+        return np.array([], dtype=np.int64)
+    width = len(target) // 2
+    rows = np.frombuffer(b''.join(bytes.fromhex(h) for h in hashes), dtype=np.uint8).reshape(-1, width)
+    differing = np.bitwise_xor(rows, np.frombuffer(bytes.fromhex(target), dtype=np.uint8))
+    return np.unpackbits(differing, axis=1).sum(axis=1)
+
+def find_duplicate_scan(fingerprint, user_id):
+    """
+    Find an identical scan stored for the same user
+
+    Only byte-for-byte identical uploads count, a similar looking page may
+    be another patient's prescription.
+
+    Args:
+        fingerprint (tuple): (sha256, dhash) from scan_fingerprint
+        user_id (int): ID of the uploading user, nothing is reused if None
+
+    Returns:
+        ScanRecord: The identical scan, or None
+    """
+    if user_id is None:
+        return None
+
+    record = ScanRecord.query.filter_by(user_id=user_id, sha256=fingerprint[0]).first()
+    if record:
+        logging.info(f"Reusing result of identical scan {record.id}")
+    return record
+
+def find_similar_scan(fingerprint, user_id):
+    """
+    Find the user's stored scan that looks most like this one
+
+    A hint only: the caller still runs OCR and must compare the text before
+    using anything from it.
+
+    Args:
+        fingerprint (tuple): (sha256, dhash) from scan_fingerprint
+        user_id (int): ID of the uploading user, nothing is returned if None
+
+    Returns:
+        ScanRecord: The closest of the user's scans within
+            DUPLICATE_DISTANCE, or None
+    """
+    if user_id is None:
+        return None
+
+    dhash = fingerprint[1]
+    candidates = (db.session.query(ScanRecord.id, ScanRecord.dhash)
+                  .filter(ScanRecord.user_id == user_id)
+                  .order_by(ScanRecord.id.desc())
+                  .limit(DUPLICATE_WINDOW)
+                  .all())
+    candidates = [(record_id, candidate) for record_id, candidate in candidates
+                  if len(candidate) == len(dhash)]
+    if not candidates:
+        return None
+
+    distances = hamming_distances(dhash, [candidate for _, candidate in candidates])
+    closest = int(np.argmin(distances))
+    if distances[closest] > DUPLICATE_DISTANCE:
+        return None
+    return db.session.get(ScanRecord, candidates[closest][0])
+
+def same_scan_text(first, second):
+    """Whether two OCR texts are the same apart from case and whitespace"""
+    return ' '.join((first or '').lower().split()) == ' '.join((second or '').lower().split())
+
+def _extension_for(image_bytes):
+    for signature, extension in IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return extension
+    return '.img'
+
+def store_scan_image(image_bytes, digest):
+    """
+    Write an image to the content-addressed store, once
+
+    Args:
+        image_bytes (bytes): Encoded image
+        digest (str): Its sha256 hex digest
+
+    Returns:
+        str: Path of the image relative to the store
+    """
+    relative_path = os.path.join(digest[:2], digest + _extension_for(image_bytes))
+    path = os.path.join(get_store_dir(), relative_path)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see half an image
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as temp_file:
+            temp_file.write(image_bytes)
+        os.replace(temp_file.name, path)
+    return relative_path
+
+def save_scan(image_bytes, fingerprint, result, user_id=None):
+    """
+    Store a processed scan so the same prescription isn't processed again
+
+    Args:
+        image_bytes (bytes): Encoded image as uploaded
+        fingerprint (tuple): (sha256, dhash) from scan_fingerprint
+        result (dict): Pipeline result with 'extracted_text' and 'medications'
+        user_id (int, optional): ID of the uploading user
+
+    Returns:
+        ScanRecord: The stored scan
+    """
+    digest, dhash = fingerprint
+    record = ScanRecord(
+        user_id=user_id,
+        sha256=digest,
+        dhash=dhash,
+        image_path=store_scan_image(image_bytes, digest),
+        extracted_text=result['extracted_text'],
+        medications_json=json.dumps(result['medications'])
+    )
+    db.session.add(record)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The same image finished processing in another job first
+        db.session.rollback()
+        record = ScanRecord.query.filter_by(user_id=user_id, sha256=digest).first()
+    return record
+
+def scan_result(record):
+    """
+    Pipeline result stored for a scan
+
+    Args:
+        record (ScanRecord): A stored scan
+
+    Returns:
+        dict: 'extracted_text', 'medications' and 'scan_id'
+    """
+    return {
+        'extracted_text': record.extracted_text,
+        'medications': json.loads(record.medications_json or '[]'),
+        'scan_id': record.id
+    }
+
+def get_scan_thumbnail(image_path, size=THUMBNAIL_SIZE):
+    """
+    Get a thumbnail of a stored scan, generating it on first use
+
+    Args:
+        image_path (str): Path of the image relative to the store
+        size (int): Longest side of the thumbnail
+
+    Returns:
+        str: Absolute path of the cached JPEG thumbnail, or None if the
+            image is missing or unreadable
+    """
+    store_dir = get_store_dir()
+    source = os.path.join(store_dir, image_path)
+    name = os.path.splitext(os.path.basename(image_path))[0] + '.jpg'
+    thumbnail = os.path.join(store_dir, 'thumbnails', str(size), name[:2], name)
+    if os.path.exists(thumbnail):
+        return thumbnail
+
+    image = cv2.imread(source)
+    if image is None:
+        logging.warning(f"Could not read stored scan {image_path}")
+        return None
+
+    height, width = image.shape[:2]
+    scale = min(1.0, size / max(height, width))
+    if scale < 1.0:
+        image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    if not ok:
+        return None
+
+    os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(thumbnail), delete=False) as temp_file:
+        temp_file.write(encoded.tobytes())
+    os.replace(temp_file.name, thumbnail)
+    return thumbnail
+
+def prune_scan_store(retention_days=None):
+    """
+    Delete stored scans past the retention period, and images nothing uses
+
+    Scan records older than retention_days, and any kept without an
+    uploader, are removed. Images and thumbnails in the store are then
+    deleted unless a scan record or a prescription still refers to them.
+
+    Args:
+        retention_days (float, optional): SCAN_RETENTION_DAYS by default
+
+    Returns:
+        dict: Numbers of 'records' and 'files' deleted
+    """
+    retention_days = SCAN_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    try:
+        records = (ScanRecord.query
+                   .filter((ScanRecord.created_at < cutoff) | ScanRecord.user_id.is_(None))
+                   .delete(synchronize_session=False))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    in_use = {path for (path,) in db.session.query(ScanRecord.image_path)}
+    in_use.update(path for (path,) in db.session.query(Prescription.scan_image_path)
+                  .filter(Prescription.scan_image_path.isnot(None)))
+    digests = {os.path.splitext(os.path.basename(path))[0] for path in in_use}
+
+    store_dir = get_store_dir()
+    thumbnails_dir = os.path.join(store_dir, 'thumbnails')
+    orphan_before = time.time() - ORPHAN_GRACE_SECONDS
+    files = 0
+    for directory, subdirectories, names in os.walk(store_dir):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.commonpath([path, thumbnails_dir]) == thumbnails_dir:
+                used = os.path.splitext(name)[0] in digests
+            else:
+                used = os.path.relpath(path, store_dir) in in_use
+            if not used and os.path.getmtime(path) < orphan_before:
+                os.remove(path)
+                files += 1
+
+    logging.info(f"Pruned {records} stored scans and {files} files from the scan store")
+    return {'records': records, 'files': files}